@@ -19,27 +19,28 @@
 BASE_PATH="$(dirname "$0")"
 
 # Compile mappings and list them
-mappingList=
-for mapping in $(ls "$BASE_PATH/src/mappings.in/"); do
-    echo -n "Processing mapping: $mapping ..."
-    cat "$BASE_PATH/src/mappings.in/$mapping" | sed -e 's;//.*$;;' -e 's; \+;;g' | tr -d '\n' | sed -e 's;,\(]\|}\);\1;' > "$BASE_PATH/src/mappings/${mapping%.*}.json"
-    mappingName="$(grep '^// Name: ' "$BASE_PATH/src/mappings.in/$mapping" | cut -c 10-)"
-    mappingIcon="$(grep '^// Icon: ' "$BASE_PATH/src/mappings.in/$mapping" | cut -c 10-)"
-    mappingList="$mappingList,{\"code\":\"${mapping%.*}\", \"name\":\"${mappingName}\", \"icon\":\"${mappingIcon}\"}"
-    echo "DONE"
-done
-echo -n "[${mappingList#,}]" > "$BASE_PATH/src/mappings/list.json"
+python3 "$BASE_PATH/tools/compile_mappings.py" "$BASE_PATH/src/mappings.in" "$BASE_PATH/src/mappings" || exit 1
+
+# Only package the flags used by the mappings
+FLAGS=$(python3 -c 'import json, sys; print("\n".join(sorted({"icons/32x32/flags/" + mapping["icon"] for mapping in json.load(sys.stdin)})))' \
+        < "$BASE_PATH/src/mappings/list.json") || exit 1
 
 # Build the *.xpi file
 test -d dist || mkdir dist
 pushd src
-zip -r -FS ../dist/keyboard_compositor.xpi \
+zip -r -FS -9 ../dist/keyboard_compositor.xpi \
     manifest.json                          \
     kc_background.js                       \
+    kc_bootstrap.js                        \
     kc_content_script.js                   \
     kc_content_script.css                  \
-    mappings/*.json                        \
-    icons/32x32/flags/*.png
+    options.html                           \
+    options.js                             \
+    mappings                               \
+    $FLAGS                                 \
+    -x mappings/.hashes mappings/.conflicts
 popd
 
-
+# Report the package size
+echo "Package size: $(stat -c %s dist/keyboard_compositor.xpi) bytes"
+unzip -Zt dist/keyboard_compositor.xpi
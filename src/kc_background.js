@@ -20,86 +20,737 @@ function menuItemClicked(frameId, targetElementId, mapping)
     });
 }
 
-function installMappings(list) {
-    var kcMenuItems = [{
-        id: browser.menus.create({
+/*!
+ * \brief Context menu state
+ *
+ * This object keeps the language state of the element targeted by the context menu,
+ * as pushed by the content scripts (see \c kc_bootstrap.js) when the context menu is requested
+ * and when the language of an element is changed, and the state of the menu items.
+ * The menu items are updated as soon as the state is pushed, so that the menu is right when it opens.
+ * Only the menu items whose title or checked state changed are updated.
+ *
+ * The menu items are created once (see buildMenus()) and outlive the background page,
+ * which is unloaded when it is idle. When it is loaded again, the state of the menu items
+ * is unknown, so that they are all updated the first time.
+ */
+var contextMenu = {
+    list: [],           // List of the mappings
+    items: [],          // Menu items, with their mapping code, title and checked state
+    states: new Map(),  // Language state of the last targeted or changed element, indexed by tab and frame
+    shown: null,        // Tab and frame for which the menu is shown
+
+    key: function(tabId, frameId) {
+        return tabId + ':' + (frameId || 0);
+    },
+
+    /*!
+     * \brief Set the language state of a frame
+     *
+     * \param tabId The identifier of the tab.
+     * \param frameId The identifier of the frame.
+     * \param state An array containing the \c lang and \c kc-lang attributes of the element.
+     * \param target Whether the element is targeted by the context menu which is opening.
+     * \return A promise resolved when the menu items are updated.
+     */
+    setState: function(tabId, frameId, state, target) {
+        var key = this.key(tabId, frameId);
+        this.states.set(key, {state: state, target: target});
+        return this.apply(state).then((changed) => {
+            if (changed && (this.shown == key))
+                return browser.menus.refresh();
+        });
+    },
+
+    /*!
+     * \brief Update the menu items
+     *
+     * \param state An array containing the \c lang and \c kc-lang attributes of the element.
+     * \return A promise resolved with whether a menu item was updated.
+     */
+    apply: function(state) {
+        var updates = [];
+        for (const item of this.items) {
+            var properties = {};
+            var checked = (item.mapping == state[1]);
+            if (item.checked != checked)
+                properties.checked = item.checked = checked;
+            if (!item.mapping) {
+                var mapping = this.list.find((e) => (e.code == state[0]));
+                var title = mapping ? "Default (" + mapping.name + ")" : "None";
+                if (item.title != title)
+                    properties.title = item.title = title;
+            }
+            if (Object.keys(properties).length > 0)
+                updates.push(browser.menus.update(item.id, properties));
+        }
+        return Promise.all(updates).then(() => (updates.length > 0));
+    },
+
+    /*!
+     * \brief Get the identifier of the menu item of a mapping
+     *
+     * \param code The code of the mapping, or \c null for the "None" item.
+     * \return The identifier of the menu item.
+     */
+    id: function(code) {
+        return 'kc-lang-' + (code || '');
+    },
+
+    /*!
+     * \brief Load the menu items
+     *
+     * This function describes the menu items of the given mappings (which were created by build()).
+     * Their title and checked state are unknown.
+     *
+     * \param list The list of mappings.
+     */
+    load: function(list) {
+        this.list = list;
+        this.items = [null].concat(list.map((mapping) => mapping.code)).map((code) => ({
+            id: this.id(code),
+            mapping: code,
+        }));
+    },
+
+    /*!
+     * \brief Build the menu items
+     *
+     * This function creates a radio item for each mapping (and the "None" item)
+     * and the "Transliterate" item.
+     *
+     * \param list The list of mappings.
+     */
+    build: function(list) {
+        this.load(list);
+        browser.menus.create({
+            id: this.id(null),
             title: "None",
             type: 'radio',
             checked: true,
             contexts: ['editable'],
-            onclick: function(info) {
-                if (info.editable)
-                    menuItemClicked(info.frameId, info.targetElementId, null);
-            },
-        }, function() {
-            if (browser.runtime.lastError) {
-                console.log("error creating item 'none':" + browser.runtime.lastError);
-            } else {
-                console.log("item created successfully");
-            }
-        }),
-        mapping: null,
-    }];
-
-    for (const mapping of list) {
-        kcMenuItems.push({
-            id: browser.menus.create({
+        });
+        for (const mapping of list) {
+            browser.menus.create({
+                id: this.id(mapping.code),
                 title: mapping.name,
                 type: 'radio',
                 contexts: ['editable'],
-                onclick: function(info) {
-                    if (info.editable)
-                        menuItemClicked(info.frameId, info.targetElementId, mapping.code);
-                },
-            }, function() {
-                if (browser.runtime.lastError) {
-                    console.log("error creating item '" + mapping.code + "':" + browser.runtime.lastError);
-                } else {
-                    console.log("item created successfully");
+            });
+        }
+        browser.menus.create({
+            id: 'kc-separator',
+            type: 'separator',
+            contexts: ['editable'],
+        });
+        browser.menus.create({
+            id: 'kc-transliterate',
+            title: "Transliterate",
+            contexts: ['editable'],
+        });
+    },
+
+    /*!
+     * \brief Menu item clicked callback
+     *
+     * The radio items are checked by the browser, so their state is updated here.
+     * \param info The information about the clicked item.
+     * \param tab The tab in which the menu was shown.
+     */
+    clicked: function(info, tab) {
+        if (info.menuItemId == 'kc-transliterate') {
+            if (info.editable)
+                browser.tabs.sendMessage(tab.id, {
+                    'command': "TRANSLITERATE",
+                    'elementId': info.targetElementId,
+                }, {frameId: info.frameId});
+            return;
+        }
+
+        var code = info.menuItemId.slice(this.id(null).length) || null;
+        for (const item of this.items)
+            item.checked = (item.mapping === code);
+        if (info.editable)
+            menuItemClicked(info.frameId, info.targetElementId, code);
+    },
+};
+
+/*!
+ * \brief Load mappings
+ *
+ * This function loads the list of mappings and all the mappings it contains.
+ * The mappings are compiled by \c tools/compile_mappings.py at build time.
+ * They are loaded here when the background page is woken up (see loadState())
+ * and served to the content scripts of all the frames in answer to the \c GET_MAPPINGS command
+ * (with the mappings of the languages present in the frame) and the \c GET_MAPPING command.
+ *
+ * \return A promise resolving to an object containing the list of mappings
+ * and the compiled mappings indexed by their code.
+ */
+function loadMappings()
+{
+    return fetch(browser.runtime.getURL("mappings/list.json"), {method: "GET"})
+        .then((response) => response.json())
+        .then((list) => Promise.all(list.filter((mapping) => !mapping.shards).map((mapping) => {
+            return fetch(browser.runtime.getURL("mappings/" + mapping.code + ".json"), {method: "GET"})
+                .then((response) => response.json())
+                .then((data) => [mapping.code, data]);
+        })).then((compiled) => ({
+            list: list,
+            mappings: Object.fromEntries(compiled),
+        })));
+}
+
+/*!
+ * \brief Load all the shards of a mapping
+ *
+ * Sharded mappings (see \c tools/compile_mappings.py) are not loaded by loadMappings():
+ * the content scripts load the shards they need. This function loads the whole mapping,
+ * when it is the base of a user mapping.
+ *
+ * \param mapping The sharded mapping, as listed in \c mappings/list.json.
+ * \return A promise resolved with the compiled mapping.
+ */
+function loadShards(mapping)
+{
+    return Promise.all(mapping.shards.map((char) => {
+        var name = char.codePointAt(0).toString(16).padStart(4, '0');
+        return fetch(browser.runtime.getURL("mappings/" + mapping.code + "/" + name + ".json"), {method: "GET"})
+            .then((response) => response.json())
+            .then((data) => [char, data]);
+    })).then((shards) => Object.fromEntries(shards));
+}
+
+/*!
+ * \brief Compile a mapping
+ *
+ * This function compiles a mapping into a reverse suffix trie,
+ * in the same format as \c tools/compile_mappings.py (indexed by code points,
+ * so that a surrogate pair is a single node).
+ *
+ * \param mapping The mapping, as an object associating the keys with the mapped texts.
+ * \return The root node of the trie.
+ */
+function compileMapping(mapping)
+{
+    var root = {};
+    for (const [key, value] of Object.entries(mapping)) {
+        var node = root;
+        for (const char of Array.from(key).reverse())
+            node = node[char] || (node[char] = {});
+        node[''] = value;
+    }
+    return root;
+}
+
+/*!
+ * \brief Flatten a compiled mapping
+ *
+ * \param trie The root node of the compiled mapping.
+ * \return The mapping, as an object associating the keys with the mapped texts.
+ */
+function flattenMapping(trie)
+{
+    var mapping = {};
+    var stack = [['', trie]];
+    while (stack.length > 0) {
+        var [suffix, node] = stack.pop();
+        for (const [char, child] of Object.entries(node)) {
+            if (char === '')
+                mapping[suffix] = child;
+            else
+                stack.push([char + suffix, child]);
+        }
+    }
+    return mapping;
+}
+
+/*!
+ * \brief Check a mapping
+ *
+ * Empty keys are rejected, as well as shadowed keys (see \c checkMapping() in \c tools/compile_mappings.py).
+ *
+ * \param mapping The mapping, as an object associating the keys with the mapped texts.
+ * \throw Error When the mapping is invalid.
+ */
+function checkMapping(mapping)
+{
+    for (const key of Object.keys(mapping)) {
+        if (!key)
+            throw new Error("Empty key");
+        var chars = Array.from(key);
+        for (var j = 1; j < chars.length; j++) {
+            for (var i = 0; i < j; i++) {
+                var other = chars.slice(i, j).join('');
+                if ((mapping[other] !== undefined) && (mapping[other] != other))
+                    throw new Error("Key '" + key + "' is shadowed by key '" + other + "'");
+            }
+        }
+    }
+}
+
+/*!
+ * \brief User mappings
+ *
+ * The user mappings are edited in the options page (see \c options.js) and stored
+ * in the local storage, under \c mapping:<code> keys. Their source is an object with
+ * the following properties:
+ * \li \c name The name of the language.
+ * \li \c icon The flag icon (in \c icons/32x32/flags), which defaults to the icon of the base mapping.
+ * \li \c base The code of the built-in mapping which is overridden (optional).
+ * \li \c entries The keys and the mapped texts (\c null removes a key of the base mapping).
+ * \li \c version A version stamp, changed on each edit.
+ *
+ * Each source is compiled once, when it is edited, and the compiled mapping is stored
+ * under the \c compiled:<code> key with the version stamps of its source and of the compiler,
+ * so that it is only compiled again when one of them changes.
+ * The content scripts follow the changes of the compiled mappings (see \c kc_content_script.js).
+ * A user mapping whose code is the code of a built-in mapping replaces it.
+ */
+var userMappings = {
+    compilerVersion: 1, // Bump when the compiled format changes
+    builtin: null,      // Built-in mappings, as returned by loadMappings()
+    sources: {},        // Sources of the user mappings, indexed by their code
+    compiled: {},       // Compiled user mappings, indexed by their code
+
+    /*!
+     * \brief Load the user mappings
+     *
+     * This function compiles the user mappings whose compiled version is outdated.
+     *
+     * \param builtin The built-in mappings, as returned by loadMappings().
+     * \return A promise resolved when the user mappings are loaded.
+     */
+    load: function(builtin) {
+        this.builtin = builtin;
+        return browser.storage.local.get(null).then((items) => {
+            var updates = {};
+            var compiling = [];
+            for (const [key, source] of Object.entries(items)) {
+                if (!key.startsWith('mapping:'))
+                    continue;
+                const code = key.slice('mapping:'.length);
+                this.sources[code] = source;
+                var record = items['compiled:' + code];
+                if (record && (record.version === source.version) && (record.compiler === this.compilerVersion))
+                    this.compiled[code] = record;
+                else
+                    compiling.push(this.compile(code, source).then((record) => {
+                        this.compiled[code] = updates['compiled:' + code] = record;
+                    }));
+            }
+            // Remove the mappings whose source was removed:
+            var removed = Object.keys(items).filter((key) => key.startsWith('compiled:') && !items['mapping:' + key.slice('compiled:'.length)]);
+            return Promise.all(compiling).then(() => Promise.all([
+                browser.storage.local.set(updates),
+                browser.storage.local.remove(removed),
+            ]));
+        });
+    },
+
+    /*!
+     * \brief Compile a user mapping
+     *
+     * \param code The code of the mapping.
+     * \param source The source of the mapping.
+     * \return A promise resolved with the compiled mapping, with its code, name, icon and version stamps,
+     * and either the compiled trie or an error message.
+     */
+    compile: function(code, source) {
+        var base = source.base ? this.builtin.list.find((mapping) => (mapping.code == source.base)) : undefined;
+        var record = {
+            code: code,
+            name: source.name || code,
+            icon: source.icon || (base ? base.icon : undefined),
+            version: source.version,
+            compiler: this.compilerVersion,
+        };
+
+        var trie;
+        if (!base)
+            trie = Promise.resolve({});
+        else if (base.shards)
+            trie = loadShards(base);
+        else
+            trie = Promise.resolve(this.builtin.mappings[base.code]);
+
+        return trie.then((trie) => {
+            if (source.base && !base)
+                throw new Error("Unknown base mapping '" + source.base + "'");
+            var mapping = flattenMapping(trie);
+            for (const [key, value] of Object.entries(source.entries || {})) {
+                if (value === null)
+                    delete mapping[key];
+                else
+                    mapping[key] = value;
+            }
+            checkMapping(mapping);
+            record.trie = compileMapping(mapping);
+            return record;
+        }).catch((error) => {
+            record.error = error.message;
+            return record;
+        });
+    },
+
+    /*!
+     * \brief Get the available mappings
+     *
+     * \return An object containing the list of the available mappings
+     * and the compiled mappings indexed by their code (as loadMappings()).
+     */
+    registry: function() {
+        var list = this.builtin.list.slice();
+        var mappings = Object.assign({}, this.builtin.mappings);
+        for (const record of Object.values(this.compiled)) {
+            if (!record.trie)
+                continue;
+            var entry = {code: record.code, name: record.name, icon: record.icon};
+            var index = list.findIndex((mapping) => (mapping.code == record.code));
+            if (index < 0)
+                list.push(entry);
+            else
+                list[index] = entry;
+            mappings[record.code] = record.trie;
+        }
+        return {list: list, mappings: mappings};
+    },
+
+    /*!
+     * \brief Storage changed callback
+     *
+     * The edited sources are compiled and the menus are rebuilt.
+     * The user mappings must be loaded (the background page may have been loaded
+     * by this change, in which case load() already compiled the edited sources).
+     *
+     * \param changes The changes in the local storage.
+     * \return A promise resolved when the menus are rebuilt.
+     */
+    changed: function(changes) {
+        var compiling = [];
+        for (const [key, change] of Object.entries(changes)) {
+            if (!key.startsWith('mapping:'))
+                continue;
+            const code = key.slice('mapping:'.length);
+            if (change.newValue) {
+                const version = change.newValue.version;
+                var record = this.compiled[code];
+                this.sources[code] = change.newValue;
+                if (record && (record.version === version))
+                    continue;
+                compiling.push(this.compile(code, change.newValue).then((record) => {
+                    // Skip the result if the source was changed again while it was compiled:
+                    var source = this.sources[code];
+                    if (!source || (source.version !== version))
+                        return;
+                    this.compiled[code] = record;
+                    return browser.storage.local.set({['compiled:' + code]: record});
+                }));
+            } else {
+                delete this.sources[code];
+                if (this.compiled[code]) {
+                    delete this.compiled[code];
+                    compiling.push(browser.storage.local.remove('compiled:' + code));
                 }
-            }),
-            mapping: mapping.code,
+            }
+        }
+        if (!Object.keys(changes).some((key) => key.startsWith('mapping:')))
+            return Promise.resolve();
+        return Promise.all(compiling).then(() => buildMenus(this.registry().list));
+    },
+};
+
+var mappingsLoaded = null; // Promise resolved when the state of the background page is loaded
+var transientStorage = browser.storage.session || browser.storage.local; // Storage for the state which does not survive a restart
+
+/*!
+ * \brief Load the state of the background page
+ *
+ * The background page is an event page, which is unloaded when it is idle.
+ * Its state (the built-in and user mappings, the state of the context menu items and the
+ * performance statistics) is loaded again from the package and the storage on demand,
+ * when the page is woken up by an event which needs it.
+ *
+ * \return A promise resolved when the state is loaded.
+ */
+function loadState()
+{
+    if (!mappingsLoaded) {
+        mappingsLoaded = Promise.all([
+            loadMappings().then((builtin) => userMappings.load(builtin)),
+            perfStats.load(),
+        ]).then(() => {
+            contextMenu.load(userMappings.registry().list);
+            // Time elapsed since the background page was loaded:
+            var wakeup = performance.now();
+            console.log("Background page state loaded in " + wakeup.toFixed(1) + "ms");
+            perfStats.add({wakeup: [wakeup]}, {wakeups: 1});
+        });
+        mappingsLoaded.catch((error) => {
+            console.error(error);
+            mappingsLoaded = null;
         });
     }
+    return mappingsLoaded;
+}
 
-    browser.menus.onShown.addListener((info) => {
-        browser.tabs.query({
-            active: true,
-            currentWindow: true,
-        }).then((tabs) => {
-            browser.tabs.sendMessage(tabs[0].id, {
-                'command': "GET_LANG",
-                'elementId': info.targetElementId,
-            }, {frameId: info.frameId}).then((attributeArray) => {
-                Promise.all(kcMenuItems.map((menuItemInfo) => {
-                    if (!menuItemInfo.mapping) {
-                        var mapping = list.find((e) => (e.code == attributeArray[0]));
-                        return browser.menus.update(menuItemInfo.id, {
-                            title: mapping ? "Default (" + mapping.name + ")" : "None",
-                            checked: menuItemInfo.mapping == attributeArray[1],
-                        });
-                    } else {
-                        return browser.menus.update(menuItemInfo.id, {
-                            checked: menuItemInfo.mapping == attributeArray[1],
-                        });
-                    }
-                })).then(() => {
-                    browser.menus.refresh();
-                });
-            });
+/*!
+ * \brief Performance statistics
+ *
+ * This object aggregates the performance records sent by the content scripts
+ * (see \c perf in \c kc_content_script.js) into histograms of durations and counters.
+ * Recording is toggled with the "Record performance" item of the Tools menu
+ * or the \c SET_PERF command. The statistics can be exported as JSON with the
+ * "Export performance data" item of the Tools menu or the \c GET_PERF command.
+ * The statistics are kept in the session storage, so that they survive the unloading of the background page.
+ * The time the background page takes to wake up (until its state is loaded) is recorded as \c wakeup.
+ */
+var perfStats = {
+    bounds: [0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 25, 50, 100, 250, Infinity], // Upper bounds of the histogram buckets (in ms)
+    enabled: false,     // Whether recording is enabled
+    since: null,        // Time at which recording was enabled
+    durations: {},      // Histograms of the durations, indexed by their name
+    counters: {},       // Counters, indexed by their name
+
+    /*!
+     * \brief Load the statistics
+     *
+     * \return A promise resolved when the statistics are loaded from the session storage.
+     */
+    load: function() {
+        return transientStorage.get({perfStats: null}).then((data) => {
+            if (data.perfStats)
+                Object.assign(this, data.perfStats);
         });
-    });
+    },
+
+    /*!
+     * \brief Save the statistics
+     *
+     * \return A promise resolved when the statistics are saved in the session storage.
+     */
+    save: function() {
+        return transientStorage.set({perfStats: {
+            enabled: this.enabled,
+            since: this.since,
+            durations: this.durations,
+            counters: this.counters,
+        }});
+    },
+
+    /*!
+     * \brief Enable or disable recording
+     *
+     * The new state is sent to the content scripts of all the tabs.
+     * The statistics are reset when recording is enabled.
+     *
+     * \param enabled Whether recording should be enabled.
+     * \return A promise resolved when the content scripts were notified.
+     */
+    setEnabled: function(enabled) {
+        if (enabled && !this.enabled) {
+            this.since = new Date().toISOString();
+            this.durations = {};
+            this.counters = {};
+        }
+        this.enabled = enabled;
+        this.save();
+        browser.menus.update('kc-perf-record', {checked: enabled});
+        return browser.tabs.query({}).then((tabs) => Promise.all(tabs.map((tab) => {
+            return browser.tabs.sendMessage(tab.id, {command: "SET_PERF", enabled: enabled})
+                .catch(() => {}); // Tab without content script
+        }))).then(() => {});
+    },
+
+    /*!
+     * \brief Add performance records
+     *
+     * \param durations The recorded durations (in ms), indexed by their name.
+     * \param counters The recorded counters, indexed by their name.
+     */
+    add: function(durations, counters) {
+        if (!this.enabled)
+            return;
+        for (const [name, values] of Object.entries(durations)) {
+            var histogram = this.durations[name];
+            if (!histogram)
+                histogram = this.durations[name] = {count: 0, sum: 0, max: 0, buckets: this.bounds.map(() => 0)};
+            for (const value of values) {
+                histogram.count++;
+                histogram.sum += value;
+                histogram.max = Math.max(histogram.max, value);
+                histogram.buckets[this.bounds.findIndex((bound) => (value <= bound))]++;
+            }
+        }
+        for (const [name, value] of Object.entries(counters))
+            this.counters[name] = (this.counters[name] || 0) + value;
+        this.save();
+    },
 
-    browser.runtime.onMessageExternal.addListener((message, sender, sendResponse) => {
-        console.log("Got external message:", message);
-        return browser.tabs.query({
-            active: true,
-            currentWindow: true,
-        }).then((tabs) => browser.tabs.sendMessage(tabs[0].id, message));
+    /*!
+     * \brief Export the statistics
+     *
+     * \return An object containing the histograms of the durations and the counters.
+     */
+    export: function() {
+        var durations = {};
+        for (const [name, histogram] of Object.entries(this.durations)) {
+            durations[name] = {
+                count: histogram.count,
+                mean: histogram.sum / histogram.count,
+                max: histogram.max,
+                buckets: Object.fromEntries(this.bounds.map((bound, b) => ['<=' + bound, histogram.buckets[b]])),
+            };
+        }
+        return {
+            enabled: this.enabled,
+            since: this.since,
+            durations: durations,
+            counters: this.counters,
+        };
+    },
+
+    /*!
+     * \brief Handle the \c GET_PERF and \c SET_PERF commands
+     *
+     * \param message The message to handle.
+     * \return A promise resolved with the exported statistics.
+     */
+    handleMessage: function(message) {
+        if (message.command == "SET_PERF")
+            return this.setEnabled(message.enabled).then(() => this.export());
+        return Promise.resolve(this.export());
+    },
+};
+
+/*!
+ * \brief Build the menus
+ *
+ * This function creates the context menu items (see contextMenu) and the Tools menu items.
+ * The menu items persist when the background page is unloaded, so they are only built
+ * when the extension is installed or updated and when the list of mappings changes.
+ *
+ * \param list The list of mappings.
+ * \return A promise resolved when the menu items are created.
+ */
+function buildMenus(list)
+{
+    return browser.menus.removeAll().then(() => {
+        contextMenu.build(list);
+        browser.menus.create({
+            id: 'kc-perf-record',
+            title: "Record performance",
+            type: 'checkbox',
+            checked: perfStats.enabled,
+            contexts: ['tools_menu'],
+        });
+        browser.menus.create({
+            id: 'kc-perf-export',
+            title: "Export performance data",
+            contexts: ['tools_menu'],
+        });
     });
 }
 
-fetch(browser.runtime.getURL("mappings/list.json"), {method: "GET"})
-        .then((response) => response.json())
-        .then((list) => {installMappings(list);})
+/*!
+ * \brief Load the compositor
+ *
+ * This function injects the compositor and its style sheet in the frame
+ * of the content script bootstrap (see \c kc_bootstrap.js) which asked for it.
+ *
+ * \param sender The sender of the \c LOAD_COMPOSITOR command.
+ * \return A promise resolved when the compositor is injected.
+ */
+function loadCompositor(sender)
+{
+    return Promise.all([
+        browser.tabs.insertCSS(sender.tab.id, {file: "kc_content_script.css", frameId: sender.frameId}),
+        browser.tabs.executeScript(sender.tab.id, {file: "kc_content_script.js", frameId: sender.frameId}),
+    ]).then(() => {});
+}
+
+// The listeners are registered synchronously, so that they wake up the background page:
+browser.runtime.onInstalled.addListener(() => {
+    loadState()
+        .then(() => buildMenus(userMappings.registry().list))
         .catch((error) => {console.error(error);});
+});
+
+browser.menus.onClicked.addListener((info, tab) => {
+    loadState().then(() => {
+        if (info.menuItemId == 'kc-perf-record')
+            return perfStats.setEnabled(info.checked);
+        if (info.menuItemId == 'kc-perf-export') {
+            var blob = new Blob([JSON.stringify(perfStats.export(), null, 4)], {type: 'application/json'});
+            return browser.tabs.create({url: URL.createObjectURL(blob)});
+        }
+        contextMenu.clicked(info, tab);
+    }).catch((error) => {console.error(error);});
+});
+
+browser.menus.onShown.addListener((info, tab) => {
+    if (!info.editable)
+        return;
+    var key = contextMenu.key(tab.id, info.frameId);
+    var state = contextMenu.states.get(key);
+    contextMenu.shown = key;
+    if (state && state.target) {
+        state.target = false;
+        return;
+    }
+
+    // The state was not pushed (yet), ask the content script:
+    browser.tabs.sendMessage(tab.id, {
+        'command': "GET_LANG",
+        'elementId': info.targetElementId,
+    }, {frameId: info.frameId}).then((attributeArray) => {
+        if (attributeArray)
+            return loadState().then(() => contextMenu.setState(tab.id, info.frameId, attributeArray, false));
+    }).catch((error) => {console.error(error);});
+});
+
+browser.menus.onHidden.addListener(() => {
+    contextMenu.shown = null;
+});
+
+browser.storage.onChanged.addListener((changes, area) => {
+    if ((area == 'local') && Object.keys(changes).some((key) => key.startsWith('mapping:')))
+        loadState().then(() => userMappings.changed(changes)).catch((error) => {console.error(error);});
+});
+
+browser.runtime.onMessageExternal.addListener((message, sender, sendResponse) => {
+    console.log("Got external message:", message);
+    if ((message.command == "GET_PERF") || (message.command == "SET_PERF"))
+        return loadState().then(() => perfStats.handleMessage(message));
+    return browser.tabs.query({
+        active: true,
+        currentWindow: true,
+    }).then((tabs) => browser.tabs.sendMessage(tabs[0].id, message));
+});
+
+browser.runtime.onMessage.addListener((message, sender) => {
+    if (message.command == "GET_MAPPINGS")
+        return loadState().then(() => {
+            // The other mappings are requested by the frames when they need them:
+            var registry = userMappings.registry();
+            var codes = new Set(message.codes);
+            return {
+                perf: perfStats.enabled,
+                list: registry.list,
+                mappings: Object.fromEntries(Object.entries(registry.mappings).filter(([code]) => codes.has(code))),
+            };
+        });
+    if (message.command == "GET_MAPPING")
+        return loadState().then(() => {
+            var registry = userMappings.registry();
+            var mapping = registry.list.find((mapping) => (mapping.code == message.code));
+            return mapping ? {mapping: mapping, trie: registry.mappings[message.code]} : null;
+        });
+    if (message.command == "LOAD_COMPOSITOR")
+        return loadCompositor(sender);
+    if (message.command == "LANG_STATE")
+        return loadState().then(() => contextMenu.setState(sender.tab.id, sender.frameId, message.state, message.target));
+    if (message.command == "PERF_DATA")
+        return loadState().then(() => {perfStats.add(message.durations, message.counters);});
+    if ((message.command == "GET_PERF") || (message.command == "SET_PERF"))
+        return loadState().then(() => perfStats.handleMessage(message));
+});
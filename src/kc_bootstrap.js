@@ -0,0 +1,231 @@
+/* Copyright 2020 Pascal COMBES <pascom@orange.fr>
+ *
+ * This file is part of KeyboardCompositor.
+ *
+ * KeyboardCompositor is free software: you can redistribute it and/or modify
+ * it under the terms of the GNU General Public License as published by
+ * the Free Software Foundation, either version 3 of the License, or
+ * (at your option) any later version.
+ *
+ * KeyboardCompositor is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+ * GNU General Public License for more details.
+ *
+ * You should have received a copy of the GNU General Public License
+ * along with KeyboardCompositor. If not, see <http://www.gnu.org/licenses/>
+ */
+
+/*!
+ * \brief Content script bootstrap
+ *
+ * This is the only content script injected in every page. It checks whether the page
+ * contains a text field with a \c lang attribute (when the page is loaded and when a text field
+ * is inserted or gets a \c lang attribute) and listens to the messages of the background script.
+ * The compositor (\c kc_content_script.js, its style sheet and the mappings) is only
+ * loaded when a text field is found or when a message needs it.
+ *
+ * The compositor is injected by the background script in the same content script scope,
+ * and calls ready() once the mappings are installed. The text typed in the text fields
+ * while the compositor is loading is recorded, so that the compositor transliterates it when it is ready.
+ *
+ * The language state of the element targeted by the context menu is pushed to the background script
+ * when the context menu is requested and when it is changed, so that the menu is right when it opens.
+ */
+var kcBootstrap = {
+    textFieldSelector: 'textarea[lang], input[type="text"][lang], [contentEditable="true"][lang]',
+    loaded: null,       // Promise resolved with the message handler of the compositor
+    resolve: null,      // Function resolving the loaded promise
+    loadStart: null,    // Time at which the compositor was requested
+    observer: null,     // Mutation observer looking for text fields until the compositor is loaded
+    runs: new Map(),    // Start of the text typed while the compositor is loading, indexed by the text fields
+
+    /*!
+     * \brief Load the compositor
+     *
+     * This function asks the background script to inject the compositor in the frame.
+     * The compositor is only loaded once.
+     *
+     * \return A promise resolved with the message handler of the compositor when it is ready.
+     */
+    load: function() {
+        if (!this.loaded) {
+            if (this.observer)
+                this.observer.disconnect();
+            document.addEventListener('beforeinput', this, true);
+            this.loadStart = performance.now();
+            this.loaded = new Promise((resolve) => {this.resolve = resolve;});
+            browser.runtime.sendMessage({command: "LOAD_COMPOSITOR"})
+                .catch((error) => {console.error(error);});
+        }
+        return this.loaded;
+    },
+
+    /*!
+     * \brief Watch for text fields
+     *
+     * This function loads the compositor as soon as a text field with a \c lang attribute
+     * is inserted in the page, or an element becomes such a text field.
+     */
+    observe: function() {
+        this.observer = new MutationObserver((mutationRecords) => {
+            for (const record of mutationRecords) {
+                if (record.type == 'attributes') {
+                    if (record.target.matches(this.textFieldSelector))
+                        return this.load();
+                    continue;
+                }
+                for (const node of record.addedNodes) {
+                    if ((node.nodeType == Node.ELEMENT_NODE)
+                     && (node.matches(this.textFieldSelector) || node.querySelector(this.textFieldSelector)))
+                        return this.load();
+                }
+            }
+        });
+        this.observer.observe(document.documentElement, {
+            subtree: true,
+            childList: true,
+            attributes: true,
+            attributeFilter: ['lang', 'type', 'contenteditable'],
+        });
+    },
+
+    /*!
+     * \brief Compositor ready callback
+     *
+     * This function is called by the compositor once it is installed.
+     *
+     * \param handleMessage The function handling the \c SET_LANG, \c REMOVE_LANG, \c TRANSLITERATE and \c SET_PERF commands
+     * (which takes the message and the target element).
+     * \return The start of the text typed while the compositor was loading (as \c start and \c node properties),
+     * indexed by the text fields.
+     */
+    ready: function(handleMessage) {
+        document.removeEventListener('beforeinput', this, true);
+        var runs = this.runs;
+        this.runs = new Map();
+        this.resolve(handleMessage);
+        return runs;
+    },
+
+    /*!
+     * \brief Get the editing host of an element
+     *
+     * \param element An element.
+     * \return The element, or its ancestor whose \c contentEditable attribute is set.
+     */
+    getEditingHost: function(element) {
+        while (element && element.isContentEditable && (element.contentEditable != 'true'))
+            element = element.parentElement;
+        return element;
+    },
+
+    /*!
+     * \brief Push the language state of an element
+     *
+     * This function sends the \c lang and \c kc-lang attributes of the element to the background script.
+     *
+     * \param element An element.
+     * \param target Whether the element is targeted by the context menu which is opening.
+     */
+    pushState: function(element, target) {
+        browser.runtime.sendMessage({
+            command: "LANG_STATE",
+            state: [element.getAttribute('lang'), element.getAttribute('kc-lang')],
+            target: target,
+        }).catch((error) => {console.error(error);});
+    },
+
+    /*!
+     * \brief Record the start of the text typed in a text field while the compositor is loading
+     *
+     * \param e The \c beforeinput event.
+     */
+    record: function(e) {
+        var element = this.getEditingHost(e.target);
+        if (!e.isTrusted || !element || !element.matches(this.textFieldSelector))
+            return;
+        if (!e.inputType.startsWith('insert')) {
+            this.runs.delete(element);
+        } else if (!this.runs.has(element)) {
+            if (element.isContentEditable) {
+                var selection = window.getSelection();
+                if (selection.rangeCount != 1)
+                    return;
+                var range = selection.getRangeAt(0);
+                if (range.startContainer != range.endContainer)
+                    return;
+                this.runs.set(element, {start: range.startOffset, node: range.startContainer});
+            } else {
+                this.runs.set(element, {start: element.selectionStart, node: undefined});
+            }
+        }
+    },
+
+    /*!
+     * \brief Event handler
+     *
+     * This function records the text typed while the compositor is loading (see record())
+     * and pushes the language state of editable elements targeted by the context menu.
+     * \param e The event to handle.
+     */
+    handleEvent: function(e) {
+        if (e.target.nodeType != Node.ELEMENT_NODE)
+            return;
+        if (e.type == 'contextmenu') {
+            var element = this.getEditingHost(e.target);
+            if (!element)
+                return;
+            if (element.isContentEditable || (element.tagName == 'TEXTAREA') || (element.tagName == 'INPUT'))
+                this.pushState(element, true);
+        } else if (e.type == 'beforeinput') {
+            this.record(e);
+        }
+    },
+
+    /*!
+     * \brief Message handler
+     *
+     * This function answers the \c GET_LANG command, which only reads attributes,
+     * and forwards the other commands to the compositor, which is loaded if needed
+     * (except for \c SET_PERF, which is dropped when the compositor is not loaded).
+     * The messages are handled in order, even while the compositor is loading.
+     *
+     * \param message The message to handle.
+     * \return A promise resolved with the answer.
+     */
+    onMessage: function(message) {
+        if (message.command == "SET_PERF") {
+            if (this.loaded)
+                return this.loaded.then((handleMessage) => {handleMessage(message, null);});
+            return;
+        }
+
+        var element = this.getEditingHost(message.elementId ? browser.menus.getTargetElement(message.elementId) : document.activeElement);
+        if (!element)
+            return;
+
+        if (message.command == "GET_LANG") {
+            var getLang = () => [
+                element.getAttribute('lang'),
+                element.getAttribute('kc-lang'),
+            ];
+            return this.loaded ? this.loaded.then(getLang) : Promise.resolve(getLang());
+        } else if ((message.command == "SET_LANG") || (message.command == "REMOVE_LANG")) {
+            return this.load().then((handleMessage) => {
+                handleMessage(message, element);
+                this.pushState(element, false);
+            });
+        } else if (message.command == "TRANSLITERATE") {
+            return this.load().then((handleMessage) => {handleMessage(message, element);});
+        }
+    },
+};
+
+browser.runtime.onMessage.addListener((message) => kcBootstrap.onMessage(message));
+document.addEventListener('contextmenu', kcBootstrap, true);
+
+if (document.querySelector(kcBootstrap.textFieldSelector))
+    kcBootstrap.load();
+else
+    kcBootstrap.observe();
@@ -19,82 +19,414 @@
 (function() {
     'use strict'
 
-    var mappings = {}; // Mapping cache
+    var mappings = {}; // Compiled mappings, indexed by their code
+    var loadingMappings = new Map(); // Mappings being fetched from the background script, indexed by their code
+    var fields = new WeakMap(); // Installed elements with their mapping code, editor adapter and listened event types
+    var textFieldSelector = kcBootstrap.textFieldSelector;
+
+    var depths = new WeakMap(); // Length of the longest key of the compiled mappings
+    var ownNodes = new WeakSet(); // Nodes inserted by the extension (language icons)
+    var profiles = new WeakMap(); // Event profiles of the installed elements which override the site profile
+    var siteProfile = 'full'; // Event profile of the site (see keyMapper.onKeyUp())
+
+    /*!
+     * \brief Performance recorder
+     *
+     * This object records the duration of compositions, scans and icon placements
+     * (as \c performance.measure() entries, which are also shown by the profiler) and counters
+     * (dispatched events, scanned nodes, compositions waiting for the mappings).
+     * The records are sent to the background script in batches, where they are aggregated.
+     *
+     * Recording is disabled by default and is toggled by the \c SET_PERF command.
+     * When it is disabled, each probe costs a single test.
+     */
+    var perf = {
+        enabled: false,     // Whether recording is enabled
+        durations: {},      // Recorded durations, indexed by their name
+        counters: {},       // Recorded counters, indexed by their name
+        scheduled: false,   // Whether sending the records is scheduled
 
-    var keyMapper = {
         /*!
-         * \brief Wraps the event target
+         * \brief Start a measure
          *
-         * This function adds a shim to ensure all the required event target properties are available.
-         * The required event target properties are:
-         * \li \c value
-         * \li \c selectionStart
-         * \li \c selectionEnd
+         * \return The start time of the measure, or \c null if recording is disabled.
+         */
+        start: function() {
+            return this.enabled ? performance.now() : null;
+        },
+
+        /*!
+         * \brief End a measure
          *
-         * \param e The event to handle.
+         * \param name The name of the measure.
+         * \param start The start time returned by start().
          */
-        wrapEventTarget: function(e) {
-            if (e.target.selectionStart === undefined)
-                Object.defineProperty(e.target, 'selectionStart', {
-                    get: () => {
-                        var selection = window.getSelection();
-                        if (selection.rangeCount == 1) {
-                            var range = selection.getRangeAt(0);
-                            if (range.startContainer == range.endContainer)
-                                return range.startOffset;
-                        }
-                        return undefined;
-                    },
-                    set: (start) => {
-                        var selection = window.getSelection();
-                        if (selection.rangeCount == 1) {
-                            var range = selection.getRangeAt(0);
-                            if (range.startContainer == range.endContainer)
-                                selection.collapse(range.commonAncestorContainer, start);
-                        }
-                    },
-                });
-            if (e.target.selectionEnd === undefined)
-                Object.defineProperty(e.target, 'selectionEnd', {
-                    get: () => {
-                        var selection = window.getSelection();
-                        if (selection.rangeCount == 1) {
-                            var range = selection.getRangeAt(0);
-                            if (range.startContainer == range.endContainer)
-                                return range.endOffset;
-                        }
-                        return undefined;
-                    },
-                    set: (end) => {
-                        var selection = window.getSelection();
-                        if (selection.rangeCount == 1) {
-                            var range = selection.getRangeAt(0);
-                            if (range.startContainer == range.endContainer)
-                                selection.collapse(range.commonAncestorContainer, end);
-                        }
-                    },
-                });
-            if (e.target.value === undefined)
-                Object.defineProperty(e.target, 'value', {
-                    get: () => {
-                        var selection = window.getSelection();
-                        if (selection.rangeCount == 1) {
-                            var range = selection.getRangeAt(0);
-                            if (range.startContainer == range.endContainer)
-                                return range.commonAncestorContainer.textContent;
-                        }
-                        return undefined;
-                    },
-                    set: (value) => {
-                        var selection = window.getSelection();
-                        if (selection.rangeCount == 1) {
-                            var range = selection.getRangeAt(0);
-                            if (range.startContainer == range.endContainer)
-                                range.commonAncestorContainer.textContent = value;
-                        }
-                    },
+        end: function(name, start) {
+            if (start === null)
+                return;
+            var end = performance.now();
+            performance.measure('kc-' + name, {start: start, end: end});
+            if (!this.durations[name])
+                this.durations[name] = [];
+            this.durations[name].push(end - start);
+            this.schedule();
+        },
+
+        /*!
+         * \brief Increment a counter
+         *
+         * \param name The name of the counter.
+         * \param n The increment.
+         */
+        count: function(name, n) {
+            if (!this.enabled)
+                return;
+            this.counters[name] = (this.counters[name] || 0) + n;
+            this.schedule();
+        },
+
+        /*!
+         * \brief Schedule sending the records to the background script
+         */
+        schedule: function() {
+            if (!this.scheduled) {
+                this.scheduled = true;
+                window.setTimeout(() => this.flush(), 1000);
+            }
+        },
+
+        /*!
+         * \brief Send the records to the background script
+         */
+        flush: function() {
+            browser.runtime.sendMessage({
+                command: "PERF_DATA",
+                durations: this.durations,
+                counters: this.counters,
+            }).catch((error) => {console.error(error);});
+            // Only clear the measures of the extension, not those of the page:
+            for (const name of Object.keys(this.durations))
+                performance.clearMeasures('kc-' + name);
+            this.durations = {};
+            this.counters = {};
+            this.scheduled = false;
+        },
+    };
+
+    /*!
+     * \brief Shard cache
+     *
+     * Large mappings are sharded by the final character of their keys (see \c tools/compile_mappings.py).
+     * The compiled mapping of a sharded mapping is a root node whose children (the shards)
+     * are fetched when a character which ends a key is typed, so that the key mapper
+     * walks it as any other compiled mapping. At most maxResident shards are kept in the frame:
+     * the least recently used ones are dropped after the compositions.
+     */
+    var shards = {
+        maxResident: 128,       // Maximum number of resident shards
+        indexes: new WeakMap(), // Shard indexes, indexed by the root node of the sharded mappings
+        resident: new Map(),    // Resident shards, in least recently used order
+        trimScheduled: false,   // Whether dropping the least recently used shards is scheduled
+
+        /*!
+         * \brief Create a sharded mapping
+         *
+         * \param mapping The mapping, as listed by the background script (with its shards and depth).
+         * \return The root node of the compiled mapping, with no resident shard.
+         */
+        create: function(mapping) {
+            var root = {};
+            this.indexes.set(root, {
+                code: mapping.code,
+                chars: new Set(mapping.shards),
+                loading: new Map(),     // Shards being fetched, indexed by their character
+            });
+            depths.set(root, mapping.depth);
+            return root;
+        },
+
+        /*!
+         * \brief Ensure that shards are resident
+         *
+         * This function fetches the shards of the given characters which are not resident
+         * and then the shards of the characters of their mapped texts, which may be composed again.
+         *
+         * \param mapping The compiled mapping.
+         * \param text The characters which may end a key (the shards are indexed by code points,
+         * so that the shard of a surrogate pair is the one of the whole character).
+         * \param seen The characters whose shards were already requested (used internally).
+         * \return \c null if all the shards are resident, or a promise resolved when they are.
+         */
+        ensure: function(mapping, text, seen) {
+            var index = this.indexes.get(mapping);
+            if (!index)
+                return null;
+            seen = seen || new Set();
+            var missing = [];
+            for (const char of new Set(text)) {
+                if (!index.chars.has(char) || seen.has(char))
+                    continue;
+                seen.add(char);
+                var key = index.code + '\n' + char;
+                if (this.resident.has(key)) {
+                    // Mark the shard as recently used:
+                    this.resident.delete(key);
+                    this.resident.set(key, [mapping, char]);
+                } else {
+                    missing.push(this.fetch(mapping, index, char));
+                }
+            }
+            if (missing.length == 0)
+                return null;
+            return Promise.all(missing).then((nodes) => {
+                var values = [];
+                for (const node of nodes)
+                    this.values(node, values);
+                return this.ensure(mapping, values.join(''), seen);
+            });
+        },
+
+        /*!
+         * \brief Fetch a shard
+         *
+         * \param mapping The root node of the sharded mapping.
+         * \param index The shard index of the mapping.
+         * \param char The character of the shard.
+         * \return A promise resolved with the shard.
+         */
+        fetch: function(mapping, index, char) {
+            var loading = index.loading.get(char);
+            if (loading)
+                return loading;
+            var name = char.codePointAt(0).toString(16).padStart(4, '0');
+            var start = perf.start();
+            loading = fetch(browser.runtime.getURL("mappings/" + index.code + "/" + name + ".json"), {method: "GET"})
+                .then((response) => response.json())
+                .then((node) => {
+                    index.loading.delete(char);
+                    mapping[char] = node;
+                    this.resident.set(index.code + '\n' + char, [mapping, char]);
+                    this.scheduleTrim();
+                    perf.count('shardLoads', 1);
+                    perf.end('shard', start);
+                    return node;
+                }, (error) => {
+                    index.loading.delete(char);
+                    throw error;
                 });
-            return e;
+            index.loading.set(char, loading);
+            return loading;
+        },
+
+        /*!
+         * \brief Collect the mapped texts of a node and its children
+         *
+         * \param node A node of a compiled mapping.
+         * \param values The array where the mapped texts are appended.
+         */
+        values: function(node, values) {
+            var stack = [node];
+            while (stack.length > 0) {
+                node = stack.pop();
+                for (const char in node) {
+                    if (char === '')
+                        values.push(node['']);
+                    else
+                        stack.push(node[char]);
+                }
+            }
+        },
+
+        /*!
+         * \brief Schedule dropping the least recently used shards
+         *
+         * The shards are dropped in a separate task, so that the shards ensured
+         * for a composition stay resident until it is done.
+         */
+        scheduleTrim: function() {
+            if (this.trimScheduled || (this.resident.size <= this.maxResident))
+                return;
+            this.trimScheduled = true;
+            window.setTimeout(() => {
+                this.trimScheduled = false;
+                for (const [key, [mapping, char]] of this.resident) {
+                    if (this.resident.size <= this.maxResident)
+                        break;
+                    this.resident.delete(key);
+                    delete mapping[char];
+                }
+            }, 0);
+        },
+    };
+
+    /*!
+     * \brief Get the character ending at a position
+     *
+     * The compiled mappings are indexed by code points (see \c tools/compile_mappings.py),
+     * while the text of the fields is made of UTF-16 units: a character outside
+     * the basic multilingual plane (e.g. an emoji) is a surrogate pair.
+     *
+     * \param text The text, as a string or an array of characters.
+     * \param pos The position at which the character ends.
+     * \return An array containing the character and its length in the text.
+     */
+    function charBefore(text, pos)
+    {
+        var char = text[pos - 1];
+        if ((pos > 1) && isSurrogate(char, 0xDC00) && isSurrogate(text[pos - 2], 0xD800))
+            return [text[pos - 2] + char, 2];
+        return [char, 1];
+    }
+
+    function isSurrogate(char, base)
+    {
+        if (char.length != 1)
+            return false;
+        var unit = char.charCodeAt(0);
+        return (unit >= base) && (unit < base + 0x400);
+    }
+
+    /*!
+     * \brief Get the position a number of characters before a position
+     *
+     * \param text The text.
+     * \param pos The position.
+     * \param count The number of characters (surrogate pairs count as one character).
+     * \return The position \p count characters before \p pos (or 0).
+     */
+    function charsBefore(text, pos, count)
+    {
+        for (; (count > 0) && (pos > 0); count--)
+            pos -= charBefore(text, pos)[1];
+        return pos;
+    }
+
+    /*!
+     * \brief Editor adapter for text controls
+     *
+     * Text areas and text inputs natively provide the properties used by the key mapper,
+     * so this adapter only forwards to them.
+     * \param element The text control.
+     */
+    function TextControlEditor(element)
+    {
+        this.element = element;
+        this.run = null;    // Start of the text inserted since the last composition
+        this.job = null;    // Pending transliteration job (see transliterator)
+        this.waiting = false;   // Whether an event waits for the mapping (see keyMapper.defer())
+    }
+
+    TextControlEditor.prototype = {
+        update: function() {},
+        get selectionStart() {
+            return this.element.selectionStart;
+        },
+        get selectionEnd() {
+            return this.element.selectionEnd;
+        },
+        get value() {
+            return this.element.value;
+        },
+        setSelection: function(start, end) {
+            this.element.setSelectionRange(start, end);
+        },
+        setRangeText: function(text, start, end) {
+            this.element.setRangeText(text, start, end, 'end');
+        },
+    };
+
+    /*!
+     * \brief Editor adapter for content editable elements
+     *
+     * The selection range is read once when update() is called (i.e. once per event).
+     * The range is live, so that the caret position is kept up to date by the browser.
+     * When the caret is in a text node, the text is edited in place with \c Text.replaceData(),
+     * so that only the edited characters are changed (and not the whole node).
+     * Only the selection within a single node is supported.
+     * \param element The content editable element.
+     */
+    function ContentEditableEditor(element)
+    {
+        this.element = element;
+        this.node = null;
+        this.range = null;
+        this.run = null;    // Start of the text inserted since the last composition
+        this.job = null;    // Pending transliteration job (see transliterator)
+        this.waiting = false;   // Whether an event waits for the mapping (see keyMapper.defer())
+    }
+
+    ContentEditableEditor.prototype = {
+        update: function() {
+            this.node = null;
+            this.range = null;
+
+            var selection = window.getSelection();
+            if (selection.rangeCount != 1)
+                return;
+            var range = selection.getRangeAt(0);
+            if (range.startContainer != range.endContainer)
+                return;
+            this.node = range.startContainer;
+            this.range = range;
+        },
+        get selectionStart() {
+            return this.range ? this.range.startOffset : undefined;
+        },
+        get selectionEnd() {
+            return this.range ? this.range.endOffset : undefined;
+        },
+        get value() {
+            return this.node ? this.node.textContent : undefined;
+        },
+        setSelection: function(start, end) {
+            if (!this.node)
+                return;
+            window.getSelection().setBaseAndExtent(this.node, start, this.node, end);
+            this.range = window.getSelection().getRangeAt(0);
+        },
+        setRangeText: function(text, start, end) {
+            if (!this.node)
+                return;
+            if (this.node.nodeType != Node.TEXT_NODE) {
+                var value = this.node.textContent;
+                this.node.textContent = value.slice(0, start) + text + value.slice(end);
+                this.setSelection(start + text.length, start + text.length);
+                return;
+            }
+            this.node.replaceData(start, end - start, text);
+            // The live range follows deletions, but not insertions at the caret:
+            if (!this.range.collapsed || (this.range.startOffset != start + text.length)) {
+                this.range.setStart(this.node, start + text.length);
+                this.range.collapse(true);
+            }
+        },
+    };
+
+    var keyMapper = {
+        /*!
+         * \brief Get the editor adapter of an element
+         *
+         * This function returns the adapter giving access to the text and the selection
+         * of the given element (see TextControlEditor and ContentEditableEditor).
+         * The adapter of an installed element is created on first use and then cached
+         * with the element, so that no property needs to be defined on the element.
+         *
+         * \param element The element.
+         * \return The editor adapter of the element.
+         */
+        getEditor: function(element) {
+            var field = fields.get(element);
+            if (field && field.editor)
+                return field.editor;
+
+            var editor;
+            if (element.setRangeText === undefined)
+                editor = new ContentEditableEditor(element);
+            else
+                editor = new TextControlEditor(element);
+            if (field)
+                field.editor = editor;
+            return editor;
         },
 
         /*!
@@ -102,16 +434,268 @@
          *
          * This function is the event listener entry point.
          * It filters out event with modifiers set and routes the other events to the handler functions.
+         *
+         * The key mapper listens to keyboard events in the capture phase on the whole document
+         * (see listen()). The first time an installed element receives an event of a given type,
+         * the key mapper registers itself on the element for this type (until it is uninstalled),
+         * so that the event is handled in the target phase, after the event listeners of the page,
+         * as it used to be with per-element listeners. Only installed elements are listened to.
          * \param e The event to handle.
          */
         handleEvent: function(e) {
             // Do nothing if one of these modifiers is pressed:
             if (e.altKey || e.ctrlKey || e.metaKey)
                 return;
+            var field = fields.get(e.target);
+            if (field === undefined)
+                return;
+            // Listen to the target, if it is not already done:
+            if (e.eventPhase == Event.CAPTURING_PHASE) {
+                if (!field.types.has(e.type)) {
+                    field.types.add(e.type);
+                    e.target.addEventListener(e.type, this);
+                }
+                return;
+            }
+            var editor = this.getEditor(e.target);
+            editor.update();
             if (e.type == 'keydown')
-                this.onKeyDown(this.wrapEventTarget(e));
+                this.onKeyDown(e, editor);
             if (e.type == 'keyup')
-                this.onKeyUp(this.wrapEventTarget(e));
+                this.onKeyUp(e, editor);
+            if (e.type == 'beforeinput')
+                this.onBeforeInput(e, editor);
+            if (e.type == 'input')
+                this.onInput(e, editor);
+        },
+
+        /*!
+         * \brief Get the mapping code of an element
+         *
+         * The code is read from the \c kc-lang attribute or, if it is not set, from the \c lang attribute.
+         * It is cached when the element is installed and refreshed when these attributes change
+         * (see install() and installMappings()), so that the attributes are not read on every key.
+         *
+         * \param element An element.
+         * \return The mapping code of the element.
+         */
+        getCode: function(element) {
+            var field = fields.get(element);
+            if (field)
+                return field.code;
+            return element.getAttribute('kc-lang') || element.getAttribute('lang');
+        },
+
+        /*!
+         * \brief Get the mapping of an element
+         *
+         * \param element An installed element.
+         * \return The compiled mapping of the element, or \c undefined if it is not available.
+         */
+        getMapping: function(element) {
+            var mapping = this.getCode(element);
+            if (mappings[mapping] === undefined) {
+                console.error("Mapping \"" + mapping + "\" is not available.");
+                return undefined;
+            }
+            return mappings[mapping];
+        },
+
+        /*!
+         * \brief Before input event handler
+         *
+         * This function records where the text inserted by the user starts,
+         * so that all the text inserted since the last composition can be transliterated at once
+         * (see flushRun()). Deletions reset the run, and any user input cancels
+         * the pending transliteration job of the element.
+         * \param e The event to handle.
+         * \param editor The editor adapter of the event target.
+         */
+        onBeforeInput: function(e, editor) {
+            if (!e.isTrusted)
+                return;
+            if (editor.job)
+                transliterator.cancel(editor);
+            if (!e.inputType.startsWith('insert'))
+                editor.run = null;
+            else if (!editor.run && (editor.selectionStart !== undefined))
+                editor.run = {start: editor.selectionStart, node: editor.node};
+        },
+
+        /*!
+         * \brief Input event handler
+         *
+         * This function transliterates the text inserted by a paste, a drop, an autofill
+         * or the commit of an input method, which are not followed by a key up event.
+         * Typed text is transliterated when the key is released (see onKeyUp()).
+         * \param e The event to handle.
+         * \param editor The editor adapter of the event target.
+         */
+        onInput: function(e, editor) {
+            if (!e.isTrusted || e.isComposing || (e.inputType == 'insertText'))
+                return;
+            if (e.inputType.startsWith('insert') && !this.defer(e, editor))
+                this.flushRun(e, editor);
+        },
+
+        /*!
+         * \brief Defer an event until the mapping of its target is loaded
+         *
+         * The mappings which were not sent with the list of the mappings are fetched
+         * when they are needed (see requireMapping()). Meanwhile, the text typed in the element
+         * is kept in its run (see onBeforeInput()), so that it is transliterated at once
+         * when the first deferred event is handled again.
+         *
+         * \param e The event to handle.
+         * \param editor The editor adapter of the event target.
+         * \return Whether the event is deferred.
+         */
+        defer: function(e, editor) {
+            var loading = requireMapping(this.getCode(e.target));
+            if (!loading)
+                return false;
+            if (!editor.waiting) {
+                editor.waiting = true;
+                perf.count('mappingWaits', 1);
+                loading.then(() => {
+                    editor.waiting = false;
+                    editor.update();
+                    if (e.type == 'keyup')
+                        this.onKeyUp(e, editor);
+                    else
+                        this.onInput(e, editor);
+                }).catch((error) => {console.error(error);});
+            }
+            return true;
+        },
+
+        /*!
+         * \brief Transliterate a text
+         *
+         * This function transliterates the given part of the text in a single left to right pass:
+         * each character is appended to the output and the longest key ending the output is replaced
+         * by its mapped text, until no key matches, as if the characters were typed one by one.
+         * The characters preceding the given part, which may be part of a key, are also transliterated.
+         *
+         * \param mapping The compiled mapping.
+         * \param text The text.
+         * \param start The start of the part to transliterate.
+         * \param end The end of the part to transliterate.
+         * \return An array containing the start of the transliterated part (including the preceding characters)
+         * and the transliterated text.
+         */
+        transliterate: function(mapping, text, start, end) {
+            var from = charsBefore(text, start, this.depth(mapping) - 1);
+            var output = Array.from(text.slice(from, start));
+            for (const char of text.slice(start, end)) {
+                output.push(char);
+                // The number of compositions is bounded, in case the mapping loops:
+                for (var n = 0; n < 64; n++) {
+                    var match = this.match(mapping, output, output.length);
+                    if (!match)
+                        break;
+                    output.splice(output.length - match[0], match[0], ...match[1]);
+                }
+            }
+            return [from, output.join('')];
+        },
+
+        /*!
+         * \brief Get the length of the longest key of a mapping
+         *
+         * \param mapping The compiled mapping.
+         * \return The length of the longest key, in characters (which is cached).
+         */
+        depth: function(mapping) {
+            var depth = depths.get(mapping);
+            if (depth === undefined) {
+                depth = 0;
+                var stack = [[mapping, 0]];
+                while (stack.length > 0) {
+                    var [node, d] = stack.pop();
+                    depth = Math.max(depth, d);
+                    for (const char in node) {
+                        if (char !== '')
+                            stack.push([node[char], d + 1]);
+                    }
+                }
+                depths.set(mapping, depth);
+            }
+            return depth;
+        },
+
+        /*!
+         * \brief Transliterate the inserted run
+         *
+         * This function transliterates the text inserted since the last composition
+         * (e.g. pasted text or keys typed so fast that their key up events overlap)
+         * with a single edit and dispatches a single \c input event.
+         * Long runs are transliterated in chunks when the page is idle (see transliterator).
+         *
+         * \param e The event which ends the run.
+         * \param editor The editor adapter of the event target.
+         * \param single Whether to transliterate runs of a single character.
+         * \return Whether the run was transliterated. Runs of a single character are left
+         * to the key up handler, unless \p single is set.
+         */
+        flushRun: function(e, editor, single) {
+            var run = editor.run;
+            editor.run = null;
+            var end = editor.selectionStart;
+            if (!run || (run.node !== editor.node) || (end === undefined) || (end != editor.selectionEnd)
+             || (charsBefore(editor.value, end, single ? 0 : 1) <= run.start))
+                return false;
+            var mapping = this.getMapping(e.target);
+            if (!mapping)
+                return true;
+            // Transliterate the run again when the shards it needs are fetched:
+            var loading = shards.ensure(mapping, editor.value.slice(run.start, end));
+            if (loading) {
+                editor.run = run;
+                loading.then(() => {
+                    editor.update();
+                    this.flushRun(e, editor, single);
+                }).catch((error) => {console.error(error);});
+                return true;
+            }
+
+            if (end - run.start > transliterator.chunkSize) {
+                transliterator.start(e.target, editor, mapping, run.start, end);
+                return true;
+            }
+            var start = perf.start();
+            var [from, text] = this.transliterate(mapping, editor.value, run.start, end);
+            if (text == editor.value.slice(from, end))
+                return true;
+            editor.setRangeText(text, from, end);
+            e.target.dispatchEvent(new InputEvent('input', {
+                data: text,
+                inputType: "insertReplacementText",
+                view: e.view,
+                bubbles: true,
+                cancelable: true,
+            }));
+            perf.count('events', 1);
+            perf.end('batch', start);
+            return true;
+        },
+
+        /*!
+         * \brief Transliterate the text typed before the key mapper was installed
+         *
+         * \param element An installed element.
+         * \param run The start of the text typed in the element (see \c kcBootstrap.record()).
+         */
+        catchUp: function(element, run) {
+            var loading = requireMapping(this.getCode(element));
+            if (loading) {
+                loading.then(() => this.catchUp(element, run)).catch((error) => {console.error(error);});
+                return;
+            }
+            var editor = this.getEditor(element);
+            editor.update();
+            editor.run = run;
+            this.flushRun({target: element, view: window}, editor, true);
         },
 
         /*!
@@ -120,18 +704,56 @@
          * This function shoud be called whenever a key is pressed.
          * It unfocuses and focuses the element when the \c Enter key is pressed.
          * This is required for some websites to work.
+         * For sharded mappings, it also fetches the shard of the typed character.
          * \param e The event to handle.
+         * \param editor The editor adapter of the event target.
          */
-        onKeyDown: function(e) {
+        onKeyDown: function(e, editor) {
+            // Fetch the shard of the typed character before the key is released:
+            var mapping = mappings[this.getCode(e.target)];
+            if (mapping && (Array.from(e.key).length == 1)) {
+                var loading = shards.ensure(mapping, e.key);
+                if (loading)
+                    loading.catch((error) => {console.error(error);});
+            }
             if (e.key != 'Enter')
                 return;
 
-            var posStart = e.target.selectionStart;
-            var posEnd = e.target.selectionEnd;
+            var posStart = editor.selectionStart;
+            var posEnd = editor.selectionEnd;
             e.target.blur();
             e.target.focus();
-            e.target.selectionStart = posStart;
-            e.target.selectionEnd = posEnd;
+            if ((posStart !== undefined) && (posEnd !== undefined))
+                editor.setSelection(posStart, posEnd);
+        },
+
+        /*!
+         * \brief Find the longest key ending at the given position
+         *
+         * This function walks the compiled mapping (a reverse suffix trie,
+         * see \c tools/compile_mappings.py) backwards from the given position, one character
+         * (i.e. one code point, see charBefore()) at a time, and remembers the deepest node holding a mapped text.
+         * No substring is allocated and the walk stops as soon as
+         * the text cannot match a longer key.
+         *
+         * \param mapping The compiled mapping.
+         * \param text The text in which to search the key (a string or an array of characters).
+         * \param pos The position at which the key should end.
+         * \return An array containing the key length (in the units of the text) and the mapped text,
+         * or \c undefined if no key ends at the given position.
+         */
+        match: function(mapping, text, pos) {
+            var match;
+            var node = mapping;
+            for (var l = 0; l < pos;) {
+                var [char, length] = charBefore(text, pos - l);
+                if (!(node = node[char]))
+                    break;
+                l += length;
+                if (node[''] !== undefined)
+                    match = [l, node['']];
+            }
+            return match;
         },
 
         /*!
@@ -139,41 +761,65 @@
          *
          * This function shoud be called whenever a key is released.
          * It applies the mappings. This is thus the core of the extension.
+         * Each synthetic key stroke edits the text in place with a single
+         * \c setRangeText() call, so that the cost of a composition only
+         * depends on its length and not on the length of the text.
+         *
+         * The events dispatched for a composition depend on the event profile
+         * of the element (its \c kc-profile attribute) or of the site:
+         * \li \c full emulates the key strokes: \c keydown, \c input and \c keyup for each deleted character
+         * and \c keydown, \c keypress, \c input and \c keyup for each inserted character.
+         * \li \c input edits the text at once and dispatches a single \c input event (see composeAtOnce()).
+         * \li \c beforeinput also dispatches a \c beforeinput event before the edit, which may cancel it.
          * \param e The event to handle.
+         * \param editor The editor adapter of the event target.
          */
-        onKeyUp: function(e) {
+        onKeyUp: function(e, editor) {
+            // Wait for the mapping:
+            if (this.defer(e, editor))
+                return;
+            // Transliterate at once the keys typed since the last composition:
+            if (e.isTrusted && this.flushRun(e, editor))
+                return;
             // Get mapping:
-            var mapping = e.target.getAttribute('kc-lang');
+            var mapping = this.getMapping(e.target);
+            // Do nothing if mapping is not available:
             if (!mapping)
-                mapping = e.target.getAttribute('lang');
-            // Do nothing if mapping is not loaded:
-            if (mappings[mapping] === undefined) {
-                console.error("Mapping \"" + mapping + "\" is not loading.");
                 return;
-            } else if (mappings[mapping] === null) {
-                console.warn("Mapping \"" + mapping + "\" is not loaded.");
-                return;
-            } else {
-                mapping = mappings[mapping];
-            }
             // Check that nothing is selected:
-            var posStart = e.target.selectionStart;
-            var posEnd = e.target.selectionEnd;
+            var posStart = editor.selectionStart;
+            var posEnd = editor.selectionEnd;
             if ((posStart === undefined) || (posEnd === undefined) || (posStart != posEnd))
                 return;
-            // Apply mapping:
-            var t = e.target.value;
-            for (var l = 3; l > 0; l--) {
-                if ((l <= t.length) && (mapping[t.slice(posStart - l, posStart)] !== undefined))
-                    break;
+            // Compose again when the shards of the typed character are fetched:
+            var t = editor.value;
+            var loading = shards.ensure(mapping, (posStart > 0) ? charBefore(t, posStart)[0] : '');
+            if (loading) {
+                loading.then(() => {
+                    editor.update();
+                    this.onKeyUp(e, editor);
+                }).catch((error) => {console.error(error);});
+                return;
             }
+            // Apply mapping:
+            var match = this.match(mapping, t, posStart);
             // Do nothing if this is not a letter in the mapping:
-            if (l == 0)
+            if (!match)
                 return;
             // Get mapped text
-            var keys = mapping[t.slice(posStart - l, posStart)];
-            // Delete original text:
-            for (var c = 1; c <= l; c++) {
+            var l = match[0];
+            var keys = match[1];
+            var start = perf.start();
+            var profile = profiles.get(e.target) || siteProfile;
+            if ((profile == 'input') || (profile == 'beforeinput')) {
+                this.composeAtOnce(e, editor, mapping, t, posStart, profile == 'beforeinput');
+                perf.end('composition', start);
+                return;
+            }
+            // Delete original text (one character at a time):
+            var deleted = Array.from(t.slice(posStart - l, posStart));
+            var pos = posStart;
+            for (var c = deleted.length - 1; c >= 0; c--) {
                 var backspaceKeyEventInit = {
                     key: "Backspace",
                     code: "Backspace",
@@ -189,16 +835,16 @@
                 };
 
                 e.target.dispatchEvent(new KeyboardEvent('keydown', backspaceKeyEventInit));
-                e.target.value = t.slice(0, posStart - c) + t.slice(posStart);
+                pos -= deleted[c].length;
+                editor.setRangeText('', pos, pos + deleted[c].length);
                 e.target.dispatchEvent(new InputEvent('input', backspaceInputEventInit));
-                e.target.selectionStart = posStart - c;
-                e.target.selectionEnd = posEnd - c;
                 e.target.dispatchEvent(new KeyboardEvent('keyup', backspaceKeyEventInit));
             }
             // Add mapped text:
-            for (var c = 1; c <= keys.length; c++) {
+            var inserted = Array.from(keys);
+            for (var c = 0; c < inserted.length; c++) {
                 var keyEventInit = {
-                    key: keys[c - 1],
+                    key: inserted[c],
                     code: e.code,
                     shiftKey: e.shiftKey,
                     view: e.view,
@@ -206,7 +852,7 @@
                     cancelable: true,
                 };
                 var inputEventInit = {
-                    data: keys[c - 1],
+                    data: inserted[c],
                     inputType: "insertText",
                     view: e.view,
                     bubbles: true,
@@ -214,147 +860,585 @@
                 };
 
                 e.target.dispatchEvent(new KeyboardEvent('keydown', keyEventInit));
-                e.target.value = t.slice(0, posStart - l) + keys.slice(0, c) + t.slice(posStart);
+                editor.setRangeText(inserted[c], pos, pos);
+                pos += inserted[c].length;
                 e.target.dispatchEvent(new KeyboardEvent('keypress', keyEventInit));
                 e.target.dispatchEvent(new InputEvent('input', inputEventInit));
-                e.target.selectionStart = posStart - l + c;
-                e.target.selectionEnd = posEnd - l + c;
                 e.target.dispatchEvent(new KeyboardEvent('keyup', keyEventInit));
             }
+            perf.count('events', 3 * deleted.length + 4 * inserted.length);
+            perf.end('composition', start);
         },
 
         /*!
-        * \brief Install key mapper on given element
+         * \brief Compose with a single edit
+         *
+         * This function replaces the key ending at the caret by its mapped text
+         * and composes again until no key matches (as the nested key up events do
+         * in the full profile), then applies the result as a single edit.
+         *
+         * \param e The event to handle.
+         * \param editor The editor adapter of the event target.
+         * \param mapping The compiled mapping.
+         * \param text The text of the element.
+         * \param pos The position of the caret.
+         * \param cancelable Whether to dispatch a \c beforeinput event, which can cancel the edit.
+         */
+        composeAtOnce: function(e, editor, mapping, text, pos, cancelable) {
+            var from = charsBefore(text, pos, this.depth(mapping));
+            var output = Array.from(text.slice(from, pos));
+            // The number of compositions is bounded, in case the mapping loops:
+            for (var n = 0; n < 64; n++) {
+                var match = this.match(mapping, output, output.length);
+                if (!match)
+                    break;
+                output.splice(output.length - match[0], match[0], ...match[1]);
+            }
+            // Only replace the characters which changed:
+            while ((from < pos) && (output.length > 0) && text.startsWith(output[0], from)) {
+                from += output.shift().length;
+            }
+            var inputEventInit = {
+                data: output.join(''),
+                inputType: "insertReplacementText",
+                view: e.view,
+                bubbles: true,
+                cancelable: true,
+            };
+
+            if (cancelable) {
+                perf.count('events', 1);
+                if (!e.target.dispatchEvent(new InputEvent('beforeinput', inputEventInit)))
+                    return;
+            }
+            editor.setRangeText(inputEventInit.data, from, pos);
+            e.target.dispatchEvent(new InputEvent('input', inputEventInit));
+            perf.count('events', 1);
+        },
+
+        /*!
+        * \brief Listen to keyboard events
         *
-        * This function install the key mapper event listeners on the given element.
+        * This function installs the key mapper event listeners on the given document.
         * The extension will then listen to \c keyup events and remap typed keys when needed.
-        * It will also listen to \c keydown events, as this is needed for Duolingo to work weel
+        * It will also listen to \c keydown events, as this is needed for Duolingo to work weel,
+        * and to \c beforeinput and \c input events, to transliterate pasted text.
+        *
+        * \param doc The document on which to listen.
+        */
+        listen: function(doc) {
+            doc.addEventListener('keydown', this, true);
+            doc.addEventListener('keyup', this, true);
+            doc.addEventListener('beforeinput', this, true);
+            doc.addEventListener('input', this, true);
+        },
+
+        /*!
+        * \brief Install key mapper on given element
+        *
+        * This function enables the key mapper on the given element.
+        * The mapping is resolved from the \c kc-lang attribute or, if it is not set,
+        * from the \c lang attribute (see getCode()), and the event profile is cached
+        * (from the \c kc-profile attribute) until the element is installed again.
+        * Installing an element several times is harmless: it refreshes the cached values.
         *
         * \param element The element on which to install the extension.
         */
         install: function(element) {
-            console.log("Installing on:", element);
+            var field = fields.get(element);
+            if (field === undefined) {
+                console.log("Installing on:", element);
+                field = {code: null, editor: null, types: new Set()};
+                fields.set(element, field);
+            }
+            field.code = element.getAttribute('kc-lang') || element.getAttribute('lang');
 
-            element.addEventListener('keydown', this);
-            element.addEventListener('keyup', this, true);
+            // Fetch the mapping before the first key is typed:
+            var loading = requireMapping(field.code);
+            if (loading)
+                loading.catch((error) => {console.error(error);});
+            if (element.hasAttribute('kc-profile'))
+                profiles.set(element, element.getAttribute('kc-profile'));
+            else
+                profiles.delete(element);
         },
 
         /*!
         * \brief Unnstall key mapper on given element
         *
-        * This function uninstall the key mapper event listeners on the given element.
+        * This function disables the key mapper on the given element.
         *
         * \param element The element on which to uninstall the extension.
         */
         uninstall: function(element) {
+            var field = fields.get(element);
+            if (field === undefined)
+                return;
+
             console.log("Uninstalling on:", element);
+            for (const type of field.types)
+                element.removeEventListener(type, this);
+            fields.delete(element);
+        },
+    };
+
+    var transliterator = {
+        chunkSize: 4096,    // Number of characters transliterated at once
+
+        /*!
+         * \brief Transliterate a field
+         *
+         * This function transliterates the selected text of the field or,
+         * if nothing is selected, the whole field (see start()).
+         *
+         * \param element An installed element.
+         */
+        transliterateElement: function(element) {
+            var mapping = keyMapper.getMapping(element);
+            if (!mapping)
+                return;
+            var editor = keyMapper.getEditor(element);
+            editor.update();
 
-            element.removeEventListener('keydown', this);
-            element.removeEventListener('keyup', this, true);
+            var segments = [];
+            if (editor instanceof TextControlEditor) {
+                var value = editor.value;
+                var start = editor.selectionStart;
+                var end = editor.selectionEnd;
+                if (start == end) {
+                    start = 0;
+                    end = value.length;
+                }
+                segments.push(this.textControlSegment(element, value, start, end));
+            } else if (editor.range && !editor.range.collapsed && (editor.node.nodeType == Node.TEXT_NODE)) {
+                segments.push(this.textNodeSegment(editor.node, editor.selectionStart, editor.selectionEnd));
+            } else {
+                var walker = document.createTreeWalker(element, NodeFilter.SHOW_TEXT);
+                while (walker.nextNode())
+                    segments.push(this.textNodeSegment(walker.currentNode, 0, walker.currentNode.length));
+            }
+            this.run(element, editor, mapping, segments);
+        },
+
+        /*!
+         * \brief Start a transliteration job
+         *
+         * This function transliterates the given part of the text of a text control
+         * in chunks (see run()).
+         *
+         * \param element The element.
+         * \param editor The editor adapter of the element.
+         * \param mapping The compiled mapping.
+         * \param start The start of the part to transliterate.
+         * \param end The end of the part to transliterate.
+         */
+        start: function(element, editor, mapping, start, end) {
+            if (editor instanceof TextControlEditor)
+                var segment = this.textControlSegment(element, editor.value, start, end);
+            else
+                var segment = this.textNodeSegment(editor.node, start, end);
+            this.run(element, editor, mapping, [segment]);
+        },
+
+        textControlSegment: function(element, text, start, end) {
+            return {
+                text: text,
+                pos: start,
+                end: end,
+                replace: (data, from, to) => {element.setRangeText(data, from, to, 'preserve');},
+            };
+        },
+
+        textNodeSegment: function(node, start, end) {
+            return {
+                text: node.data,
+                pos: start,
+                end: end,
+                replace: (data, from, to) => {node.replaceData(from, to - from, data);},
+            };
+        },
+
+        /*!
+         * \brief Run a transliteration job
+         *
+         * The segments are transliterated in chunks of chunkSize characters in idle callbacks,
+         * as long as the page is idle, so that large fields do not make the page jank.
+         * The text of each segment is read once: the offset between the original text
+         * and the edited text is tracked, as well as the end of the transliterated text,
+         * which may be part of a key spanning two chunks.
+         * The job is cancelled by any user input in the element.
+         * A single \c input event is dispatched when the job is done.
+         *
+         * \param element The element.
+         * \param editor The editor adapter of the element.
+         * \param mapping The compiled mapping.
+         * \param segments The segments to transliterate.
+         */
+        run: function(element, editor, mapping, segments) {
+            if (editor.job)
+                this.cancel(editor);
+            var depth = keyMapper.depth(mapping);
+            for (const segment of segments) {
+                segment.delta = 0;
+                segment.tail = segment.text.slice(charsBefore(segment.text, segment.pos, depth - 1), segment.pos);
+            }
+
+            var job = {
+                segments: segments,
+                handle: null,
+            };
+            var step = (deadline) => {
+                var start = perf.start();
+                var loading = null;
+                while ((job.segments.length > 0) && ((deadline.timeRemaining() > 1) || deadline.didTimeout)) {
+                    var segment = job.segments[0];
+                    var chunkEnd = Math.min(segment.end, segment.pos + this.chunkSize);
+                    // Do not split a surrogate pair:
+                    if ((chunkEnd < segment.end) && isSurrogate(segment.text[chunkEnd - 1], 0xD800))
+                        chunkEnd++;
+                    // Wait for the shards needed by the chunk:
+                    if ((loading = shards.ensure(mapping, segment.text.slice(segment.pos, chunkEnd))))
+                        break;
+                    perf.count('transliteratedChars', chunkEnd - segment.pos);
+                    var chunk = segment.tail + segment.text.slice(segment.pos, chunkEnd);
+                    var [from, text] = keyMapper.transliterate(mapping, chunk, segment.tail.length, chunk.length);
+                    var replaced = chunk.length - from;
+                    if (text != chunk.slice(from))
+                        segment.replace(text, chunkEnd + segment.delta - replaced, chunkEnd + segment.delta);
+                    segment.delta += text.length - replaced;
+                    var tail = chunk.slice(0, from) + text;
+                    segment.tail = tail.slice(charsBefore(tail, tail.length, depth - 1));
+                    segment.pos = chunkEnd;
+                    if (segment.pos >= segment.end)
+                        job.segments.shift();
+                }
+                perf.end('transliteration', start);
+
+                if (loading) {
+                    loading.then(() => {
+                        if (editor.job === job)
+                            job.handle = window.requestIdleCallback(step, {timeout: 1000});
+                    }).catch((error) => {console.error(error);});
+                    return;
+                }
+                if (job.segments.length > 0) {
+                    job.handle = window.requestIdleCallback(step, {timeout: 1000});
+                    return;
+                }
+                editor.job = null;
+                element.dispatchEvent(new InputEvent('input', {
+                    inputType: "insertReplacementText",
+                    bubbles: true,
+                    cancelable: true,
+                }));
+            };
+            editor.job = job;
+            job.handle = window.requestIdleCallback(step, {timeout: 1000});
+        },
+
+        /*!
+         * \brief Cancel the transliteration job of an element
+         *
+         * \param editor The editor adapter of the element.
+         */
+        cancel: function(editor) {
+            window.cancelIdleCallback(editor.job.handle);
+            editor.job = null;
         },
     };
 
-    function addLanguageIcon(element, mapping) {
-        var icon = document.createElement('IMG');
-        icon.setAttribute('src', browser.runtime.getURL('icons/32x32/flags/' + mapping.icon));
-        icon.setAttribute('class', 'kc-flag');
-        icon.setAttribute('alt', mapping.name);
-        icon.setAttribute('title', mapping.name);
-
-        var root = icon;
-        if (getComputedStyle(element).getPropertyValue('display') == 'block') {
-            icon.setAttribute('style', 'vertical-align: top;');
-            root = document.createElement('DIV');
-            root.setAttribute('class', 'kc-div');
-            root.appendChild(icon);
-        }
+    var languageIcons = {
+        pending: new Map(), // Elements waiting for an icon, with their mapping
+        moved: new Set(),   // Elements whose icon should be placed again
+        scheduled: false,   // Whether a placement is scheduled
+        observed: new WeakSet(), // Elements whose size is tracked
+        observer: new ResizeObserver((entries) => {
+            for (const entry of entries) {
+                // Skip the notification sent when the element starts being observed:
+                if (!languageIcons.observed.has(entry.target))
+                    languageIcons.observed.add(entry.target);
+                else if (languageIcons.find(entry.target))
+                    languageIcons.moved.add(entry.target);
+            }
+            if (languageIcons.moved.size > 0)
+                languageIcons.schedule();
+        }),
 
-        removeLanguageIcon(element);
-        if (element.nextSibling)
-            element.parentNode.insertBefore(root, element.nextSibling);
-        else
-            element.parentNode.appendChild(root);
+        /*!
+         * \brief Schedule icon placement
+         *
+         * This function schedules the placement of the pending icons in the next animation frame.
+         */
+        schedule: function() {
+            if (!this.scheduled) {
+                this.scheduled = true;
+                window.requestAnimationFrame(() => this.flush());
+            }
+        },
 
-        var elementRect = element.getBoundingClientRect();
-        var iconRect = icon.getBoundingClientRect();
+        /*!
+         * \brief Find the icon of an element
+         *
+         * \param element An element.
+         * \return The root node of the icon (an \c IMG or a \c DIV containing the \c IMG)
+         * inserted after the element, or \c null if there is none.
+         */
+        find: function(element) {
+            var root = element.nextElementSibling;
+            if (root && (root.tagName == 'IMG') && (root.className == 'kc-flag'))
+                return root;
+            if (root && (root.tagName == 'DIV') && (root.className == 'kc-div'))
+                return root;
+            return null;
+        },
 
-        if (getComputedStyle(element).getPropertyValue('display') == 'block') {
-            icon.setAttribute('style', 'left: ' + (elementRect.right - iconRect.right - 4) + 'px; top: ' + (elementRect.bottom - iconRect.top - 32) + 'px;');
-        } else {
-            icon.setAttribute('style', 'margin-left: ' + (elementRect.right - iconRect.right - 32 - 4) + 'px; margin-bottom: ' + (iconRect.bottom - elementRect.bottom) + 'px;');
-        }
-    }
+        /*!
+         * \brief Check the icon of an element
+         *
+         * \param element An element.
+         * \param mapping A mapping.
+         * \return Whether the flag of the given mapping is shown after the element
+         * and no other icon is waiting to be inserted.
+         */
+        shows: function(element, mapping) {
+            if (this.pending.has(element))
+                return false;
+            var root = this.find(element);
+            var icon = root && ((root.tagName == 'DIV') ? root.firstElementChild : root);
+            return !!icon && (icon.getAttribute('title') == mapping.name);
+        },
 
-    function removeLanguageIcon(element) {
-        var icon = element.nextElementSibling;
-        if (icon && (icon.tagName == 'IMG') && (icon.className == 'kc-flag'))
-            element.parentNode.removeChild(icon);
-        if (icon && (icon.tagName == 'DIV') && (icon.className == 'kc-div'))
-            element.parentNode.removeChild(icon);
-    }
+        /*!
+         * \brief Place icons
+         *
+         * This function inserts the pending icons and places them, as well as the icons
+         * of the elements which were resized. All the layout information is read in a first phase
+         * and all the styles are written in a second phase, so that a single layout is forced
+         * whatever the number of icons.
+         */
+        flush: function() {
+            var start = perf.start();
+            var pending = this.pending;
+            var moved = this.moved;
+            this.pending = new Map();
+            this.moved = new Set();
+            this.scheduled = false;
+
+            // Read element display:
+            var icons = [];
+            for (const [element, mapping] of pending) {
+                if (mapping && element.isConnected)
+                    icons.push({
+                        element: element,
+                        mapping: mapping,
+                        block: getComputedStyle(element).getPropertyValue('display') == 'block',
+                    });
+            }
+
+            // Insert new icons:
+            for (const item of icons) {
+                item.icon = document.createElement('IMG');
+                item.icon.setAttribute('src', browser.runtime.getURL('icons/32x32/flags/' + item.mapping.icon));
+                item.icon.setAttribute('class', 'kc-flag');
+                item.icon.setAttribute('alt', item.mapping.name);
+                item.icon.setAttribute('title', item.mapping.name);
+
+                var root = item.icon;
+                if (item.block) {
+                    item.icon.setAttribute('style', 'vertical-align: top;');
+                    root = document.createElement('DIV');
+                    root.setAttribute('class', 'kc-div');
+                    root.appendChild(item.icon);
+                }
+
+                this.remove(item.element);
+                ownNodes.add(root);
+                if (item.element.nextSibling)
+                    item.element.parentNode.insertBefore(root, item.element.nextSibling);
+                else
+                    item.element.parentNode.appendChild(root);
+                this.observer.observe(item.element);
+            }
+
+            // Reset the icons of resized elements:
+            for (const element of moved) {
+                var root = this.find(element);
+                if (!element.isConnected || pending.has(element) || !root)
+                    continue;
+                var icon = (root.tagName == 'DIV') ? root.firstElementChild : root;
+                if (root.tagName == 'DIV')
+                    icon.setAttribute('style', 'vertical-align: top;');
+                else
+                    icon.removeAttribute('style');
+                icons.push({
+                    element: element,
+                    block: root.tagName == 'DIV',
+                    icon: icon,
+                });
+            }
+
+            // Read positions:
+            for (const item of icons) {
+                item.elementRect = item.element.getBoundingClientRect();
+                item.iconRect = item.icon.getBoundingClientRect();
+            }
+
+            // Write positions:
+            for (const item of icons) {
+                if (item.block) {
+                    item.icon.setAttribute('style', 'left: ' + (item.elementRect.right - item.iconRect.right - 4) + 'px; top: ' + (item.elementRect.bottom - item.iconRect.top - 32) + 'px;');
+                } else {
+                    item.icon.setAttribute('style', 'margin-left: ' + (item.elementRect.right - item.iconRect.right - 32 - 4) + 'px; margin-bottom: ' + (item.iconRect.bottom - item.elementRect.bottom) + 'px;');
+                }
+            }
+            perf.count('placedIcons', icons.length);
+            perf.end('iconPlacement', start);
+        },
+
+        /*!
+         * \brief Remove the icon of an element
+         *
+         * \param element An element.
+         */
+        remove: function(element) {
+            var root = this.find(element);
+            if (root)
+                element.parentNode.removeChild(root);
+        },
+    };
 
     /*!
-     * \brief Searches for text fields
+     * \brief Add a language icon
      *
-     * This function searches for text fields among the descendants of the given element.
-     * It currently matches \c textarea and \c input of type \c text.
+     * This function queues the insertion of the flag of the given mapping after the element.
+     * The icon is inserted and placed in the next animation frame, and placed again
+     * whenever the element is resized.
      *
-     * \param element The element to search for text fields.
-     * \param list The list of available mappings.
+     * \param element The element for which to add an icon.
+     * \param mapping The mapping whose flag should be shown (nothing is shown if it is not available).
      */
-    function searchTextFields(element, list) {
-        // Search for text areas
-        for (const textArea of element.getElementsByTagName('textarea')) {
-            list.forEach((mapping) => {
-                if (textArea.getAttribute('lang') == mapping.code) {
-                    loadMapping(mapping.code);
-                    keyMapper.install(textArea);
-                    addLanguageIcon(textArea, mapping);
-                }
-            });
-        }
-
-        // Search for text inputs
-        for (const input of element.getElementsByTagName('input')) {
-            list.forEach((mapping) => {
-                if ((input.getAttribute('type') == 'text') && (input.getAttribute('lang') == mapping.code)) {
-                    loadMapping(mapping.code);
-                    keyMapper.install(input);
-                    addLanguageIcon(input, mapping);
-                }
-            });
+    function addLanguageIcon(element, mapping) {
+        if (!mapping) {
+            console.error("No mapping for the icon of:", element);
+            return;
         }
+        languageIcons.pending.set(element, mapping);
+        languageIcons.schedule();
+    }
 
-        // Search editable elements
-        for (const editable of element.querySelectorAll('[contentEditable="true"]')) {
-            list.forEach((mapping) => {
-                if (editable.getAttribute('lang') == mapping.code) {
-                    loadMapping(mapping.code);
-                    keyMapper.install(editable);
-                    addLanguageIcon(editable, mapping);
-                }
-            });
-        }
+    /*!
+     * \brief Remove a language icon
+     *
+     * This function removes the flag shown after the element, and cancels pending insertions.
+     *
+     * \param element The element for which to remove the icon.
+     */
+    function removeLanguageIcon(element) {
+        languageIcons.pending.delete(element);
+        languageIcons.moved.delete(element);
+        languageIcons.observer.unobserve(element);
+        languageIcons.observed.delete(element);
+        languageIcons.remove(element);
     }
 
     /*!
-     * \brief Load a mapping
+     * \brief Searches for text fields
      *
-     * This function loads a mapping in the mapping cache, if it is not already loaded.
+     * This function searches for text fields among the given element and its descendants.
+     * It currently matches \c textarea, \c input of type \c text and editable elements
+     * with a \c lang attribute, using a single selector query.
      *
-     * \param name The name of the mapping to load.
+     * \param element The element to search for text fields.
+     * \param codes The available mappings, indexed by their code.
      */
-    function loadMapping(name)
-    {
-        if (mappings[name] === undefined) {
-            mappings[name] = null;
-            fetch(browser.runtime.getURL("mappings/" + name + ".json"), {method: "GET"})
-                .then((response) => response.json())
-                .then((mapping) => {mappings[name] = mapping;})
-                .catch((error) => {console.error(error);});
+    function searchTextFields(element, codes) {
+        var start = perf.start();
+        var textFields = Array.from(element.querySelectorAll(textFieldSelector));
+        if ((element.nodeType == Node.ELEMENT_NODE) && element.matches(textFieldSelector))
+            textFields.unshift(element);
+
+        for (const textField of textFields) {
+            var mapping = codes.get(textField.getAttribute('lang'));
+            if (mapping) {
+                mapping = codes.get(textField.getAttribute('kc-lang')) || mapping;
+                keyMapper.install(textField);
+                // Avoid rewriting the icon when the subtree is scanned again:
+                if (!languageIcons.shows(textField, mapping))
+                    addLanguageIcon(textField, mapping);
+            }
         }
+        perf.count('scannedNodes', 1);
+        perf.count('foundFields', textFields.length);
+        perf.end('scan', start);
     }
 
+    var textFieldScanner = {
+        codes: new Map(),   // Available mappings, indexed by their code
+        pending: new Set(), // Nodes waiting to be scanned
+        scheduled: false,   // Whether a scan is scheduled
+        budget: 4,          // Maximum scanning time per frame (in ms)
+        maxPending: 1000,   // Number of queued nodes above which the whole body is scanned instead
+
+        /*!
+         * \brief Queue a node for scanning
+         *
+         * This function queues the given node, so that it is searched for text fields
+         * in the next animation frame. Mutations are thus coalesced per frame.
+         * When too many nodes are queued, they are replaced by the body,
+         * which is cheaper to scan once than thousands of subtrees.
+         *
+         * \param node The node to scan.
+         */
+        queue: function(node) {
+            if (this.pending.size < this.maxPending)
+                this.pending.add(node);
+            else if (!this.pending.has(document.body))
+                this.pending = new Set([document.body]);
+            if (!this.scheduled) {
+                this.scheduled = true;
+                window.requestAnimationFrame(() => this.flush());
+            }
+        },
+
+        /*!
+         * \brief Scan queued nodes
+         *
+         * This function searches the queued nodes for text fields.
+         * Nodes which are no longer in the document or whose ancestor
+         * is also queued are skipped, so that each subtree is scanned once.
+         * The scan stops when its time budget is exhausted and the remaining
+         * nodes are scanned in the next frame, so that sustained DOM changes
+         * do not make the extension monopolize the frames.
+         */
+        flush: function() {
+            var nodes = this.pending;
+            this.pending = new Set();
+            this.scheduled = false;
+
+            var roots = [];
+            for (const node of nodes) {
+                if (!node.isConnected)
+                    continue;
+                var parent = node.parentNode;
+                while (parent && !nodes.has(parent))
+                    parent = parent.parentNode;
+                if (!parent)
+                    roots.push(node);
+            }
+
+            var start = performance.now();
+            for (var r = 0; r < roots.length; r++) {
+                if ((r > 0) && (performance.now() - start > this.budget)) {
+                    perf.count('deferredScans', roots.length - r);
+                    for (; r < roots.length; r++)
+                        this.queue(roots[r]);
+                    break;
+                }
+                searchTextFields(roots[r], this.codes);
+            }
+        },
+    };
+
     /*!
      * \brief Install mappings
      *
@@ -367,14 +1451,29 @@
     {
         console.log("Installing mappings:", list);
 
+        var codes = new Map(list.map((mapping) => [mapping.code, mapping]));
+        textFieldScanner.codes = codes;
+        keyMapper.listen(document);
+
         // Search for text fields in every new node using a MutationObserver
         var bodyObserver = new MutationObserver(function(mutationRecords) {
             for (const record of mutationRecords) {
+                // Refresh the cached code when the language of a field changes:
+                if (record.type == 'attributes') {
+                    if (fields.has(record.target))
+                        keyMapper.install(record.target);
+                    else
+                        textFieldScanner.queue(record.target);
+                    continue;
+                }
                 record.addedNodes.forEach((node) => {
+                    // Skip the icons inserted by the extension:
+                    if (ownNodes.has(node))
+                        return;
                     if ((node.nodeType == Node.ELEMENT_NODE)
                      || (node.nodeType == Node.DOCUMENT_NODE)
                      || (node.nodeType == Node.DOCUMENT_FRAGMENT_NODE))
-                        searchTextFields(node, list);
+                        textFieldScanner.queue(node);
                 });
             }
         });
@@ -382,45 +1481,171 @@
         bodyObserver.observe(document.body, {
             subtree: true,
             childList: true,
+            attributes: true,
+            attributeFilter: ['lang', 'kc-lang'],
         });
 
         // Search for text fields on body
-        searchTextFields(document.body, list);
+        searchTextFields(document.body, codes);
 
-        browser.runtime.onMessage.addListener((message, sender, sendResponse) => {
-            var element = message.elementId ? browser.menus.getTargetElement(message.elementId) : document.activeElement;
-
-            while (element && element.isContentEditable && (element.contentEditable != 'true'))
-                element = element.parentElement;
-            if (!element)
+        // Handle the commands forwarded by the bootstrap (see kc_bootstrap.js):
+        var runs = kcBootstrap.ready((message, element) => {
+            if (message.command == "SET_PERF") {
+                perf.enabled = message.enabled;
                 return;
+            }
 
             var oldKCLang = element.getAttribute('kc-lang');
 
-            if (message.command == "GET_LANG") {
-                sendResponse([
-                    element.getAttribute('lang'),
-                    oldKCLang,
-                ]);
-            } else if (message.command == "SET_LANG") {
-                loadMapping(message.lang);
-                element.setAttribute('kc-lang', message.lang);
-                addLanguageIcon(element, list.find((e) => (e.code == element.getAttribute('kc-lang'))));
-                if (!oldKCLang && !list.find((e) => (e.code == element.getAttribute('lang'))))
+            if (message.command == "SET_LANG") {
+                if (message.profile !== undefined)
+                    setProfile(element, message.profile, message.site);
+                if (message.lang) {
+                    element.setAttribute('kc-lang', message.lang);
+                    addLanguageIcon(element, codes.get(element.getAttribute('kc-lang')));
                     keyMapper.install(element);
+                } else if (fields.has(element)) {
+                    // Only the profile changed, which is cached when installing:
+                    keyMapper.install(element);
+                }
+            } else if (message.command == "TRANSLITERATE") {
+                transliterator.transliterateElement(element);
             } else if (message.command == "REMOVE_LANG") {
                 removeLanguageIcon(element);
                 element.removeAttribute('kc-lang');
-                if (oldKCLang && !list.find((e) => (e.code == element.getAttribute('lang'))))
+                if (!codes.has(element.getAttribute('lang')))
                     keyMapper.uninstall(element);
-                else if (oldKCLang)
-                    addLanguageIcon(element, list.find((e) => (e.code == element.getAttribute('lang'))));
+                else if (oldKCLang) {
+                    keyMapper.install(element);
+                    addLanguageIcon(element, codes.get(element.getAttribute('lang')));
+                }
             }
         });
+
+        // Transliterate the text typed while the compositor was loading:
+        for (const [element, run] of runs) {
+            if (element.isConnected && fields.has(element))
+                keyMapper.catchUp(element, run);
+        }
+    }
+
+    /*!
+     * \brief Set an event profile
+     *
+     * This function sets the event profile of an element (in its \c kc-profile attribute)
+     * or of the site (in the local storage, so that it applies to all the pages of the site).
+     * See keyMapper.onKeyUp() for the available profiles.
+     *
+     * \param element The element.
+     * \param profile The event profile (\c full, \c input or \c beforeinput),
+     * or \c null to use the default profile.
+     * \param site Whether to set the profile of the site instead of the profile of the element.
+     */
+    function setProfile(element, profile, site)
+    {
+        if (profile && !['full', 'input', 'beforeinput'].includes(profile)) {
+            console.error("Unknown event profile \"" + profile + "\".");
+            return;
+        }
+
+        if (site) {
+            browser.storage.local.get({siteProfiles: {}}).then((data) => {
+                if (profile)
+                    data.siteProfiles[location.hostname] = profile;
+                else
+                    delete data.siteProfiles[location.hostname];
+                return browser.storage.local.set(data);
+            }).catch((error) => {console.error(error);});
+        } else if (profile) {
+            element.setAttribute('kc-profile', profile);
+        } else {
+            element.removeAttribute('kc-profile');
+        }
+    }
+
+    /*!
+     * \brief Load a mapping when it is needed
+     *
+     * Only the mappings of the languages present in the frame when the compositor is loaded
+     * are sent with the list of the mappings: the other mappings are fetched from the background script
+     * by this function, once.
+     *
+     * \param code The code of the mapping.
+     * \return \c null if the mapping is loaded (or is not listed), or a promise resolved when it is loaded.
+     */
+    function requireMapping(code)
+    {
+        if (!code || (mappings[code] !== undefined) || !textFieldScanner.codes.has(code))
+            return null;
+        var loading = loadingMappings.get(code);
+        if (!loading) {
+            loading = updateMapping(code).finally(() => {loadingMappings.delete(code);});
+            loadingMappings.set(code, loading);
+        }
+        return loading;
     }
 
-    fetch(browser.runtime.getURL("mappings/list.json"), {method: "GET"})
-        .then((response) => response.json())
-        .then((list) => {installMappings(list);})
+    /*!
+     * \brief Update a mapping
+     *
+     * This function fetches the mapping from the background script when a user mapping
+     * is compiled or removed (see \c userMappings in \c kc_background.js)
+     * or when it is needed (see requireMapping()).
+     * The new text fields are searched again when a mapping is added.
+     *
+     * \param code The code of the mapping.
+     * \return A promise resolved when the mapping is updated.
+     */
+    function updateMapping(code)
+    {
+        return browser.runtime.sendMessage({command: "GET_MAPPING", code: code}).then((data) => {
+            var codes = textFieldScanner.codes;
+            if (!data) {
+                delete mappings[code];
+                codes.delete(code);
+                return;
+            }
+            var added = !codes.has(code);
+            mappings[code] = data.mapping.shards ? shards.create(data.mapping) : data.trie;
+            codes.set(code, data.mapping);
+            if (added && document.body)
+                textFieldScanner.queue(document.body);
+        }).catch((error) => {console.error(error);});
+    }
+
+    browser.storage.onChanged.addListener((changes, area) => {
+        if (area != 'local')
+            return;
+        // The site profile is shared by all the pages of the site:
+        if (changes.siteProfiles)
+            siteProfile = (changes.siteProfiles.newValue || {})[location.hostname] || 'full';
+        // The user mappings are compiled by the background script:
+        for (const key of Object.keys(changes)) {
+            if (key.startsWith('compiled:'))
+                updateMapping(key.slice('compiled:'.length));
+        }
+    });
+
+    // Mappings are loaded and compiled once by the background script.
+    // Only the mappings of the languages present in the frame are sent with the list:
+    var present = new Set();
+    for (const field of document.querySelectorAll(textFieldSelector))
+        present.add(field.getAttribute('lang'));
+    Promise.all([
+        browser.runtime.sendMessage({command: "GET_MAPPINGS", codes: Array.from(present)}),
+        browser.storage.local.get({siteProfiles: {}}),
+    ])
+        .then(([data, storage]) => {
+            siteProfile = storage.siteProfiles[location.hostname] || 'full';
+            mappings = data.mappings;
+            for (const mapping of data.list) {
+                if (mapping.shards)
+                    mappings[mapping.code] = shards.create(mapping);
+            }
+            perf.enabled = data.perf;
+            installMappings(data.list);
+            // Time elapsed since the bootstrap asked for the compositor:
+            perf.end('load', perf.enabled ? kcBootstrap.loadStart : null);
+        })
         .catch((error) => {console.error(error);});
 })();
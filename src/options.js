@@ -0,0 +1,177 @@
+/* Copyright 2020 Pascal COMBES <pascom@orange.fr>
+ *
+ * This file is part of KeyboardCompositor.
+ *
+ * KeyboardCompositor is free software: you can redistribute it and/or modify
+ * it under the terms of the GNU General Public License as published by
+ * the Free Software Foundation, either version 3 of the License, or
+ * (at your option) any later version.
+ *
+ * KeyboardCompositor is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+ * GNU General Public License for more details.
+ *
+ * You should have received a copy of the GNU General Public License
+ * along with KeyboardCompositor. If not, see <http://www.gnu.org/licenses/>
+ */
+
+/*!
+ * \brief User mapping options
+ *
+ * This page edits the sources of the user mappings, which are stored in the local storage
+ * under \c mapping:<code> keys. They are compiled by the background script,
+ * which stores the compiled mappings (or the compilation errors) under \c compiled:<code> keys
+ * (see \c userMappings in \c kc_background.js).
+ */
+var options = {
+    sources: {},    // Sources of the user mappings, indexed by their code
+
+    /*!
+     * \brief Get an element of the page
+     *
+     * \param id The identifier of the element.
+     * \return The element.
+     */
+    element: function(id) {
+        return document.getElementById(id);
+    },
+
+    /*!
+     * \brief Load the page
+     *
+     * This function fills the mapping lists and listens to the storage changes.
+     */
+    load: function() {
+        browser.runtime.sendMessage({command: "GET_MAPPINGS"}).then((data) => {
+            for (const mapping of data.list)
+                this.element('base').add(new Option(mapping.name + ' (' + mapping.code + ')', mapping.code));
+        }).catch((error) => {console.error(error);});
+
+        browser.storage.local.get(null).then((items) => {
+            for (const [key, value] of Object.entries(items)) {
+                if (key.startsWith('mapping:'))
+                    this.sources[key.slice('mapping:'.length)] = value;
+            }
+            this.list();
+        }).catch((error) => {console.error(error);});
+
+        browser.storage.onChanged.addListener((changes, area) => {
+            if (area == 'local')
+                this.changed(changes);
+        });
+
+        this.element('mappings').addEventListener('change', () => this.show(this.element('mappings').value));
+        this.element('save').addEventListener('click', () => this.save());
+        this.element('delete').addEventListener('click', () => this.remove());
+    },
+
+    /*!
+     * \brief List the user mappings
+     */
+    list: function() {
+        var select = this.element('mappings');
+        var selected = select.value;
+        while (select.options.length > 1)
+            select.remove(1);
+        for (const code of Object.keys(this.sources).sort())
+            select.add(new Option(this.sources[code].name || code, code));
+        select.value = this.sources[selected] ? selected : '';
+    },
+
+    /*!
+     * \brief Show a user mapping
+     *
+     * \param code The code of the mapping (empty for a new mapping).
+     */
+    show: function(code) {
+        var source = this.sources[code] || {};
+        this.element('code').value = code;
+        this.element('name').value = source.name || '';
+        this.element('icon').value = source.icon || '';
+        this.element('base').value = source.base || '';
+        this.element('entries').value = JSON.stringify(source.entries || {}, null, 4);
+        this.element('error').textContent = '';
+        if (code)
+            browser.storage.local.get('compiled:' + code).then((items) => this.showError(code, items['compiled:' + code]));
+    },
+
+    /*!
+     * \brief Show the compilation error of a user mapping
+     *
+     * \param code The code of the mapping.
+     * \param record The compiled mapping.
+     */
+    showError: function(code, record) {
+        if ((this.element('code').value == code) && record)
+            this.element('error').textContent = record.error || '';
+    },
+
+    /*!
+     * \brief Save the user mapping
+     *
+     * The version stamp of the source is updated, so that the mapping is compiled again.
+     */
+    save: function() {
+        var code = this.element('code').value.trim();
+        var entries;
+        try {
+            if (!code)
+                throw new Error("The code of the mapping is required");
+            entries = JSON.parse(this.element('entries').value);
+            if ((typeof entries != 'object') || Array.isArray(entries) || (entries === null))
+                throw new Error("The entries must be an object associating the keys with the mapped texts");
+        } catch (error) {
+            this.element('error').textContent = error.message;
+            return;
+        }
+
+        var source = {
+            name: this.element('name').value.trim(),
+            icon: this.element('icon').value.trim(),
+            base: this.element('base').value,
+            entries: entries,
+            version: Date.now(),
+        };
+        this.element('error').textContent = '';
+        this.sources[code] = source;
+        this.list();
+        this.element('mappings').value = code;
+        browser.storage.local.set({['mapping:' + code]: source}).catch((error) => {console.error(error);});
+    },
+
+    /*!
+     * \brief Delete the user mapping
+     */
+    remove: function() {
+        var code = this.element('code').value.trim();
+        if (this.sources[code])
+            browser.storage.local.remove('mapping:' + code).catch((error) => {console.error(error);});
+        this.show('');
+    },
+
+    /*!
+     * \brief Storage changed callback
+     *
+     * \param changes The changes in the local storage.
+     */
+    changed: function(changes) {
+        var update = false;
+        for (const [key, change] of Object.entries(changes)) {
+            if (key.startsWith('mapping:')) {
+                var code = key.slice('mapping:'.length);
+                if (change.newValue)
+                    this.sources[code] = change.newValue;
+                else
+                    delete this.sources[code];
+                update = true;
+            } else if (key.startsWith('compiled:')) {
+                this.showError(key.slice('compiled:'.length), change.newValue);
+            }
+        }
+        if (update)
+            this.list();
+    },
+};
+
+options.load();
@@ -1,3 +1,8 @@
 from .test import TextAreaTest
 from .test import TextInputTest
 from .test import ContentEditableTest
+from .test_compiler import CompilerTest
+from .test_imagediff import ImageDiffTest
+from .test_compose import ComposeTest
+from .test_compose import TransliterateTest
+from .test_compose import DifferentialTest
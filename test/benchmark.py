@@ -0,0 +1,236 @@
+# Copyright 2020 Pascal COMBES <pascom@orange.fr>
+#
+# This file is part of KeyboardCompositor.
+#
+# KeyboardCompositor is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# KeyboardCompositor is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with KeyboardCompositor. If not, see <http://www.gnu.org/licenses/>
+
+# Keystroke latency and layout benchmarks.
+#
+# Run with: python -m unittest test.benchmark
+#
+# The results are written in testOutput/benchmark.json and compared with
+# benchmark_baseline.json: a benchmark without baseline fails. Set KC_UPDATE_BASELINE=1
+# to record the current results in the baseline. The synthetic event counts
+# of the baseline are those of the reference composer (see tools/kc_compose.py),
+# the other metrics depend on the machine.
+#
+# The layouts forced by the extension are the synchronous reflows recorded
+# by the Gecko profiler in the content processes (the refresh driver reflows
+# are interruptible), which requires access to the chrome context.
+
+from selenium.webdriver.common.by import By
+from .PythonUtils.testdata import TestData
+from .test import BrowserTestCase
+
+import json
+import os
+import statistics
+
+# Installs a recorder on the element (once), which measures for each typed key
+# the time between the trusted keyup and the last synthetic input event,
+# and counts the synthetic events. The recorded compositions are reset.
+RECORDER_SCRIPT = """
+var element = arguments[0];
+if (!window.kcBenchmark || (window.kcBenchmark.element !== element)) {
+    var recorder = {element: element, compositions: [], current: null};
+    var record = (e) => {
+        var now = performance.now();
+        if (e.isTrusted && (e.type == 'keyup')) {
+            recorder.current = {start: now, end: now, events: 0};
+            recorder.compositions.push(recorder.current);
+        } else if (!e.isTrusted && recorder.current) {
+            recorder.current.events++;
+            if (e.type == 'input')
+                recorder.current.end = now;
+        }
+    };
+    for (const type of ['keydown', 'keypress', 'input', 'keyup'])
+        element.addEventListener(type, record);
+    window.kcBenchmark = recorder;
+}
+window.kcBenchmark.compositions = [];
+window.kcBenchmark.current = null;
+"""
+
+# Starts the Gecko profiler (in the chrome context), only recording the markers of the main threads.
+START_PROFILER_SCRIPT = """
+var done = arguments[arguments.length - 1];
+Promise.resolve(Services.profiler.StartProfiler(1 << 22, 1, ['nostacksampling'], ['GeckoMain'])).then(() => done());
+"""
+
+# Stops the Gecko profiler (in the chrome context) and counts the synchronous reflows
+# of the content processes. Tracing markers are recorded as a start and an end.
+COUNT_REFLOWS_SCRIPT = """
+var done = arguments[arguments.length - 1];
+Services.profiler.getProfileDataAsync().then((profile) => {
+    Services.profiler.StopProfiler();
+    var count = 0;
+    for (const process of profile.processes || []) {
+        for (const thread of process.threads) {
+            if ((thread.processType != 'tab') || (thread.name != 'GeckoMain'))
+                continue;
+            var strings = thread.stringTable;
+            var schema = thread.markers.schema;
+            for (const marker of thread.markers.data) {
+                if ((strings[marker[schema.name]] == 'Reflow (sync)') && (marker[schema.phase] != 3))
+                    count++;
+            }
+        }
+    }
+    done(count);
+}, (error) => done(String(error)));
+"""
+
+# Waits for the layout benchmark page to place all the flags and returns its result.
+LAYOUT_SCRIPT = """
+var done = arguments[arguments.length - 1];
+var check = () => {
+    if (window.kcLayoutBenchmark)
+        done(window.kcLayoutBenchmark);
+    else
+        window.requestAnimationFrame(check);
+};
+check();
+"""
+
+# Fills the element with the given text and places the caret at its end.
+# The layout is then flushed, so that it is not counted with the compositions.
+FILL_SCRIPT = """
+var element = arguments[0];
+var text = arguments[1];
+element.focus();
+if (element.isContentEditable) {
+    element.textContent = text;
+    var selection = window.getSelection();
+    if (element.firstChild)
+        selection.collapse(element.firstChild, text.length);
+    else
+        selection.collapse(element, 0);
+} else {
+    element.value = text;
+    element.setSelectionRange(text.length, text.length);
+}
+element.getBoundingClientRect();
+"""
+
+# Results of all the benchmarks, indexed by their name:
+results = {}
+
+class Benchmark(BrowserTestCase):
+    browserArguments = ['-remote-allow-system-access']  # Needed for the chrome context
+    tolerance = 0.5     # Relative time increase considered as a regression
+    slack = 1.0         # Absolute time increase (in ms) always tolerated
+    counts = ['events', 'forcedLayouts']        # Metrics which must not increase
+    timings = ['latency', 'elapsed']            # Metrics compared with the tolerance
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.installAddon(os.path.join(cls.testDir, 'dist', 'kc_test.xpi'))
+
+        cls.testOutput = os.path.join(cls.testDir, 'testOutput')
+        cls.baselinePath = os.path.join(cls.testDir, 'benchmark_baseline.json')
+        try:
+            with open(cls.baselinePath, 'r') as baselineFile:
+                cls.baseline = json.load(baselineFile)
+        except (FileNotFoundError):
+            cls.baseline = {}
+
+    @classmethod
+    def tearDownClass(cls):
+        with open(os.path.join(cls.testOutput, 'benchmark.json'), 'w') as resultFile:
+            json.dump(results, resultFile, indent=4, sort_keys=True)
+        if os.environ.get('KC_UPDATE_BASELINE'):
+            with open(cls.baselinePath, 'w') as baselineFile:
+                json.dump(dict(cls.baseline, **results), baselineFile, indent=4, sort_keys=True)
+        super().tearDownClass()
+
+    def startReflowCount(self):
+        with self.browser.context(self.browser.CONTEXT_CHROME):
+            self.browser.execute_async_script(START_PROFILER_SCRIPT)
+
+    def stopReflowCount(self):
+        with self.browser.context(self.browser.CONTEXT_CHROME):
+            count = self.browser.execute_async_script(COUNT_REFLOWS_SCRIPT)
+        self.assertIsInstance(count, int, f"Could not count the reflows: {count}")
+        return count
+
+    def checkRegression(self, name, result):
+        results[name] = result
+        try:
+            baseline = self.__class__.baseline[name]
+        except (KeyError):
+            if os.environ.get('KC_UPDATE_BASELINE'):
+                return
+            self.fail(f"{name}: no baseline in {self.__class__.baselinePath} (set KC_UPDATE_BASELINE=1 to record it)")
+
+        for metric in self.__class__.counts:
+            if metric in baseline:
+                self.assertLessEqual(result[metric], baseline[metric], f"{name}: more {metric} than the baseline")
+        for metric in self.__class__.timings:
+            if metric in baseline:
+                self.assertLessEqual(result[metric], baseline[metric] * (1 + self.__class__.tolerance) + self.__class__.slack,
+                                     f"{name}: {metric} regression")
+
+class KeystrokeBenchmark(Benchmark):
+    repeat = 10
+
+    def getTextElement(self, elementId, lang):
+        self.browser.get(os.path.join('file://' + self.__class__.testDir, 'test_dynamic.html'))
+        element = self.browser.find_element(By.ID, elementId)
+        self.browser.execute_script(f"kcTest.sendMessage({{command: 'SET_LANG', lang: '{lang}'}}, arguments[0]).then(arguments[arguments.length - 1]);", element)
+        ans = self.browser.execute_async_script("kcTest.sendMessage({command: 'GET_LANG'}, arguments[0]).then(arguments[arguments.length - 1]);", element)
+        self.assertEqual(ans, [None, lang])
+        return element
+
+    def measure(self, element, text, keys):
+        compositions = []
+        forcedLayouts = []
+        for _ in range(0, self.__class__.repeat):
+            # Each repeat types in the same initial text:
+            self.browser.execute_script(FILL_SCRIPT, element, text)
+            self.browser.execute_script(RECORDER_SCRIPT, element)
+            self.startReflowCount()
+            element.send_keys(keys)
+            forcedLayouts.append(self.stopReflowCount() / len(keys))
+            compositions.append(self.browser.execute_script("return window.kcBenchmark.compositions;"))
+
+        # Every typed key should be recorded:
+        for composition in compositions:
+            self.assertEqual(len(composition), len(keys))
+        return {
+            'latency': statistics.median(sum(c['end'] - c['start'] for c in composition) for composition in compositions),
+            'maxLatency': max(max(c['end'] - c['start'] for c in composition) for composition in compositions),
+            'events': statistics.median(sum(c['events'] for c in composition) for composition in compositions),
+            'forcedLayouts': statistics.median(forcedLayouts),
+        }
+
+    @TestData([
+        {'elementId': elementId, 'size': size, 'lang': lang, 'keys': keys}
+        for elementId in ['inlineTextArea', 'inlineTextInput', 'blockEditableDiv']
+        for size in [0, 1024, 64*1024, 1024*1024]
+        for lang, keys in [('ru', 'a'), ('ru', 'ya'), ('ru', 'shch'), ('el', 'pc')]
+    ])
+    def testLatency(self, elementId, size, lang, keys):
+        element = self.getTextElement(elementId, lang)
+        self.checkRegression(f"{elementId}/{size}/{lang}/{keys}", self.measure(element, '.' * size, keys))
+
+class LayoutBenchmark(Benchmark):
+    @TestData([{'count': count} for count in [200, 1000]])
+    def testLayout(self, count):
+        self.startReflowCount()
+        self.browser.get(os.path.join('file://' + self.__class__.testDir, f'test_layout.html?count={count}'))
+        result = self.browser.execute_async_script(LAYOUT_SCRIPT)
+        result['forcedLayouts'] = self.stopReflowCount()
+        self.checkRegression(f"layout/{count}", result)
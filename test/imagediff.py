@@ -0,0 +1,229 @@
+# Copyright 2020 Pascal COMBES <pascom@orange.fr>
+#
+# This file is part of KeyboardCompositor.
+#
+# KeyboardCompositor is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# KeyboardCompositor is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with KeyboardCompositor. If not, see <http://www.gnu.org/licenses/>
+
+# In-process image comparison.
+#
+# Decodes PNG images (as returned by WebDriver screenshots or stored in testInput)
+# in memory and compares them with the structural dissimilarity (DSSIM).
+
+from array import array
+
+import functools
+import math
+import struct
+import zlib
+
+class ImageError(Exception):
+    pass
+
+class Image:
+    """An RGB image, stored as one array of floats per channel."""
+
+    def __init__(self, width, height, channels):
+        self.width = width
+        self.height = height
+        self.channels = channels
+
+    @classmethod
+    def fromPNG(cls, data):
+        """Decode a non-interlaced PNG image.
+
+        All the color types and bit depths are supported.
+        Transparency is ignored and 16 bits samples are reduced to 8 bits.
+
+        :param data: The bytes of the PNG file.
+        :return: The decoded image.
+        """
+        if (data[:8] != b'\x89PNG\r\n\x1a\n'):
+            raise ImageError("Not a PNG image")
+
+        pos = 8
+        header = None
+        palette = None
+        compressed = bytearray()
+        while (pos < len(data)):
+            length, chunkType = struct.unpack('>I4s', data[pos:pos + 8])
+            chunk = data[pos + 8:pos + 8 + length]
+            pos += 12 + length
+            if (chunkType == b'IHDR'):
+                header = struct.unpack('>IIBBBBB', chunk)
+            elif (chunkType == b'PLTE'):
+                palette = chunk
+            elif (chunkType == b'IDAT'):
+                compressed += chunk
+            elif (chunkType == b'IEND'):
+                break
+        if header is None:
+            raise ImageError("Missing PNG header")
+
+        width, height, depth, colorType, _, _, interlace = header
+        if interlace:
+            raise ImageError("Interlaced PNG images are not supported")
+        samples = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}[colorType]
+        bitsPerPixel = samples * depth
+        stride = (width * bitsPerPixel + 7) // 8
+        bpp = max(1, bitsPerPixel // 8)
+        raw = zlib.decompress(bytes(compressed))
+
+        # Unfilter scanlines:
+        rows = []
+        previous = bytearray(stride)
+        for y in range(0, height):
+            filterType = raw[y * (stride + 1)]
+            row = bytearray(raw[y * (stride + 1) + 1:(y + 1) * (stride + 1)])
+            if (filterType == 1):
+                for i in range(bpp, stride):
+                    row[i] = (row[i] + row[i - bpp]) & 0xFF
+            elif (filterType == 2):
+                for i in range(0, stride):
+                    row[i] = (row[i] + previous[i]) & 0xFF
+            elif (filterType == 3):
+                for i in range(0, stride):
+                    left = row[i - bpp] if (i >= bpp) else 0
+                    row[i] = (row[i] + ((left + previous[i]) >> 1)) & 0xFF
+            elif (filterType == 4):
+                for i in range(0, stride):
+                    a = row[i - bpp] if (i >= bpp) else 0
+                    b = previous[i]
+                    c = previous[i - bpp] if (i >= bpp) else 0
+                    p = a + b - c
+                    pa, pb, pc = abs(p - a), abs(p - b), abs(p - c)
+                    predictor = a if (pa <= pb) and (pa <= pc) else (b if (pb <= pc) else c)
+                    row[i] = (row[i] + predictor) & 0xFF
+            elif (filterType != 0):
+                raise ImageError(f"Unknown PNG filter type: {filterType}")
+            rows.append(row)
+            previous = row
+
+        # Convert to RGB:
+        channels = [array('d', bytes(8 * width * height)) for _ in range(0, 3)]
+        maxValue = (1 << min(depth, 8)) - 1
+        for y, row in enumerate(rows):
+            if (depth < 8):
+                mask = (1 << depth) - 1
+                values = [(row[(x * depth) // 8] >> (8 - depth - (x * depth) % 8)) & mask for x in range(0, width)]
+            elif (depth == 16):
+                values = row[::2]
+            else:
+                values = row
+            for x in range(0, width):
+                if (colorType == 3):
+                    index = 3 * values[x]
+                    rgb = palette[index:index + 3]
+                elif colorType in (0, 4):
+                    gray = values[x * samples] * 255 // maxValue
+                    rgb = (gray, gray, gray)
+                else:
+                    rgb = values[x * samples:x * samples + 3]
+                for c in range(0, 3):
+                    channels[c][y * width + x] = rgb[c]
+        return cls(width, height, channels)
+
+    def crop(self, x, y, width, height):
+        """Crop the image.
+
+        :param x: The abscissa of the top left corner of the cropped area.
+        :param y: The ordinate of the top left corner of the cropped area.
+        :param width: The width of the cropped area.
+        :param height: The height of the cropped area.
+        :return: The cropped image.
+        """
+        if (x < 0) or (y < 0) or (x + width > self.width) or (y + height > self.height):
+            raise ImageError(f"Crop area {width}x{height}+{x}+{y} is outside {self.width}x{self.height} image")
+        channels = []
+        for channel in self.channels:
+            cropped = array('d')
+            for r in range(y, y + height):
+                cropped.extend(channel[r * self.width + x:r * self.width + x + width])
+            channels.append(cropped)
+        return Image(width, height, channels)
+
+@functools.lru_cache(maxsize=None)
+def loadImage(path):
+    """Load a PNG file. The decoded images are cached.
+
+    :param path: The path to the PNG file.
+    :return: The decoded image.
+    """
+    with open(path, 'rb') as file:
+        return Image.fromPNG(file.read())
+
+def gaussianKernel(radius=5, sigma=1.5):
+    kernel = [math.exp(-(i * i) / (2 * sigma * sigma)) for i in range(-radius, radius + 1)]
+    total = sum(kernel)
+    return [k / total for k in kernel]
+
+def blur(channel, width, height, kernel):
+    """Blur a channel with a separable kernel, keeping only the pixels where the kernel fits.
+
+    :return: The blurred channel and its size.
+    """
+    size = len(kernel)
+    outWidth = width - size + 1
+    outHeight = height - size + 1
+    horizontal = array('d', bytes(8 * outWidth * height))
+    for y in range(0, height):
+        row = y * width
+        for x in range(0, outWidth):
+            horizontal[y * outWidth + x] = sum(kernel[k] * channel[row + x + k] for k in range(0, size))
+    blurred = array('d', bytes(8 * outWidth * outHeight))
+    for y in range(0, outHeight):
+        for x in range(0, outWidth):
+            blurred[y * outWidth + x] = sum(kernel[k] * horizontal[(y + k) * outWidth + x] for k in range(0, size))
+    return blurred, outWidth, outHeight
+
+def ssim(image1, image2, kernel=gaussianKernel()):
+    """Compute the mean structural similarity (SSIM) of two images.
+
+    The SSIM is computed on each channel with a gaussian window
+    (of radius 5 and standard deviation 1.5) and averaged.
+
+    :param image1: The first image.
+    :param image2: The second image.
+    :return: The mean SSIM of the images (1 when they are identical).
+    """
+    if (image1.width != image2.width) or (image1.height != image2.height):
+        raise ImageError(f"Image sizes differ: {image1.width}x{image1.height} and {image2.width}x{image2.height}")
+    if (image1.width < len(kernel)) or (image1.height < len(kernel)):
+        raise ImageError(f"Images are too small: {image1.width}x{image1.height}")
+
+    c1 = (0.01 * 255) ** 2
+    c2 = (0.03 * 255) ** 2
+    total = 0
+    for x, y in zip(image1.channels, image2.channels):
+        w, h = image1.width, image1.height
+        muX, outWidth, outHeight = blur(x, w, h, kernel)
+        muY, _, _ = blur(y, w, h, kernel)
+        sigmaXX, _, _ = blur(array('d', (v * v for v in x)), w, h, kernel)
+        sigmaYY, _, _ = blur(array('d', (v * v for v in y)), w, h, kernel)
+        sigmaXY, _, _ = blur(array('d', (u * v for u, v in zip(x, y))), w, h, kernel)
+        for i in range(0, outWidth * outHeight):
+            mx, my = muX[i], muY[i]
+            sxx = sigmaXX[i] - mx * mx
+            syy = sigmaYY[i] - my * my
+            sxy = sigmaXY[i] - mx * my
+            total += ((2 * mx * my + c1) * (2 * sxy + c2)) / ((mx * mx + my * my + c1) * (sxx + syy + c2))
+    return total / (len(image1.channels) * outWidth * outHeight)
+
+def dssim(image1, image2):
+    """Compute the structural dissimilarity (DSSIM) of two images.
+
+    :param image1: The first image.
+    :param image2: The second image.
+    :return: The DSSIM of the images, (1 - SSIM) / 2 (0 when they are identical).
+    """
+    return (1 - ssim(image1, image2)) / 2
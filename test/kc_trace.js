@@ -0,0 +1,87 @@
+/* Copyright 2020 Pascal COMBES <pascom@orange.fr>
+ * 
+ * This file is part of KeyboardCompositor.
+ * 
+ * KeyboardCompositor is free software: you can redistribute it and/or modify
+ * it under the terms of the GNU General Public License as published by
+ * the Free Software Foundation, either version 3 of the License, or
+ * (at your option) any later version.
+ * 
+ * KeyboardCompositor is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+ * GNU General Public License for more details.
+ * 
+ * You should have received a copy of the GNU General Public License
+ * along with KeyboardCompositor. If not, see <http://www.gnu.org/licenses/>
+ */
+
+/*!
+ * \brief Event trace recorder
+ *
+ * This object records the events of the test pages in a ring buffer,
+ * keeping only the fields checked by the tests and a timestamp.
+ * The tests fetch the whole trace in one call with take().
+ */
+var kcTrace = {
+    capacity: 65536,            // Maximum number of records
+    records: new Array(65536),  // Ring buffer
+    start: 0,                   // Index of the oldest record
+    length: 0,                  // Number of records
+
+    /*!
+     * \brief Record an event
+     *
+     * \param label The label of the event (e.g. <tt>Event[ru]</tt>).
+     * \param e The event to record.
+     */
+    record: function(label, e) {
+        var record = {
+            label: label,
+            type: e.type,
+            isTrusted: e.isTrusted,
+            timeStamp: performance.now(),
+        };
+        if (e.type.startsWith('key')) {
+            record.key = e.key;
+            record.altKey = e.altKey;
+            record.ctrlKey = e.ctrlKey;
+            record.metaKey = e.metaKey;
+            record.shiftKey = e.shiftKey;
+        } else if ((e.type == 'input') || (e.type == 'beforeinput')) {
+            record.data = e.data;
+            record.inputType = e.inputType;
+        } else {
+            record.target = e.target;
+            record.originalTarget = e.originalTarget;
+            record.explicitOriginalTarget = e.explicitOriginalTarget;
+        }
+
+        this.records[(this.start + this.length) % this.capacity] = record;
+        if (this.length < this.capacity)
+            this.length++;
+        else
+            this.start = (this.start + 1) % this.capacity;
+    },
+
+    /*!
+     * \brief Take the recorded events
+     *
+     * This function returns the recorded events and clears the trace.
+     *
+     * \param prefix If given, only the events whose label starts with this prefix are returned.
+     * \return The list of recorded events, from the oldest to the newest.
+     */
+    take: function(prefix) {
+        var records = [];
+        for (var i = 0; i < this.length; i++) {
+            var record = this.records[(this.start + i) % this.capacity];
+            if (!prefix || record.label.startsWith(prefix))
+                records.push(record);
+        }
+        this.records = new Array(this.capacity);
+        this.start = 0;
+        this.length = 0;
+        return records;
+    },
+};
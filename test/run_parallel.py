@@ -0,0 +1,125 @@
+# Copyright 2020 Pascal COMBES <pascom@orange.fr>
+#
+# This file is part of KeyboardCompositor.
+#
+# KeyboardCompositor is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# KeyboardCompositor is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with KeyboardCompositor. If not, see <http://www.gnu.org/licenses/>
+
+# Parallel test runner.
+#
+# Run with: python -m test.run_parallel [-j JOBS] [TEST_NAME ...]
+#
+# The test classes are run by a pool of worker processes. Each worker process
+# starts its own headless Firefox once and shares it between all the test classes
+# it runs (see BrowserTestCase.sharedBrowser), so that the tests of a class only
+# cost a browser start when the class needs its own browser (e.g. the benchmarks).
+# The largest classes are run first.
+#
+# Known limitation: a test class is never split between workers, and the subtests
+# of a test method (e.g. the data of TestData) are run by the same worker,
+# so that the number of useful workers is bounded by the number of test classes.
+
+import argparse
+import io
+import multiprocessing
+import multiprocessing.util
+import os
+import sys
+import time
+import unittest
+
+def flattenSuite(suite):
+    for test in suite:
+        if isinstance(test, unittest.TestSuite):
+            yield from flattenSuite(test)
+        else:
+            yield test
+
+def initWorker():
+    os.environ['KC_HEADLESS'] = '1'
+    from .test import BrowserTestCase
+    BrowserTestCase.sharedBrowser = BrowserTestCase.startBrowser()
+    # Pool workers do not run atexit handlers, but they run the finalizers with an exit priority:
+    multiprocessing.util.Finalize(None, BrowserTestCase.sharedBrowser.quit, exitpriority=10)
+
+def runClass(testIds):
+    output = io.StringIO()
+    stdout, sys.stdout = sys.stdout, output
+    try:
+        suite = unittest.defaultTestLoader.loadTestsFromNames(testIds)
+        result = unittest.TextTestRunner(stream=output, verbosity=2).run(suite)
+    finally:
+        sys.stdout = stdout
+    return {
+        'testIds': testIds,
+        'testsRun': result.testsRun,
+        'failures': [(str(test), trace) for test, trace in result.failures],
+        'errors': [(str(test), trace) for test, trace in result.errors],
+        'skipped': len(result.skipped),
+        'output': output.getvalue(),
+    }
+
+def splitClasses(testIds):
+    classes = {}
+    for testId in testIds:
+        classes.setdefault(testId.rpartition('.')[0], []).append(testId)
+    return sorted(classes.values(), key=len, reverse=True)
+
+if __name__ == '__main__':
+    argParser = argparse.ArgumentParser(description="Run the browser tests in parallel.")
+    argParser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+                           help="Number of worker processes (defaults to the number of cores)")
+    argParser.add_argument('-v', '--verbose', action='store_true',
+                           help="Print the output of all the test classes")
+    argParser.add_argument('names', nargs='*', default=['test'],
+                           help="Names of the tests to run")
+    args = argParser.parse_args()
+
+    suite = unittest.defaultTestLoader.loadTestsFromNames(args.names)
+    testIds = [test.id() for test in flattenSuite(suite)]
+    classes = splitClasses(testIds)
+    jobs = max(1, min(args.jobs, len(classes)))
+    print(f"Running {len(testIds)} tests of {len(classes)} classes with {jobs} workers")
+
+    start = time.monotonic()
+    testsRun = 0
+    skipped = 0
+    failures = []
+    errors = []
+    with multiprocessing.get_context('spawn').Pool(jobs, initializer=initWorker) as pool:
+        for result in pool.imap_unordered(runClass, classes):
+            testsRun += result['testsRun']
+            skipped += result['skipped']
+            failures += result['failures']
+            errors += result['errors']
+            if args.verbose or result['failures'] or result['errors']:
+                print(result['output'])
+            print(f"[{testsRun}/{len(testIds)}] {result['testIds'][0].rpartition('.')[0]} done")
+        # Let the workers quit their browser:
+        pool.close()
+        pool.join()
+
+    for title, problems in [('ERROR', errors), ('FAIL', failures)]:
+        for test, trace in problems:
+            print('=' * 70)
+            print(f"{title}: {test}")
+            print('-' * 70)
+            print(trace)
+
+    print('-' * 70)
+    print(f"Ran {testsRun} tests in {time.monotonic() - start:.3f}s")
+    print()
+    if failures or errors:
+        print(f"FAILED (failures={len(failures)}, errors={len(errors)}, skipped={skipped})")
+        sys.exit(1)
+    print(f"OK (skipped={skipped})" if skipped else "OK")
@@ -19,39 +19,65 @@ from selenium import webdriver
 from selenium.common import exceptions as selenium
 from selenium.webdriver.common.keys import Keys
 from selenium.webdriver.common.by import By
+from selenium.webdriver.support.wait import WebDriverWait
 from .PythonUtils.testdata import TestData
 from .ConsoleCapture import captureConsole
+from . import imagediff
 
 import os
-import subprocess
 import unittest
 
-class ImageMagick:
-    programs = {
-        'crop':    'convert',
-        'compare': 'compare',
+# Waits until the language icons are placed: they are inserted and placed
+# in an animation frame, so this waits for two animation frames and then
+# for the icon next to the element (if any) to have its placement style.
+FLAG_SCRIPT = """
+var element = arguments[0];
+var done = arguments[arguments.length - 1];
+var frames = 0;
+var check = () => {
+    var root = element.nextElementSibling;
+    var icon = (root && (root.className == 'kc-div')) ? root.firstElementChild : root;
+    var placed = !icon || (icon.className != 'kc-flag') || /left/.test(icon.getAttribute('style') || '');
+    if ((++frames >= 2) && placed)
+        done();
+    else
+        window.requestAnimationFrame(check);
+};
+window.requestAnimationFrame(check);
+"""
+
+# Resets the state of the test page in a single round trip:
+# clears the text fields, removes the languages set by the tests and installs
+# the value recorder used by BaseTest.typeKeys().
+RESET_SCRIPT = """
+var done = arguments[arguments.length - 1];
+for (const field of document.querySelectorAll('textarea, input[type="text"]'))
+    field.value = '';
+for (const field of document.querySelectorAll('[contentEditable="true"]'))
+    field.textContent = '';
+for (const field of document.querySelectorAll('[kc-profile]'))
+    field.removeAttribute('kc-profile');
+var reset = Promise.resolve();
+if (window.kcTest) {
+    for (const field of document.querySelectorAll('[kc-lang]')) {
+        var removeLang = () => kcTest.sendMessage({command: 'REMOVE_LANG'}, field);
+        reset = reset.then(removeLang, removeLang);
     }
-
-    @classmethod
-    def checkImageMagick(cls):
-        for prog in cls.programs.values():
-            imWhich = subprocess.run(['which', prog], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-            if (imWhich.returncode != 0):
-                return False
-        return True
-
-    @classmethod
-    def crop(cls, src, dest, rect):
-        imCrop = subprocess.run([cls.programs['crop'], src, '-crop', f"{rect['width']}x{rect['height']}+{rect['x']}+{rect['y']}", dest])
-        return imCrop.returncode == 0
-
-    @classmethod
-    def compare(cls, src1, src2, dest):
-        imCompare = subprocess.run([cls.programs['compare'], src1, src2, '-metric', 'DSSIM', '-compose', 'clear', dest], stderr=subprocess.PIPE)
-        try:
-            return float(imCompare.stderr)
-        except (ValueError):
-            print(imCompare.stderr)
+}
+if (!window.kcValues) {
+    document.addEventListener('keydown', (e) => {
+        if (e.isTrusted)
+            window.kcValues.push(e.target.isContentEditable ? e.target.textContent : e.target.value);
+    }, true);
+}
+window.kcValues = [];
+var finish = () => {
+    if (document.activeElement)
+        document.activeElement.blur();
+    done();
+};
+reset.then(finish, finish);
+"""
 
 def foreachElement(fun):
     def foreachElementFun(self, *args, **kwArgs):
@@ -70,47 +96,134 @@ def foreachElement(fun):
     return foreachElementFun
 
 class BrowserTestCase(unittest.TestCase):
+    browserArguments = []   # Additional command line arguments of Firefox
+    sharedBrowser = None    # Browser shared by the test classes without browser arguments (see run_parallel.py)
+
+    @classmethod
+    def startBrowser(cls, arguments=[]):
+        options = webdriver.FirefoxOptions()
+        if os.environ.get('KC_HEADLESS'):
+            options.add_argument('-headless')
+        for argument in arguments:
+            options.add_argument(argument)
+        browser = webdriver.Firefox(options=options)
+        captureConsole(browser, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'console_capture.xpi'))
+        browser.kcAddons = set()
+        return browser
+
+    @classmethod
+    def installAddon(cls, path):
+        # The addons are installed once in a shared browser:
+        if path not in cls.browser.kcAddons:
+            cls.browser.kcAddons.add(path)
+            print(cls.browser.install_addon(path, True))
+
     @classmethod
     def setUpClass(cls):
         cls.testDir = os.path.dirname(os.path.abspath(__file__))
         cls.baseDir = os.path.dirname(cls.testDir)
 
-        cls.browser = webdriver.Firefox()
-        captureConsole(cls.browser, os.path.join(cls.testDir, 'console_capture.xpi'))
-        print(cls.browser.install_addon(os.path.join(cls.baseDir, 'dist', 'keyboard_compositor.xpi'), True))
+        if (BrowserTestCase.sharedBrowser is not None) and not cls.browserArguments:
+            cls.browser = BrowserTestCase.sharedBrowser
+        else:
+            cls.browser = cls.startBrowser(cls.browserArguments)
+        cls.installAddon(os.path.join(cls.baseDir, 'dist', 'keyboard_compositor.xpi'))
 
     @classmethod
     def tearDownClass(cls):
-        cls.browser.close()
+        if cls.browser is not BrowserTestCase.sharedBrowser:
+            cls.browser.close()
 
     def setUp(self):
         self.browser = self.__class__.browser
 
+    def loadPage(self, page):
+        url = os.path.join('file://' + self.__class__.testDir, page)
+        if (self.browser.current_url != url):
+            self.browser.get(url)
+        self.resetPage()
+
+    def resetPage(self):
+        self.browser.execute_async_script(RESET_SCRIPT)
+
 class BaseTest(BrowserTestCase):
 
+    def typeKeys(self, element, keysList):
+        element.send_keys(''.join(keysList))
+        values = self.browser.execute_script("""
+            var element = arguments[0];
+            var values = window.kcValues.slice(1);
+            values.push(element.isContentEditable ? element.textContent : element.value);
+            window.kcValues = [];
+            return values;
+        """, element)
+        self.assertEqual(len(values), sum(len(keys) for keys in keysList))
+
+        l = 0
+        chunkValues = []
+        for keys in keysList:
+            l = l + len(keys)
+            chunkValues.append(values[l - 1])
+        return chunkValues
+
+    def clearTextElements(self):
+        self.resetPage()
+
     def assertEvent(self, event, eventType, target):
         self.assertEqual(event['type'], eventType)
         self.assertEqual(event['target'], target)
         self.assertEqual(event['originalTarget'], target)
         self.assertEqual(event['explicitOriginalTarget'], target)
 
-    def assertInputEvent(self, inputEvent, eventType, data):
-        self.assertEqual(inputEvent['type'], eventType)
-        if (data == 'Backspace'):
-            self.assertEqual(inputEvent['inputType'], 'deleteContentBackward')
-        else:
-            self.assertEqual(inputEvent['data'], data)
-            self.assertEqual(inputEvent['inputType'], 'insertText')
-
-    def assertKeyEvent(self, keyEvent, eventType, key, **kwArgs):
-        self.assertEqual(keyEvent['type'], eventType)
-        self.assertEqual(keyEvent['key'], key)
-        self.assertEqual(keyEvent['altKey'], kwArgs['altKey'] if 'altKey' in kwArgs else False)
-        self.assertEqual(keyEvent['ctrlKey'], kwArgs['ctrlKey'] if 'ctrlKey' in kwArgs else False)
-        self.assertEqual(keyEvent['metaKey'], kwArgs['metaKey'] if 'metaKey' in kwArgs else False)
-        self.assertEqual(keyEvent['shiftKey'], kwArgs['shiftKey'] if 'shiftKey' in kwArgs else False)
-        for k, v in kwArgs:
-            self.assertEqual(keyEvent[k], v)
+    def clearTrace(self):
+        self.browser.execute_script("kcTrace.take();")
+
+    def takeTrace(self, prefix='Event'):
+        return self.browser.execute_script("return kcTrace.take(arguments[0]);", prefix)
+
+    def splitTrace(self, trace, keysList):
+        # Split the trace at the trusted keydown events starting each group of keys:
+        starts = [i for i, record in enumerate(trace) if record['isTrusted'] and (record['type'] == 'keydown')]
+        self.assertEqual(len(starts), sum(len(keys) for keys in keysList))
+
+        l = 0
+        traces = []
+        for keys in keysList:
+            end = starts[l + len(keys)] if (l + len(keys) < len(starts)) else len(trace)
+            traces.append(trace[starts[l]:end])
+            l = l + len(keys)
+        return traces
+
+    @staticmethod
+    def normalizeEvent(record):
+        if (record['type'] == 'input'):
+            if (record['inputType'] == 'deleteContentBackward'):
+                return (record['label'], 'input', 'Backspace', ())
+            if (record['inputType'] == 'insertText'):
+                return (record['label'], 'input', record['data'], ())
+            return (record['label'], 'input', f"{record['inputType']}:{record['data']}", ())
+        modifiers = tuple(m for m in ('alt', 'ctrl', 'meta', 'shift') if record.get(m + 'Key'))
+        return (record['label'], record['type'], record.get('key'), modifiers)
+
+    def keyEvents(self, label, key, *modifiers):
+        return [
+            (label, 'keydown', key, modifiers),
+            (label, 'keypress', key, modifiers),
+            (label, 'input', key, ()),
+            (label, 'keyup', key, modifiers),
+        ]
+
+    def backspaceEvents(self, label):
+        return [
+            (label, 'keydown', 'Backspace', ()),
+            (label, 'input', 'Backspace', ()),
+            (label, 'keyup', 'Backspace', ()),
+        ]
+
+    def assertTrace(self, trace, expected):
+        # None matches any event in the expected sequence:
+        actual = [None if (e is None) else self.normalizeEvent(r) for r, e in zip(trace, expected)]
+        self.assertEqual(actual + [self.normalizeEvent(r) for r in trace[len(expected):]], expected)
 
     @TestData(
         [{'lang': "en", 'keys': l, 'letter': l} for l in "ABCDEFGHIJKLMNOPQRSTUVWXYZ"] +
@@ -127,39 +240,14 @@ class BaseTest(BrowserTestCase):
     @foreachElement
     def testSingleKey(self, lang, keys, letter, elementId=None):
         textElement = self.getTextElement(lang, elementId)
-        del self.browser.consoleCapture
-
-        for i in range(1, 5):
-            textElement.send_keys(keys)
-            self.assertEqual(self.getValue(textElement), letter * i)
-
-        capture = [record for record in self.browser.consoleCapture() if record['arguments'][0].startswith('Event')]
-        numEvents = 4 if (keys == letter) else 11
-        self.assertEqual(len(capture), 4*numEvents)
-        for i in range(0, 4):
-            self.assertEqual(capture[i*numEvents]['arguments'][0], f'Event[{lang}]')
-            self.assertKeyEvent(capture[i*numEvents]['arguments'][1], 'keydown', keys)
-            self.assertEqual(capture[i*numEvents + 1]['arguments'][0], f'Event[{lang}]')
-            self.assertKeyEvent(capture[i*numEvents + 1]['arguments'][1], 'keypress', keys)
-            self.assertEqual(capture[i*numEvents + 2]['arguments'][0], f'Event[{lang}]')
-            self.assertInputEvent(capture[i*numEvents + 2]['arguments'][1], 'input', keys)
-            self.assertEqual(capture[i*numEvents + 3]['arguments'][0], f'Event[{lang}]')
-            self.assertKeyEvent(capture[i*numEvents + 3]['arguments'][1], 'keyup', keys)
-            if (keys != letter):
-                self.assertEqual(capture[i*numEvents + 4]['arguments'][0], f'Event[{lang}]')
-                self.assertKeyEvent(capture[i*numEvents + 4]['arguments'][1], 'keydown', 'Backspace')
-                self.assertEqual(capture[i*numEvents + 5]['arguments'][0], f'Event[{lang}]')
-                self.assertInputEvent(capture[i*numEvents + 5]['arguments'][1], 'input', 'Backspace')
-                self.assertEqual(capture[i*numEvents + 6]['arguments'][0], f'Event[{lang}]')
-                self.assertKeyEvent(capture[i*numEvents + 6]['arguments'][1], 'keyup', 'Backspace')
-                self.assertEqual(capture[i*numEvents + 7]['arguments'][0], f'Event[{lang}]')
-                self.assertKeyEvent(capture[i*numEvents + 7]['arguments'][1], 'keydown', letter)
-                self.assertEqual(capture[i*numEvents + 8]['arguments'][0], f'Event[{lang}]')
-                self.assertKeyEvent(capture[i*numEvents + 8]['arguments'][1], 'keypress', letter)
-                self.assertEqual(capture[i*numEvents + 9]['arguments'][0], f'Event[{lang}]')
-                self.assertInputEvent(capture[i*numEvents + 9]['arguments'][1], 'input', letter)
-                self.assertEqual(capture[i*numEvents + 10]['arguments'][0], f'Event[{lang}]')
-                self.assertKeyEvent(capture[i*numEvents + 10]['arguments'][1], 'keyup', letter)
+        self.clearTrace()
+
+        self.assertEqual(self.typeKeys(textElement, [keys] * 4), [letter * i for i in range(1, 5)])
+
+        expected = self.keyEvents(f'Event[{lang}]', keys)
+        if (keys != letter):
+            expected += self.backspaceEvents(f'Event[{lang}]') + self.keyEvents(f'Event[{lang}]', letter)
+        self.assertTrace(self.takeTrace(), expected * 4)
 
     @TestData([
         {'lang': "ru", 'keys': k, 'letter': l} for k, l in dict({
@@ -176,40 +264,16 @@ class BaseTest(BrowserTestCase):
     @foreachElement
     def testPrefixComposition(self, lang, keys, letter, elementId=None):
         textElement = self.getTextElement(lang, elementId)
-        del self.browser.consoleCapture
-
-        for i in range(1, 5):
-            textElement.send_keys(keys)
-            self.assertEqual(self.getValue(textElement), letter * i)
-
-        capture = [record for record in self.browser.consoleCapture() if record['arguments'][0].startswith('Event')]
-        numEvents = 7 * len(keys) + 4
-        self.assertEqual(len(capture), 4*numEvents)
-        for i in range(0, 4):
-            for j in range(0, len(keys)):
-                self.assertEqual(capture[i*numEvents + 4*j]['arguments'][0], f'Event[{lang}]')
-                self.assertKeyEvent(capture[i*numEvents + 4*j]['arguments'][1], 'keydown', keys[j])
-                self.assertEqual(capture[i*numEvents + 4*j + 1]['arguments'][0], f'Event[{lang}]')
-                self.assertKeyEvent(capture[i*numEvents + 4*j + 1]['arguments'][1], 'keypress', keys[j])
-                self.assertEqual(capture[i*numEvents + 4*j + 2]['arguments'][0], f'Event[{lang}]')
-                self.assertInputEvent(capture[i*numEvents + 4*j + 2]['arguments'][1], 'input', keys[j])
-                self.assertEqual(capture[i*numEvents + 4*j + 3]['arguments'][0], f'Event[{lang}]')
-                self.assertKeyEvent(capture[i*numEvents + 4*j + 3]['arguments'][1], 'keyup', keys[j])
-            for j in range(0, len(keys)):
-                self.assertEqual(capture[i*numEvents + 4*len(keys) + 3*j]['arguments'][0], f'Event[{lang}]')
-                self.assertKeyEvent(capture[i*numEvents + 4*len(keys) + 3*j]['arguments'][1], 'keydown', 'Backspace')
-                self.assertEqual(capture[i*numEvents + 4*len(keys) + 3*j + 1]['arguments'][0], f'Event[{lang}]')
-                self.assertInputEvent(capture[i*numEvents + 4*len(keys) + 3*j + 1]['arguments'][1], 'input', 'Backspace')
-                self.assertEqual(capture[i*numEvents + 4*len(keys) + 3*j + 2]['arguments'][0], f'Event[{lang}]')
-                self.assertKeyEvent(capture[i*numEvents + 4*len(keys) + 3*j + 2]['arguments'][1], 'keyup', 'Backspace')
-            self.assertEqual(capture[i*numEvents + 7*len(keys)]['arguments'][0], f'Event[{lang}]')
-            self.assertKeyEvent(capture[i*numEvents + 7*len(keys)]['arguments'][1], 'keydown', letter)
-            self.assertEqual(capture[i*numEvents + 7*len(keys) + 1]['arguments'][0], f'Event[{lang}]')
-            self.assertKeyEvent(capture[i*numEvents + 7*len(keys) + 1]['arguments'][1], 'keypress', letter)
-            self.assertEqual(capture[i*numEvents + 7*len(keys) + 2]['arguments'][0], f'Event[{lang}]')
-            self.assertInputEvent(capture[i*numEvents + 7*len(keys) + 2]['arguments'][1], 'input', letter)
-            self.assertEqual(capture[i*numEvents + 7*len(keys) + 3]['arguments'][0], f'Event[{lang}]')
-            self.assertKeyEvent(capture[i*numEvents + 7*len(keys) + 3]['arguments'][1], 'keyup', letter)
+        self.clearTrace()
+
+        self.assertEqual(self.typeKeys(textElement, [keys] * 4), [letter * i for i in range(1, 5)])
+
+        expected = []
+        for key in keys:
+            expected += self.keyEvents(f'Event[{lang}]', key)
+        expected += self.backspaceEvents(f'Event[{lang}]') * len(keys)
+        expected += self.keyEvents(f'Event[{lang}]', letter)
+        self.assertTrace(self.takeTrace(), expected * 4)
 
     @TestData(
         [{'lang': "ru", 'keys': k, 'letter': l} for k, l in dict({"TS": "Ц", "Ts": "Ц", "CH": "Ч", "Ch": "Ч"}).items()] +
@@ -220,48 +284,16 @@ class BaseTest(BrowserTestCase):
     @foreachElement
     def testSuffixComposition(self, lang, keys, letter, elementId=None):
         textElement = self.getTextElement(lang, elementId)
-        del self.browser.consoleCapture
-
-        for i in range(1, 5):
-            textElement.send_keys(keys)
-            self.assertEqual(self.getValue(textElement), letter * i)
-
-        capture = [record for record in self.browser.consoleCapture() if record['arguments'][0].startswith('Event')]
-        numEvents = 15 + 3 * len(keys) + 4
-        self.assertEqual(len(capture), 4*numEvents)
-        for i in range(0, 4):
-            self.assertEqual(capture[i*numEvents]['arguments'][0], f'Event[{lang}]')
-            self.assertKeyEvent(capture[i*numEvents]['arguments'][1], 'keydown', keys[0])
-            self.assertEqual(capture[i*numEvents + 1]['arguments'][0], f'Event[{lang}]')
-            self.assertKeyEvent(capture[i*numEvents + 1]['arguments'][1], 'keypress', keys[0])
-            self.assertEqual(capture[i*numEvents + 2]['arguments'][0], f'Event[{lang}]')
-            self.assertInputEvent(capture[i*numEvents + 2]['arguments'][1], 'input', keys[0])
-            self.assertEqual(capture[i*numEvents + 3]['arguments'][0], f'Event[{lang}]')
-            self.assertKeyEvent(capture[i*numEvents + 3]['arguments'][1], 'keyup', keys[0])
-            # Key is corrected (7 events):
-            self.assertEqual(capture[i*numEvents + 11]['arguments'][0], f'Event[{lang}]')
-            self.assertKeyEvent(capture[i*numEvents + 11]['arguments'][1], 'keydown', keys[1])
-            self.assertEqual(capture[i*numEvents + 11 + 1]['arguments'][0], f'Event[{lang}]')
-            self.assertKeyEvent(capture[i*numEvents + 11 + 1]['arguments'][1], 'keypress', keys[1])
-            self.assertEqual(capture[i*numEvents + 11 + 2]['arguments'][0], f'Event[{lang}]')
-            self.assertInputEvent(capture[i*numEvents + 11 + 2]['arguments'][1], 'input', keys[1])
-            self.assertEqual(capture[i*numEvents + 11 + 3]['arguments'][0], f'Event[{lang}]')
-            self.assertKeyEvent(capture[i*numEvents + 11 + 3]['arguments'][1], 'keyup', keys[1])
-            for j in range(0, len(keys)):
-                self.assertEqual(capture[i*numEvents + 15 + 3*j]['arguments'][0], f'Event[{lang}]')
-                self.assertKeyEvent(capture[i*numEvents + 15 + 3*j]['arguments'][1], 'keydown', 'Backspace')
-                self.assertEqual(capture[i*numEvents + 15 + 3*j + 1]['arguments'][0], f'Event[{lang}]')
-                self.assertInputEvent(capture[i*numEvents + 15 + 3*j + 1]['arguments'][1], 'input', 'Backspace')
-                self.assertEqual(capture[i*numEvents + 15 + 3*j + 2]['arguments'][0], f'Event[{lang}]')
-                self.assertKeyEvent(capture[i*numEvents + 15 + 3*j + 2]['arguments'][1], 'keyup', 'Backspace')
-            self.assertEqual(capture[i*numEvents + 15 + 3*len(keys)]['arguments'][0], f'Event[{lang}]')
-            self.assertKeyEvent(capture[i*numEvents + 15 + 3*len(keys)]['arguments'][1], 'keydown', letter)
-            self.assertEqual(capture[i*numEvents + 15 + 3*len(keys) + 1]['arguments'][0], f'Event[{lang}]')
-            self.assertKeyEvent(capture[i*numEvents + 15 + 3*len(keys) + 1]['arguments'][1], 'keypress', letter)
-            self.assertEqual(capture[i*numEvents + 15 + 3*len(keys) + 2]['arguments'][0], f'Event[{lang}]')
-            self.assertInputEvent(capture[i*numEvents + 15 + 3*len(keys) + 2]['arguments'][1], 'input', letter)
-            self.assertEqual(capture[i*numEvents + 15 + 3*len(keys) + 3]['arguments'][0], f'Event[{lang}]')
-            self.assertKeyEvent(capture[i*numEvents + 15 + 3*len(keys) + 3]['arguments'][1], 'keyup', letter)
+        self.clearTrace()
+
+        self.assertEqual(self.typeKeys(textElement, [keys] * 4), [letter * i for i in range(1, 5)])
+
+        expected = self.keyEvents(f'Event[{lang}]', keys[0])
+        expected += [None] * 7 # Key is corrected
+        expected += self.keyEvents(f'Event[{lang}]', keys[1])
+        expected += self.backspaceEvents(f'Event[{lang}]') * len(keys)
+        expected += self.keyEvents(f'Event[{lang}]', letter)
+        self.assertTrace(self.takeTrace(), expected * 4)
 
     @TestData([
         {'lang': "ru", 'keys': k, 'letter': l} for k, l in dict({
@@ -274,65 +306,19 @@ class BaseTest(BrowserTestCase):
     @foreachElement
     def testShchaComposition(self, lang, keys, letter, elementId=None):
         textElement = self.getTextElement(lang, elementId)
-        del self.browser.consoleCapture
-
-        for i in range(1, 5):
-            textElement.send_keys(keys)
-            self.assertEqual(self.getValue(textElement), letter * i)
-
-        capture = [record for record in self.browser.consoleCapture() if record['arguments'][0].startswith('Event')]
-        numEvents = 46
-        self.assertEqual(len(capture), 4*numEvents)
-        for i in range(0, 4):
-            self.assertEqual(capture[i*numEvents]['arguments'][0], f'Event[{lang}]')
-            self.assertKeyEvent(capture[i*numEvents]['arguments'][1], 'keydown', keys[0])
-            self.assertEqual(capture[i*numEvents + 1]['arguments'][0], f'Event[{lang}]')
-            self.assertKeyEvent(capture[i*numEvents + 1]['arguments'][1], 'keypress', keys[0])
-            self.assertEqual(capture[i*numEvents + 2]['arguments'][0], f'Event[{lang}]')
-            self.assertInputEvent(capture[i*numEvents + 2]['arguments'][1], 'input', keys[0])
-            self.assertEqual(capture[i*numEvents + 3]['arguments'][0], f'Event[{lang}]')
-            self.assertKeyEvent(capture[i*numEvents + 3]['arguments'][1], 'keyup', keys[0])
-            self.assertEqual(capture[i*numEvents + 4]['arguments'][0], f'Event[{lang}]')
-            self.assertKeyEvent(capture[i*numEvents + 4]['arguments'][1], 'keydown', keys[1])
-            self.assertEqual(capture[i*numEvents + 4 + 1]['arguments'][0], f'Event[{lang}]')
-            self.assertKeyEvent(capture[i*numEvents + 4 + 1]['arguments'][1], 'keypress', keys[1])
-            self.assertEqual(capture[i*numEvents + 4 + 2]['arguments'][0], f'Event[{lang}]')
-            self.assertInputEvent(capture[i*numEvents + 4 + 2]['arguments'][1], 'input', keys[1])
-            self.assertEqual(capture[i*numEvents + 4 + 3]['arguments'][0], f'Event[{lang}]')
-            self.assertKeyEvent(capture[i*numEvents + 4 + 3]['arguments'][1], 'keyup', keys[1])
-            # Keys are corrected (10 events):
-            self.assertEqual(capture[i*numEvents + 18]['arguments'][0], f'Event[{lang}]')
-            self.assertKeyEvent(capture[i*numEvents + 18]['arguments'][1], 'keydown', keys[2])
-            self.assertEqual(capture[i*numEvents + 18 + 1]['arguments'][0], f'Event[{lang}]')
-            self.assertKeyEvent(capture[i*numEvents + 18 + 1]['arguments'][1], 'keypress', keys[2])
-            self.assertEqual(capture[i*numEvents + 18 + 2]['arguments'][0], f'Event[{lang}]')
-            self.assertInputEvent(capture[i*numEvents + 18 + 2]['arguments'][1], 'input', keys[2])
-            self.assertEqual(capture[i*numEvents + 18 + 3]['arguments'][0], f'Event[{lang}]')
-            self.assertKeyEvent(capture[i*numEvents + 18 + 3]['arguments'][1], 'keyup', keys[2])
-            # Key is corrected (7 events):
-            self.assertEqual(capture[i*numEvents + 29]['arguments'][0], f'Event[{lang}]')
-            self.assertKeyEvent(capture[i*numEvents + 29]['arguments'][1], 'keydown', keys[3])
-            self.assertEqual(capture[i*numEvents + 29 + 1]['arguments'][0], f'Event[{lang}]')
-            self.assertKeyEvent(capture[i*numEvents + 29 + 1]['arguments'][1], 'keypress', keys[3])
-            self.assertEqual(capture[i*numEvents + 29 + 2]['arguments'][0], f'Event[{lang}]')
-            self.assertInputEvent(capture[i*numEvents + 29 + 2]['arguments'][1], 'input', keys[3])
-            self.assertEqual(capture[i*numEvents + 29 + 3]['arguments'][0], f'Event[{lang}]')
-            self.assertKeyEvent(capture[i*numEvents + 29 + 3]['arguments'][1], 'keyup', keys[3])
-            for j in range(0, 3):
-                self.assertEqual(capture[i*numEvents + 33 + 3*j]['arguments'][0], f'Event[{lang}]')
-                self.assertKeyEvent(capture[i*numEvents + 33 + 3*j]['arguments'][1], 'keydown', 'Backspace')
-                self.assertEqual(capture[i*numEvents + 33 + 3*j + 1]['arguments'][0], f'Event[{lang}]')
-                self.assertInputEvent(capture[i*numEvents + 33 + 3*j + 1]['arguments'][1], 'input', 'Backspace')
-                self.assertEqual(capture[i*numEvents + 33 + 3*j + 2]['arguments'][0], f'Event[{lang}]')
-                self.assertKeyEvent(capture[i*numEvents + 33 + 3*j + 2]['arguments'][1], 'keyup', 'Backspace')
-            self.assertEqual(capture[i*numEvents + 42]['arguments'][0], f'Event[{lang}]')
-            self.assertKeyEvent(capture[i*numEvents + 42]['arguments'][1], 'keydown', letter)
-            self.assertEqual(capture[i*numEvents + 42 + 1]['arguments'][0], f'Event[{lang}]')
-            self.assertKeyEvent(capture[i*numEvents + 42 + 1]['arguments'][1], 'keypress', letter)
-            self.assertEqual(capture[i*numEvents + 42 + 2]['arguments'][0], f'Event[{lang}]')
-            self.assertInputEvent(capture[i*numEvents + 42 + 2]['arguments'][1], 'input', letter)
-            self.assertEqual(capture[i*numEvents + 42 + 3]['arguments'][0], f'Event[{lang}]')
-            self.assertKeyEvent(capture[i*numEvents + 42 + 3]['arguments'][1], 'keyup', letter)
+        self.clearTrace()
+
+        self.assertEqual(self.typeKeys(textElement, [keys] * 4), [letter * i for i in range(1, 5)])
+
+        expected = self.keyEvents(f'Event[{lang}]', keys[0])
+        expected += self.keyEvents(f'Event[{lang}]', keys[1])
+        expected += [None] * 10 # Keys are corrected
+        expected += self.keyEvents(f'Event[{lang}]', keys[2])
+        expected += [None] * 7 # Key is corrected
+        expected += self.keyEvents(f'Event[{lang}]', keys[3])
+        expected += self.backspaceEvents(f'Event[{lang}]') * 3
+        expected += self.keyEvents(f'Event[{lang}]', letter)
+        self.assertTrace(self.takeTrace(), expected * 4)
 
     @TestData({
         "English (upper)": {
@@ -390,54 +376,84 @@ class BaseTest(BrowserTestCase):
     @foreachElement
     def testAlphabet(self, lang, inputData, outputData, elementId=None):
         textElement = self.getTextElement(lang, elementId)
-        del self.browser.consoleCapture
+        self.clearTrace()
 
-        l = 0
-        for keys in inputData.split(' '):
-            textElement.send_keys(keys)
-
-            capture = [record for record in self.browser.consoleCapture() if record['arguments'][0].startswith('Event')]
-            self.assertEqual(capture[-4]['arguments'][0], f'Event[{lang}]')
-            self.assertKeyEvent(capture[-4]['arguments'][1], 'keydown', outputData[l])
-            self.assertEqual(capture[-3]['arguments'][0], f'Event[{lang}]')
-            self.assertKeyEvent(capture[-3]['arguments'][1], 'keypress', outputData[l])
-            self.assertEqual(capture[-2]['arguments'][0], f'Event[{lang}]')
-            self.assertInputEvent(capture[-2]['arguments'][1], 'input', outputData[l])
-            self.assertEqual(capture[-1]['arguments'][0], f'Event[{lang}]')
-            self.assertKeyEvent(capture[-1]['arguments'][1], 'keyup', outputData[l])
-
-            l = l + 1
-            self.assertEqual(self.getValue(textElement), outputData[0:l])
+        keysList = inputData.split(' ')
+        self.assertEqual(self.typeKeys(textElement, keysList), [outputData[0:l] for l in range(1, len(keysList) + 1)])
+
+        for l, trace in enumerate(self.splitTrace(self.takeTrace(), keysList)):
+            self.assertTrace(trace[-4:], self.keyEvents(f'Event[{lang}]', outputData[l]))
 
     @TestData(['ru', 'el'])
     @foreachElement
     def testEnter(self, lang, elementId=None):
         textElement = self.getTextElement(lang, elementId)
-        del self.browser.consoleCapture
+        self.clearTrace()
 
         textElement.send_keys(Keys.ENTER)
-        capture = self.browser.consoleCapture()[1:]
+        trace = self.takeTrace('')[1:]
 
         focusEvent = None
         blurEvent = None
-        for record in capture:
-            if (record['arguments'][0] == f'Blur[{lang}]'):
+        for record in trace:
+            if (record['label'] == f'Blur[{lang}]'):
                 if focusEvent is not None:
                     self.fail("Focus event occured before blur event")
                 if blurEvent is None:
-                    blurEvent = record['arguments'][1]
+                    blurEvent = record
                 else:
                     self.fail("Captured two blur events")
-            if (record['arguments'][0] == f'Focus[{lang}]'):
+            if (record['label'] == f'Focus[{lang}]'):
                 if blurEvent is None:
                     self.fail("Focus event occured before blur event")
                 if focusEvent is None:
-                    focusEvent = record['arguments'][1]
+                    focusEvent = record
                 else:
                     self.fail("Captured two focus events")
         self.assertEvent(blurEvent, 'blur', textElement)
         self.assertEvent(focusEvent, 'focus', textElement)
 
+    @TestData([
+        {'lang': 'ru', 'profile': 'input'},
+        {'lang': 'ru', 'profile': 'beforeinput'},
+        {'lang': 'el', 'profile': 'input'},
+        {'lang': 'el', 'profile': 'beforeinput'},
+    ], afterEach=lambda self: self.clearTextElements())
+    def testProfile(self, lang, profile):
+        textElement = self.getTextElement(lang, self.__class__.elementIds[lang][0])
+        self.browser.execute_script(f"kcTest.sendMessage({{command: 'SET_LANG', lang: '{lang}', profile: '{profile}'}}, arguments[0]);", textElement)
+        ans = self.browser.execute_async_script("kcTest.sendMessage({command: 'GET_LANG'}, arguments[0]).then(arguments[arguments.length - 1]);", textElement)
+        self.assertEqual(ans, [None, lang])
+        self.clearTrace()
+
+        keys, letter = {'ru': ("ya", "я"), 'el': ("pc", "ψ")}[lang]
+        self.assertEqual(self.typeKeys(textElement, [keys]), [letter])
+        self.assertTrace(self.splitTrace(self.takeTrace(), [keys[0], keys[1]])[1], self.keyEvents(f'Event[{lang}]', keys[1]) + [
+            (f'Event[{lang}]', 'input', f"insertReplacementText:{letter}", ()),
+        ])
+
+    @TestData([
+        {'lang': 'ru', 'text': "privet, shchuka", 'outputData': "привет, щука"},
+        {'lang': 'el', 'text': "kalèmera kosmos", 'outputData': "καλημερα κοσμοσ"},
+    ], afterEach=lambda self: self.clearTextElements())
+    @foreachElement
+    def testTransliterate(self, lang, text, outputData, elementId=None):
+        textElement = self.getTextElement(lang, elementId)
+        self.browser.execute_async_script("""
+            var element = arguments[0];
+            var done = arguments[arguments.length - 1];
+            if (element.isContentEditable)
+                element.textContent = arguments[1];
+            else
+                element.value = arguments[1];
+            element.addEventListener('input', (e) => {
+                if (e.inputType == 'insertReplacementText')
+                    done();
+            });
+            kcTest.sendMessage({command: 'TRANSLITERATE'}, element);
+        """, textElement, text)
+        self.assertEqual(self.getValue(textElement), outputData)
+
 class FlagsTest(BrowserTestCase):
     @classmethod
     def setUpClass(cls):
@@ -455,27 +471,21 @@ class FlagsTest(BrowserTestCase):
         w = 32 + 3*2 + 1
         h = 32
 
+        self.browser.execute_async_script(FLAG_SCRIPT, element)
         self.browser.execute_script("arguments[0].blur();", element)
-        self.assertTrue(self.browser.save_screenshot(os.path.join(self.__class__.testOutput, f"testFlag_{lang}.png")))
-        self.assertTrue(ImageMagick.crop(os.path.join(self.__class__.testOutput, f"testFlag_{lang}.png"),
-                                         os.path.join(self.__class__.testOutput, f"testFlag_{lang}.png"),
-                                         {
-                                             'width': w,
-                                             'height': h,
-                                             'x': element.rect['x'] + element.rect['width'] - w,
-                                             'y': element.rect['y'] + element.rect['height'] - h
-                                         }))
-
-        diff = ImageMagick.compare(os.path.join(self.__class__.testInput, f"testFlag_{lang}.png"),
-                                   os.path.join(self.__class__.testOutput, f"testFlag_{lang}.png"),
-                                   os.path.join(self.__class__.testOutput, f"testFlag_{lang}_diff.png"))
-        self.assertIsNot(diff, None)
+        screenshot = element.screenshot_as_png
+        image = imagediff.Image.fromPNG(screenshot)
+        image = image.crop(image.width - w, image.height - h, w, h)
+
+        diff = imagediff.dssim(imagediff.loadImage(os.path.join(self.__class__.testInput, f"testFlag_{lang}.png")), image)
         print(f"\nDSSIM for '{lang}' is: {diff} ... ", end='')
+        if (diff > 0.1):
+            with open(os.path.join(self.__class__.testOutput, f"testFlag_{lang}.png"), 'wb') as screenshotFile:
+                screenshotFile.write(screenshot)
         self.assertLessEqual(diff, 0.1)
 
     @TestData(['ru', 'el'])
     @foreachElement
-    @unittest.skipUnless(ImageMagick.checkImageMagick(), 'This test requires ImageMagick')
     def testFlag(self, lang, elementId=None):
         self.checkFlag(self.getTextElement(lang, elementId), lang)
 
@@ -483,7 +493,7 @@ class MessagesTest(BrowserTestCase):
     @classmethod
     def setUpClass(cls):
         super().setUpClass()
-        print(cls.browser.install_addon(os.path.join(cls.testDir, 'dist', 'kc_test.xpi'), True))
+        cls.installAddon(os.path.join(cls.testDir, 'dist', 'kc_test.xpi'))
 
     @TestData(['en', 'fr', 'de', 'ru', 'el'])
     def testGetLang(self, lang):
@@ -517,6 +527,20 @@ class MessagesTest(BrowserTestCase):
         ans = self.browser.execute_async_script("kcTest.sendMessage({command: 'GET_LANG'}, arguments[0]).then(arguments[arguments.length - 1]);", element)
         self.assertEqual(ans, [lang, None])
 
+    def testPerf(self):
+        element = self.getTextElement('ru')
+        self.browser.execute_async_script("kcTest.sendMessage({command: 'SET_PERF', enabled: true}, arguments[0]).then(arguments[arguments.length - 1]);", element)
+        element.send_keys('privet')
+
+        # Records are sent to the background script periodically, so wait for the six compositions:
+        def composed(browser):
+            ans = browser.execute_async_script("kcTest.sendMessage({command: 'GET_PERF'}, arguments[0]).then(arguments[arguments.length - 1]);", element)
+            return ans['durations'].get('composition', {}).get('count', 0) >= 6
+        WebDriverWait(self.browser, 10, poll_frequency=0.2).until(composed)
+        ans = self.browser.execute_async_script("kcTest.sendMessage({command: 'SET_PERF', enabled: false}, arguments[0]).then(arguments[arguments.length - 1]);", element)
+        self.assertEqual(ans['durations']['composition']['count'], 6)
+        self.assertEqual(ans['counters']['events'], 6 * 7)
+
 class DynamicFlagsTest(FlagsTest, MessagesTest):
 
     def setUp(self):
@@ -534,7 +558,6 @@ class DynamicFlagsTest(FlagsTest, MessagesTest):
         {'lang': 'ru', 'kcLang': 'el'},
         {'lang': 'el', 'kcLang': 'el'},
     ])
-    @unittest.skipUnless(ImageMagick.checkImageMagick(), 'This test requires ImageMagick')
     def testFlagSetLang(self, lang, kcLang):
         element = self.getTextElement(lang)
 
@@ -560,26 +583,21 @@ class TextAreaTest(BaseTest, DynamicFlagsTest):
 
     def getTextElement(self, lang, elementId=None):
         if elementId is None:
-            self.browser.get(os.path.join('file://' + self.__class__.testDir, 'test_mapping.html'))
+            self.loadPage('test_mapping.html')
             element = self.browser.find_element(By.CSS_SELECTOR, f'textarea[lang="{lang}"]')
         else:
-            self.browser.get(os.path.join('file://' + self.__class__.testDir, 'test_dynamic.html'))
+            self.loadPage('test_dynamic.html')
             element = self.browser.find_element(By.ID, elementId)
             if lang is not None:
                 self.browser.execute_script(f"kcTest.sendMessage({{command: 'SET_LANG', lang: '{lang}'}}, arguments[0]).then(arguments[arguments.length - 1]);", element)
                 ans = self.browser.execute_async_script("kcTest.sendMessage({command: 'GET_LANG'}, arguments[0]).then(arguments[arguments.length - 1]);", element)
                 self.assertEqual(ans, [None, lang])
 
-        self.browser.consoleCapture.depth = 1
         return element
 
     def getValue(self, element):
         return element.get_property('value')
 
-    def clearTextElements(self):
-        for textArea in self.browser.find_elements(By.TAG_NAME, 'textarea'):
-            textArea.clear()
-
 class TextInputTest(BaseTest, DynamicFlagsTest):
     elementIds = {
         'ru': ['inlineTextInput'],
@@ -588,26 +606,21 @@ class TextInputTest(BaseTest, DynamicFlagsTest):
 
     def getTextElement(self, lang, elementId=None):
         if elementId is None:
-            self.browser.get(os.path.join('file://' + self.__class__.testDir, 'test_mapping.html'))
+            self.loadPage('test_mapping.html')
             element = self.browser.find_element(By.CSS_SELECTOR, f'input[type="text"][lang="{lang}"]')
         else:
-            self.browser.get(os.path.join('file://' + self.__class__.testDir, 'test_dynamic.html'))
+            self.loadPage('test_dynamic.html')
             element = self.browser.find_element(By.ID, elementId)
             if lang is not None:
                 self.browser.execute_script(f"kcTest.sendMessage({{command: 'SET_LANG', lang: '{lang}'}}, arguments[0]).then(arguments[arguments.length - 1]);", element)
                 ans = self.browser.execute_async_script("kcTest.sendMessage({command: 'GET_LANG'}, arguments[0]).then(arguments[arguments.length - 1]);", element)
                 self.assertEqual(ans, [None, lang])
 
-        self.browser.consoleCapture.depth = 1
         return element
 
     def getValue(self, element):
         return element.get_property('value')
 
-    def clearTextElements(self):
-        for textInput in self.browser.find_elements(By.CSS_SELECTOR, 'input[type="text"]'):
-            textInput.clear()
-
 class ContentEditableTest(BaseTest, DynamicFlagsTest):
     elementIds = {
         'ru': ['blockEditableDiv', 'inlineBlockEditableDiv'],
@@ -616,22 +629,17 @@ class ContentEditableTest(BaseTest, DynamicFlagsTest):
 
     def getTextElement(self, lang, elementId=None):
         if elementId is None:
-            self.browser.get(os.path.join('file://' + self.__class__.testDir, 'test_mapping.html'))
+            self.loadPage('test_mapping.html')
             element = self.browser.find_element(By.CSS_SELECTOR, f'div[contentEditable="true"][lang="{lang}"]')
         else:
-            self.browser.get(os.path.join('file://' + self.__class__.testDir, 'test_dynamic.html'))
+            self.loadPage('test_dynamic.html')
             element = self.browser.find_element(By.ID, elementId)
             if lang is not None:
                 self.browser.execute_script(f"kcTest.sendMessage({{command: 'SET_LANG', lang: '{lang}'}}, arguments[0]).then(arguments[arguments.length - 1]);", element)
                 ans = self.browser.execute_async_script("kcTest.sendMessage({command: 'GET_LANG'}, arguments[0]).then(arguments[arguments.length - 1]);", element)
                 self.assertEqual(ans, [None, lang])
 
-        self.browser.consoleCapture.depth = 1
         return element
 
     def getValue(self, element):
         return element.text
-
-    def clearTextElements(self):
-        for editableDiv in self.browser.find_elements(By.CSS_SELECTOR, 'div[contentEditable="true"]'):
-            editableDiv.clear()
@@ -0,0 +1,148 @@
+# Copyright 2020 Pascal COMBES <pascom@orange.fr>
+#
+# This file is part of KeyboardCompositor.
+#
+# KeyboardCompositor is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# KeyboardCompositor is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with KeyboardCompositor. If not, see <http://www.gnu.org/licenses/>
+
+import io
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'tools'))
+from compile_mappings import MappingError, MappingParser, checkMapping, compileMapping, compileMappings
+from kc_compose import compose, loadMapping
+
+class CompilerTest(unittest.TestCase):
+    header = "// Name: Test\n// Icon: test.png\n"
+
+    def parse(self, source):
+        return MappingParser(self.header + source).parse()
+
+    def testParse(self):
+        header, entries = self.parse('{\n    "a": "а", // Comment\n    "b //": "б c",\n}\n')
+        self.assertEqual(header, {'name': "Test", 'icon': "test.png"})
+        self.assertEqual(entries, [("a", "а", 4), ("b //", "б c", 5)])
+
+    def testParseErrors(self):
+        for source in ['{"a" "а"}', '{"a": "а",, }', '{"a": "а"} "b"', '{"a": а}', '/* {}']:
+            with self.subTest(source=source):
+                with self.assertRaises(MappingError):
+                    self.parse(source)
+        with self.assertRaises(MappingError):
+            MappingParser('{"a": "а"}').parse()
+
+    def testDuplicateKey(self):
+        with self.assertRaises(MappingError) as context:
+            checkMapping(self.parse('{\n"a": "а",\n"a": "б"\n}')[1])
+        self.assertEqual(context.exception.line, 5)
+
+    def testShadowedKey(self):
+        with self.assertRaises(MappingError):
+            checkMapping(self.parse('{"s": "с", "sh": "ш"}')[1])
+        self.assertEqual(checkMapping(self.parse('{"s": "с", "сh": "ч"}')[1]), {"s": "с", "сh": "ч"})
+
+    def testCompile(self):
+        self.assertEqual(compileMapping({"a": "а", "ya": "я", "шсh": "щ"}), {
+            "a": {"": "а", "y": {"": "я"}},
+            "h": {"с": {"ш": {"": "щ"}}},
+        })
+
+    def testSurrogatePair(self):
+        # Characters outside the basic multilingual plane are a single node (and a single shard):
+        mapping = {"\U0001F600": "x", "x\U0001F600": "\U00010330", "\U00010330\U00010330": "y"}
+        self.assertEqual(compileMapping(mapping), {
+            "\U0001F600": {"": "x", "x": {"": "\U00010330"}},
+            "\U00010330": {"\U00010330": {"": "y"}},
+        })
+        with tempfile.TemporaryDirectory() as srcDir, tempfile.TemporaryDirectory() as destDir:
+            with open(os.path.join(srcDir, 'xx.js'), 'w', encoding='utf-8') as file:
+                file.write(self.header + json.dumps(mapping))
+
+            self.assertEqual(compileMappings(srcDir, destDir, log=io.StringIO(), shardThreshold=2), [
+                {'code': 'xx', 'name': "Test", 'icon': "test.png", 'shards': ["\U00010330", "\U0001F600"], 'depth': 2},
+            ])
+            self.assertEqual(sorted(os.listdir(os.path.join(destDir, 'xx'))), ['10330.json', '1f600.json'])
+            self.assertEqual(loadMapping('xx', destDir), compileMapping(mapping))
+            self.assertEqual(compose(loadMapping('xx', destDir), "x\U0001F600x\U0001F600"), "y")
+
+    def testIncremental(self):
+        with tempfile.TemporaryDirectory() as srcDir, tempfile.TemporaryDirectory() as destDir:
+            with open(os.path.join(srcDir, 'xx.js'), 'w', encoding='utf-8') as file:
+                file.write(self.header + '{"a": "а"}')
+
+            log = io.StringIO()
+            self.assertEqual(compileMappings(srcDir, destDir, log=log), [{'code': 'xx', 'name': "Test", 'icon': "test.png"}])
+            self.assertIn("Processing mapping: xx.js", log.getvalue())
+            with open(os.path.join(destDir, 'xx.json'), encoding='utf-8') as file:
+                self.assertEqual(json.load(file), {"a": {"": "а"}})
+
+            log = io.StringIO()
+            compileMappings(srcDir, destDir, log=log)
+            self.assertIn("Mapping xx.js is up to date", log.getvalue())
+
+            os.remove(os.path.join(srcDir, 'xx.js'))
+            self.assertEqual(compileMappings(srcDir, destDir, log=log), [])
+            self.assertFalse(os.path.exists(os.path.join(destDir, 'xx.json')))
+
+    def testConflicts(self):
+        with tempfile.TemporaryDirectory() as srcDir, tempfile.TemporaryDirectory() as destDir:
+            with open(os.path.join(srcDir, 'xx.js'), 'w', encoding='utf-8') as file:
+                file.write(self.header + '{"a": "а", "ba": "б"}')
+
+            log = io.StringIO()
+            compileMappings(srcDir, destDir, log=log)
+            self.assertIn("Key 'a' is a suffix of key 'ba'", log.getvalue())
+
+            # The conflicts are only listed again when they change or when verbose:
+            log = io.StringIO()
+            compileMappings(srcDir, destDir, force=True, log=log)
+            self.assertNotIn("Key 'a' is a suffix of key 'ba'", log.getvalue())
+            self.assertIn("1 conflict(s) already reported", log.getvalue())
+
+            log = io.StringIO()
+            compileMappings(srcDir, destDir, force=True, log=log, verbose=True)
+            self.assertIn("Key 'a' is a suffix of key 'ba'", log.getvalue())
+
+            with open(os.path.join(srcDir, 'xx.js'), 'w', encoding='utf-8') as file:
+                file.write(self.header + '{"a": "а", "ba": "б", "ca": "ц"}')
+            log = io.StringIO()
+            compileMappings(srcDir, destDir, log=log)
+            self.assertIn("Key 'a' is a suffix of key 'ca'", log.getvalue())
+            self.assertNotIn("Key 'a' is a suffix of key 'ba'", log.getvalue())
+
+    def testSharded(self):
+        with tempfile.TemporaryDirectory() as srcDir, tempfile.TemporaryDirectory() as destDir:
+            with open(os.path.join(srcDir, 'xx.js'), 'w', encoding='utf-8') as file:
+                file.write(self.header + '{"a": "а", "ya": "я", "b": "б"}')
+
+            log = io.StringIO()
+            self.assertEqual(compileMappings(srcDir, destDir, log=log, shardThreshold=2), [
+                {'code': 'xx', 'name': "Test", 'icon': "test.png", 'shards': ["a", "b"], 'depth': 2},
+            ])
+            self.assertFalse(os.path.exists(os.path.join(destDir, 'xx.json')))
+            self.assertEqual(sorted(os.listdir(os.path.join(destDir, 'xx'))), ['0061.json', '0062.json'])
+            with open(os.path.join(destDir, 'xx', '0061.json'), encoding='utf-8') as file:
+                self.assertEqual(json.load(file), {"": "а", "y": {"": "я"}})
+            self.assertEqual(loadMapping('xx', destDir), compileMapping({"a": "а", "ya": "я", "b": "б"}))
+
+            log = io.StringIO()
+            self.assertEqual(compileMappings(srcDir, destDir, log=log, shardThreshold=2)[0]['shards'], ["a", "b"])
+            self.assertIn("Mapping xx.js is up to date", log.getvalue())
+
+            compileMappings(srcDir, destDir, log=log)
+            self.assertTrue(os.path.isfile(os.path.join(destDir, 'xx.json')))
+            self.assertFalse(os.path.exists(os.path.join(destDir, 'xx')))
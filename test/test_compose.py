@@ -0,0 +1,119 @@
+# Copyright 2020 Pascal COMBES <pascom@orange.fr>
+#
+# This file is part of KeyboardCompositor.
+#
+# KeyboardCompositor is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# KeyboardCompositor is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with KeyboardCompositor. If not, see <http://www.gnu.org/licenses/>
+
+from selenium.webdriver.common.keys import Keys
+from selenium.webdriver.common.by import By
+from .PythonUtils.testdata import TestData
+from .test import BrowserTestCase
+
+import io
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'tools'))
+from kc_compose import BACKSPACE, LEFT, RIGHT, Composer, compose, flattenMapping, loadMapping
+from kc_fuzz import check, naiveCompose, sample
+from kc_transliterate import Transliterator, transliterate, transliterateFiles, transliteratePaths
+
+class ComposeTest(unittest.TestCase):
+    def testCompose(self):
+        trie = loadMapping('ru')
+        for keys, text in [('privet', "привет"), ('shch', "щ"), ('yaya', "яя"), ('tsa', "ца"), ('shh', "шh")]:
+            with self.subTest(keys=keys):
+                self.assertEqual(compose(trie, keys), text)
+
+    def testEditKeys(self):
+        trie = loadMapping('ru')
+        self.assertEqual(compose(trie, ['s', 'h', LEFT, 't']), "тш")
+        self.assertEqual(compose(trie, ['y', BACKSPACE, 'a']), "а")
+        self.assertEqual(compose(trie, ['y', LEFT, RIGHT, 'a']), "я")
+        self.assertEqual(compose(trie, ['a'], "т s"), "т sа")
+
+    def testFlattenMapping(self):
+        mapping = {"a": "а", "ya": "я", "шсh": "щ"}
+        self.assertEqual(flattenMapping({"a": {"": "а", "y": {"": "я"}}, "h": {"с": {"ш": {"": "щ"}}}}), mapping)
+
+    def testNaiveModel(self):
+        for code in ['el', 'ru']:
+            trie = loadMapping(code)
+            mapping = flattenMapping(trie)
+            for keys, text in sample(code, 0, 200, 12):
+                with self.subTest(code=code, keys=keys):
+                    self.assertIsNone(check(trie, mapping, keys))
+                    self.assertEqual(naiveCompose(mapping, keys), text)
+
+    def testRecursion(self):
+        with self.assertRaises(RecursionError):
+            Composer({"a": {"": "b"}, "b": {"": "a"}}).typeKeys('a')
+
+class TransliterateTest(unittest.TestCase):
+    def testTransliterate(self):
+        trie = loadMapping('ru')
+        self.assertEqual(transliterate(trie, "privet, shchuka\ntsaplya"), "привет, щука\nцапля")
+        for keys, text in sample('ru', 0, 200, 12):
+            keys = ''.join(key for key in keys if (len(key) == 1))
+            with self.subTest(keys=keys):
+                self.assertEqual(transliterate(trie, keys + ' ' + keys), compose(trie, keys + ' ' + keys))
+
+    def testStream(self):
+        trie = loadMapping('ru')
+        transliterator = Transliterator(trie)
+        self.assertEqual(transliterator.feed("privet, sh"), "привет, ")
+        self.assertEqual(transliterator.feed("ch"), "")
+        self.assertEqual(transliterator.feed("uka"), "")
+        self.assertEqual(transliterator.finish(), "щука")
+        with self.assertRaises(ValueError):
+            Transliterator(trie, maxPending=4).feed("privet")
+
+    def testFiles(self):
+        text = "privet, shchuka\n" * 100
+        output = io.StringIO()
+        self.assertEqual(transliterateFiles(loadMapping('ru'), [io.StringIO(text), io.StringIO(text)], [output, output], 64), 2 * len(text))
+        self.assertEqual(output.getvalue(), "привет, щука\n" * 200)
+
+    def testPaths(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            inputPaths = [os.path.join(tempDir, f"input{i}.txt") for i in range(0, 3)]
+            outputPaths = [os.path.join(tempDir, f"output{i}.txt") for i in range(0, 3)]
+            for i, path in enumerate(inputPaths):
+                with open(path, 'w', encoding='utf-8') as file:
+                    file.write("privet\n" * (i + 1))
+            self.assertEqual(transliteratePaths('ru', None, inputPaths, outputPaths, 2, chunkSize=4), 7 * 6)
+            for i, path in enumerate(outputPaths):
+                with open(path, encoding='utf-8') as file:
+                    self.assertEqual(file.read(), "привет\n" * (i + 1))
+
+class DifferentialTest(BrowserTestCase):
+    count = 20      # Number of sequences replayed for each mapping and element
+    seed = 0
+    keys = {BACKSPACE: Keys.BACKSPACE, LEFT: Keys.LEFT, RIGHT: Keys.RIGHT}
+
+    @TestData([
+        {'lang': lang, 'tagName': tagName}
+        for lang in ['ru', 'el']
+        for tagName in ['textarea', 'input[type="text"]', 'div[contentEditable="true"]']
+    ])
+    def testReplay(self, lang, tagName):
+        for keys, text in sample(lang, self.__class__.seed, self.__class__.count, 12):
+            with self.subTest(keys=keys):
+                self.loadPage('test_mapping.html')
+                element = self.browser.find_element(By.CSS_SELECTOR, f'{tagName}[lang="{lang}"]')
+                element.send_keys(''.join(self.__class__.keys.get(key, key) for key in keys))
+                value = element.text if (tagName.startswith('div')) else element.get_property('value')
+                self.assertEqual(value, text)
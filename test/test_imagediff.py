@@ -0,0 +1,55 @@
+# Copyright 2020 Pascal COMBES <pascom@orange.fr>
+#
+# This file is part of KeyboardCompositor.
+#
+# KeyboardCompositor is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# KeyboardCompositor is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with KeyboardCompositor. If not, see <http://www.gnu.org/licenses/>
+
+from . import imagediff
+
+import os
+import struct
+import unittest
+import zlib
+
+def encodePNG(width, height, pixels):
+    def chunk(chunkType, data):
+        return struct.pack('>I', len(data)) + chunkType + data + struct.pack('>I', zlib.crc32(chunkType + data))
+    raw = b''.join(b'\x00' + bytes(pixels[y * width * 4:(y + 1) * width * 4]) for y in range(0, height))
+    return b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0)) \
+                                + chunk(b'IDAT', zlib.compress(raw)) \
+                                + chunk(b'IEND', b'')
+
+class ImageDiffTest(unittest.TestCase):
+    testInput = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'testInput')
+
+    def testDecodeRGBA(self):
+        pixels = [(x * 10, y * 20, x + y, 255) for y in range(0, 12) for x in range(0, 13)]
+        image = imagediff.Image.fromPNG(encodePNG(13, 12, [v for p in pixels for v in p]))
+        self.assertEqual((image.width, image.height), (13, 12))
+        self.assertEqual([int(image.channels[c][5 * 13 + 7]) for c in range(0, 3)], [70, 100, 12])
+
+        cropped = image.crop(2, 3, 11, 9)
+        self.assertEqual([int(cropped.channels[c][0]) for c in range(0, 3)], [20, 60, 5])
+        with self.assertRaises(imagediff.ImageError):
+            image.crop(3, 3, 11, 9)
+
+    def testDSSIM(self):
+        for lang in ['ru', 'el']:
+            with self.subTest(lang=lang):
+                image = imagediff.loadImage(os.path.join(self.testInput, 'TextAreaTest', f"testFlag_{lang}.png"))
+                self.assertEqual((image.width, image.height), (39, 32))
+                self.assertAlmostEqual(imagediff.dssim(image, image), 0)
+        ru = imagediff.loadImage(os.path.join(self.testInput, 'TextAreaTest', "testFlag_ru.png"))
+        el = imagediff.loadImage(os.path.join(self.testInput, 'TextAreaTest', "testFlag_el.png"))
+        self.assertGreater(imagediff.dssim(ru, el), 0.1)
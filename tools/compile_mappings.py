@@ -0,0 +1,396 @@
+#!/usr/bin/env python3
+# Copyright 2020 Pascal COMBES <pascom@orange.fr>
+#
+# This file is part of KeyboardCompositor.
+#
+# KeyboardCompositor is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# KeyboardCompositor is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with KeyboardCompositor. If not, see <http://www.gnu.org/licenses/>
+
+"""Compile the mapping sources in src/mappings.in into the JSON files loaded by the extension.
+
+A mapping source starts with a header giving the name of the language and the icon
+of its flag, followed by a JSON object associating typed keys with the mapped text.
+Comments (// and /* */) and trailing commas are allowed:
+
+    // Name: Russian
+    // Icon: ru.png
+    {
+        "a":  "а", // Comment
+        "ya": "я",
+    }
+
+Each mapping is compiled into a reverse suffix trie: each node is an object
+whose keys are characters (code points, so that a surrogate pair in the UTF-16 text
+of the extension is a single character) and whose values are the child nodes. The keys of the
+mapping are inserted from their last character to their first one, so that the trie
+can be walked backwards from the caret. The mapped text is stored under the empty key.
+
+Large mappings (with more than SHARD_THRESHOLD keys) are sharded: the subtrie of each
+final character is written in its own file (mappings/<code>/<code point>.json), so that
+the extension only loads the shards of the characters which are typed. The list of the
+mappings then gives the characters which have a shard and the length of the longest key.
+
+Only the mappings whose source changed since the previous run are compiled again.
+The conflicts found in a mapping are listed when they were not reported by the previous run
+(or every time with the --verbose option).
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import sys
+
+VERSION = 2                     # Bump when the output format changes
+HASHES_FILE = '.hashes'         # Hashes of the sources of the compiled mappings
+CONFLICTS_FILE = '.conflicts'   # Conflicts reported for the compiled mappings
+LIST_FILE = 'list.json'         # List of the mappings
+SHARD_THRESHOLD = 4096          # Number of keys above which a mapping is sharded
+
+class MappingError(Exception):
+    def __init__(self, path, line, message):
+        super().__init__(f"{path}:{line}: {message}")
+        self.path = path
+        self.line = line
+
+class MappingParser:
+    """Parser for the mapping sources."""
+
+    def __init__(self, text, path='<mapping>'):
+        self.text = text
+        self.path = path
+        self.pos = 0
+
+    def error(self, message, pos=None):
+        pos = self.pos if pos is None else pos
+        return MappingError(self.path, self.text.count('\n', 0, pos) + 1, message)
+
+    def skipBlanks(self):
+        while self.pos < len(self.text):
+            if self.text[self.pos].isspace():
+                self.pos += 1
+            elif self.text.startswith('//', self.pos):
+                end = self.text.find('\n', self.pos)
+                self.pos = len(self.text) if (end == -1) else end
+            elif self.text.startswith('/*', self.pos):
+                end = self.text.find('*/', self.pos + 2)
+                if (end == -1):
+                    raise self.error("Unterminated comment")
+                self.pos = end + 2
+            else:
+                break
+
+    def peek(self):
+        self.skipBlanks()
+        return self.text[self.pos] if (self.pos < len(self.text)) else None
+
+    def expect(self, char):
+        if (self.peek() != char):
+            raise self.error(f"Expected '{char}', got {self.describe()}")
+        self.pos += 1
+
+    def describe(self):
+        return f"'{self.text[self.pos]}'" if (self.pos < len(self.text)) else "end of file"
+
+    def parseString(self):
+        if (self.peek() != '"'):
+            raise self.error(f"Expected string, got {self.describe()}")
+        start = self.pos
+        try:
+            string, self.pos = json.decoder.scanstring(self.text, self.pos + 1)
+        except json.JSONDecodeError as error:
+            raise self.error(error.msg, error.pos) from None
+        return string, start
+
+    def parseHeader(self):
+        header = {}
+        for line in self.text.splitlines():
+            if not line.startswith('// '):
+                break
+            key, sep, value = line[3:].partition(': ')
+            if sep:
+                header[key.strip().lower()] = value.strip()
+        for key in ('name', 'icon'):
+            if key not in header:
+                raise MappingError(self.path, 1, f"Missing '// {key.capitalize()}: ' header")
+        return header
+
+    def parse(self):
+        """Parse the mapping source.
+
+        :return: A tuple containing the header (a dictionary with the 'name' and 'icon' keys)
+        and the list of the entries of the mapping, as (key, value, line) tuples.
+        """
+        header = self.parseHeader()
+        entries = []
+        self.expect('{')
+        while (self.peek() != '}'):
+            key, start = self.parseString()
+            self.expect(':')
+            value, _ = self.parseString()
+            entries.append((key, value, self.text.count('\n', 0, start) + 1))
+            if (self.peek() != ','):
+                break
+            self.pos += 1
+        self.expect('}')
+        if self.peek() is not None:
+            raise self.error(f"Unexpected {self.describe()} after mapping")
+        return header, entries
+
+def checkMapping(entries, path='<mapping>'):
+    """Check the entries of a mapping.
+
+    Empty and duplicate keys are rejected, as well as shadowed keys:
+    a key is shadowed when one of its proper prefixes ends with another key,
+    because that key is composed as soon as it is typed, so that the shadowed
+    key can never be typed.
+
+    :param entries: The entries of the mapping, as (key, value, line) tuples.
+    :param path: The path to the mapping source, used in error messages.
+    :return: The mapping, as a dictionary.
+    :raise MappingError: When the mapping is invalid.
+    """
+    mapping = {}
+    lines = {}
+    for key, value, line in entries:
+        if not key:
+            raise MappingError(path, line, "Empty key")
+        if key in mapping:
+            raise MappingError(path, line, f"Duplicate key '{key}' (first defined on line {lines[key]})")
+        mapping[key] = value
+        lines[key] = line
+
+    for key in mapping:
+        for j in range(1, len(key)):
+            for i in range(0, j):
+                other = key[i:j]
+                if (other in mapping) and (mapping[other] != other):
+                    raise MappingError(path, lines[key], f"Key '{key}' is shadowed by key '{other}' (line {lines[other]})")
+    return mapping
+
+def findConflicts(mapping):
+    """Find the prefix and suffix conflicts in a mapping.
+
+    These are not errors, but they make the result of a composition
+    depend on the previous compositions:
+    - A suffix conflict occurs when a key ends with another key,
+      in which case the longest key wins (e.g. 'шсh' and 'сh').
+    - A prefix conflict (or chain) occurs when a key starts with the text
+      produced by another key (e.g. 'тs' needs 't' to be composed into 'т' first).
+
+    :param mapping: The mapping, as a dictionary.
+    :return: A list of messages describing the conflicts.
+    """
+    producers = {}
+    for key, value in sorted(mapping.items()):
+        if value and (value != key):
+            producers.setdefault(value, []).append(key)
+
+    # Only the substrings of the keys with the length of a produced value are looked up:
+    lengths = sorted({len(value) for value in producers})
+
+    conflicts = []
+    for key in sorted(mapping):
+        for i in range(1, len(key)):
+            if key[i:] in mapping:
+                conflicts.append(f"Key '{key[i:]}' is a suffix of key '{key}'")
+        chained = set()
+        for j in range(1, len(key)):
+            for length in lengths:
+                if (length > j):
+                    break
+                if key[j - length:j] in producers:
+                    chained.add(key[j - length:j])
+        for value in sorted(chained):
+            conflicts.append(f"Key '{key}' chains on '{value}' (from " + ", ".join(f"'{other}'" for other in producers[value]) + ")")
+    return conflicts
+
+def compileMapping(mapping):
+    """Compile a mapping into a reverse suffix trie.
+
+    :param mapping: The mapping, as a dictionary.
+    :return: The root node of the trie.
+    """
+    root = {}
+    for key, value in mapping.items():
+        node = root
+        for char in reversed(key):
+            node = node.setdefault(char, {})
+        node[''] = value
+    return root
+
+def shardName(char):
+    """Get the name of the file of a shard.
+
+    :param char: The final character of the keys in the shard.
+    :return: The name of the file (the code point of the character).
+    """
+    return f"{ord(char):04x}.json"
+
+def writeShards(shardDir, trie):
+    """Write the shards of a compiled mapping.
+
+    The shards which are not part of the mapping any more are removed.
+
+    :param shardDir: The directory where the shards are written.
+    :param trie: The compiled mapping.
+    :return: The sorted list of the characters which have a shard.
+    """
+    os.makedirs(shardDir, exist_ok=True)
+    names = set()
+    for char, node in trie.items():
+        names.add(shardName(char))
+        writeIfChanged(os.path.join(shardDir, shardName(char)), dumpJSON(node))
+    for name in set(os.listdir(shardDir)) - names:
+        os.remove(os.path.join(shardDir, name))
+    return sorted(trie)
+
+def removeMapping(destDir, code):
+    """Remove a compiled mapping (either sharded or not).
+
+    :param destDir: The directory containing the compiled mappings.
+    :param code: The code of the mapping.
+    """
+    try:
+        os.remove(os.path.join(destDir, code + '.json'))
+    except FileNotFoundError:
+        pass
+    shutil.rmtree(os.path.join(destDir, code), ignore_errors=True)
+
+def dumpJSON(data):
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':'), sort_keys=True)
+
+def writeIfChanged(path, text):
+    try:
+        with open(path, 'r', encoding='utf-8') as file:
+            if (file.read() == text):
+                return False
+    except FileNotFoundError:
+        pass
+    with open(path, 'w', encoding='utf-8') as file:
+        file.write(text)
+    return True
+
+def compileMappings(srcDir, destDir, iconDir=None, force=False, log=sys.stdout, shardThreshold=SHARD_THRESHOLD, verbose=False):
+    """Compile all the mappings in a directory.
+
+    :param srcDir: The directory containing the mapping sources.
+    :param destDir: The directory where the compiled mappings are written.
+    :param iconDir: The directory containing the flag icons, if they should be checked.
+    :param force: Whether to compile the mappings even if their source did not change.
+    :param log: The stream where progress and conflicts are reported.
+    :param shardThreshold: The number of keys above which a mapping is sharded.
+    :param verbose: Whether to list all the conflicts, and not only the ones which were not reported before.
+    :return: The list of the mappings.
+    :raise MappingError: When a mapping is invalid.
+    """
+    os.makedirs(destDir, exist_ok=True)
+    try:
+        with open(os.path.join(destDir, HASHES_FILE), 'r', encoding='utf-8') as file:
+            hashes = json.load(file)
+    except (FileNotFoundError, ValueError):
+        hashes = {}
+    try:
+        with open(os.path.join(destDir, LIST_FILE), 'r', encoding='utf-8') as file:
+            previous = {mapping['code']: mapping for mapping in json.load(file)}
+    except (FileNotFoundError, ValueError):
+        previous = {}
+    try:
+        with open(os.path.join(destDir, CONFLICTS_FILE), 'r', encoding='utf-8') as file:
+            reported = json.load(file)
+    except (FileNotFoundError, ValueError):
+        reported = {}
+
+    mappingList = []
+    newHashes = {}
+    newConflicts = {}
+    for name in sorted(os.listdir(srcDir)):
+        code, ext = os.path.splitext(name)
+        if (ext != '.js'):
+            continue
+        path = os.path.join(srcDir, name)
+        with open(path, 'rb') as file:
+            source = file.read()
+        digest = hashlib.sha256(f"{VERSION}\n{shardThreshold}\n".encode() + source).hexdigest()
+        parser = MappingParser(source.decode('utf-8'), path)
+        header = parser.parseHeader()
+        if (iconDir is not None) and not os.path.isfile(os.path.join(iconDir, header['icon'])):
+            raise MappingError(path, 1, f"Icon '{header['icon']}' does not exist")
+        entry = {'code': code, 'name': header['name'], 'icon': header['icon']}
+        newHashes[code] = digest
+
+        dest = os.path.join(destDir, code + '.json')
+        if not force and (hashes.get(code) == digest) and (code in previous) \
+           and os.path.exists(os.path.join(destDir, code) if ('shards' in previous[code]) else dest):
+            print(f"Mapping {name} is up to date", file=log)
+            mappingList.append(dict(previous[code], **entry))
+            if code in reported:
+                newConflicts[code] = reported[code]
+            continue
+
+        print(f"Processing mapping: {name} ...", file=log)
+        _, entries = parser.parse()
+        mapping = checkMapping(entries, path)
+        conflicts = findConflicts(mapping)
+        known = set(reported.get(code, []))
+        for conflict in conflicts:
+            if verbose or (conflict not in known):
+                print(f"    {conflict}", file=log)
+        if not verbose and known.intersection(conflicts):
+            print(f"    {len(known.intersection(conflicts))} conflict(s) already reported (use --verbose to list them)", file=log)
+        if conflicts:
+            newConflicts[code] = conflicts
+        trie = compileMapping(mapping)
+        if (len(mapping) > shardThreshold):
+            if os.path.isfile(dest):
+                os.remove(dest)
+            entry['shards'] = writeShards(os.path.join(destDir, code), trie)
+            entry['depth'] = max(len(key) for key in mapping)
+            print(f"    Sharded into {len(entry['shards'])} shards", file=log)
+        else:
+            shutil.rmtree(os.path.join(destDir, code), ignore_errors=True)
+            writeIfChanged(dest, dumpJSON(trie))
+        mappingList.append(entry)
+
+    # Remove the mappings whose source was removed:
+    for code in set(hashes) - set(newHashes):
+        removeMapping(destDir, code)
+
+    writeIfChanged(os.path.join(destDir, LIST_FILE), dumpJSON(mappingList))
+    writeIfChanged(os.path.join(destDir, HASHES_FILE), json.dumps(newHashes, indent=4, sort_keys=True))
+    writeIfChanged(os.path.join(destDir, CONFLICTS_FILE), json.dumps(newConflicts, ensure_ascii=False, indent=4, sort_keys=True))
+    return mappingList
+
+if __name__ == '__main__':
+    baseDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+    argParser = argparse.ArgumentParser(description="Compile KeyboardCompositor mappings.")
+    argParser.add_argument('srcDir', nargs='?', default=os.path.join(baseDir, 'src', 'mappings.in'),
+                           help="Directory containing the mapping sources")
+    argParser.add_argument('destDir', nargs='?', default=os.path.join(baseDir, 'src', 'mappings'),
+                           help="Directory where the compiled mappings are written")
+    argParser.add_argument('-f', '--force', action='store_true',
+                           help="Compile all the mappings, even if they did not change")
+    argParser.add_argument('-s', '--shard-threshold', type=int, default=SHARD_THRESHOLD,
+                           help=f"Number of keys above which a mapping is sharded (defaults to {SHARD_THRESHOLD})")
+    argParser.add_argument('-v', '--verbose', action='store_true',
+                           help="List all the conflicts, even if they were already reported")
+    args = argParser.parse_args()
+
+    try:
+        compileMappings(args.srcDir, args.destDir, os.path.join(baseDir, 'src', 'icons', '32x32', 'flags'), args.force,
+                        shardThreshold=args.shard_threshold, verbose=args.verbose)
+    except MappingError as error:
+        print(f"ERROR: {error}", file=sys.stderr)
+        sys.exit(1)
@@ -0,0 +1,188 @@
+# Copyright 2020 Pascal COMBES <pascom@orange.fr>
+#
+# This file is part of KeyboardCompositor.
+#
+# KeyboardCompositor is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# KeyboardCompositor is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with KeyboardCompositor. If not, see <http://www.gnu.org/licenses/>
+
+"""Reference implementation of the composition engine of the content script.
+
+The Composer class simulates a text field in which the keyMapper of
+src/kc_content_script.js is installed: each typed key is inserted at the caret
+and then keyMapper.onKeyUp() is simulated. This includes the synthetic keyup events
+dispatched for each deleted and inserted character, which are handled by
+keyMapper.onKeyUp() again.
+"""
+
+import json
+import os
+
+from compile_mappings import MappingParser, checkMapping, compileMapping
+
+BACKSPACE = 'Backspace'     # Deletes the character before the caret
+LEFT = 'ArrowLeft'          # Moves the caret to the left
+RIGHT = 'ArrowRight'        # Moves the caret to the right
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def loadMapping(code, mappingDir=None):
+    """Load a compiled mapping.
+
+    When the mapping was not compiled yet (i.e. build.sh was not run),
+    its source in src/mappings.in is compiled in memory.
+    The shards of sharded mappings are merged.
+
+    :param code: The code of the mapping (e.g. 'ru').
+    :param mappingDir: The directory containing the compiled mappings
+    (defaults to src/mappings).
+    :return: The compiled mapping (a reverse suffix trie).
+    """
+    if mappingDir is None:
+        mappingDir = os.path.join(BASE_DIR, 'src', 'mappings')
+    try:
+        with open(os.path.join(mappingDir, code + '.json'), 'r', encoding='utf-8') as mappingFile:
+            return json.load(mappingFile)
+    except FileNotFoundError:
+        pass
+    shardDir = os.path.join(mappingDir, code)
+    if os.path.isdir(shardDir):
+        trie = {}
+        for name in os.listdir(shardDir):
+            with open(os.path.join(shardDir, name), 'r', encoding='utf-8') as shardFile:
+                trie[chr(int(os.path.splitext(name)[0], 16))] = json.load(shardFile)
+        return trie
+
+    path = os.path.join(BASE_DIR, 'src', 'mappings.in', code + '.js')
+    with open(path, 'r', encoding='utf-8') as sourceFile:
+        _, entries = MappingParser(sourceFile.read(), path).parse()
+    return compileMapping(checkMapping(entries, path))
+
+def flattenMapping(trie):
+    """Convert a compiled mapping back into a dictionary.
+
+    :param trie: The compiled mapping.
+    :return: A dictionary associating the keys to the mapped texts.
+    """
+    mapping = {}
+    stack = [('', trie)]
+    while stack:
+        suffix, node = stack.pop()
+        for char, child in node.items():
+            if (char == ''):
+                mapping[suffix] = child
+            else:
+                stack.append((char + suffix, child))
+    return mapping
+
+def match(trie, text, pos):
+    """Find the longest key ending at the given position (see keyMapper.match()).
+
+    :param trie: The compiled mapping.
+    :param text: The text in which to search the key.
+    :param pos: The position at which the key should end.
+    :return: A tuple containing the key length and the mapped text, or None.
+    """
+    found = None
+    node = trie
+    for l in range(1, pos + 1):
+        node = node.get(text[pos - l])
+        if node is None:
+            break
+        if '' in node:
+            found = (l, node[''])
+    return found
+
+class Composer:
+    """A simulated text field with the key mapper installed.
+
+    :param trie: The compiled mapping.
+    :param text: The initial text of the field.
+    :param caret: The initial position of the caret (defaults to the end of the text).
+    :param maxDepth: The maximum nesting of synthetic keyup events,
+    after which a RecursionError is raised.
+    """
+
+    def __init__(self, trie, text='', caret=None, maxDepth=64):
+        self.trie = trie
+        self.text = text
+        self.caret = len(text) if caret is None else caret
+        self.maxDepth = maxDepth
+        self.events = 0
+
+    def setRangeText(self, text, start, end):
+        # Same clamping as HTMLInputElement.setRangeText():
+        start = min(start, len(self.text))
+        end = min(end, len(self.text))
+        self.text = self.text[:start] + text + self.text[end:]
+        self.caret = start + len(text)
+
+    def type(self, key):
+        """Type a key.
+
+        :param key: A character, BACKSPACE, LEFT or RIGHT.
+        """
+        if (key == BACKSPACE):
+            if (self.caret > 0):
+                self.setRangeText('', self.caret - 1, self.caret)
+        elif (key == LEFT):
+            self.caret = max(0, self.caret - 1)
+        elif (key == RIGHT):
+            self.caret = min(len(self.text), self.caret + 1)
+        else:
+            self.setRangeText(key, self.caret, self.caret)
+        self.keyUp(0)
+
+    def typeKeys(self, keys):
+        """Type a sequence of keys.
+
+        :param keys: An iterable over the keys to type (see type()).
+        :return: The text of the field.
+        """
+        for key in keys:
+            self.type(key)
+        return self.text
+
+    def keyUp(self, depth):
+        """Simulate keyMapper.onKeyUp().
+
+        :param depth: The nesting level of the keyup event.
+        """
+        if (depth > self.maxDepth):
+            raise RecursionError(f"Composition nested more than {self.maxDepth} times")
+
+        posStart = self.caret
+        found = match(self.trie, self.text, posStart)
+        if found is None:
+            return
+        l, keys = found
+
+        # Delete original text:
+        for c in range(1, l + 1):
+            self.setRangeText('', posStart - c, posStart - c + 1)
+            self.events += 3
+            self.keyUp(depth + 1)
+        # Add mapped text:
+        for c in range(1, len(keys) + 1):
+            self.setRangeText(keys[c - 1], posStart - l + c - 1, posStart - l + c - 1)
+            self.events += 4
+            self.keyUp(depth + 1)
+
+def compose(trie, keys, text=''):
+    """Type keys in a simulated text field.
+
+    :param trie: The compiled mapping.
+    :param keys: An iterable over the keys to type (see Composer.type()).
+    :param text: The initial text of the field.
+    :return: The text of the field.
+    """
+    return Composer(trie, text).typeKeys(keys)
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+# Copyright 2020 Pascal COMBES <pascom@orange.fr>
+#
+# This file is part of KeyboardCompositor.
+#
+# KeyboardCompositor is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# KeyboardCompositor is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with KeyboardCompositor. If not, see <http://www.gnu.org/licenses/>
+
+"""Fuzz the composition engine without a browser.
+
+Random key sequences (including backspaces and caret moves) are typed in the
+reference implementation of the content script (see kc_compose.py) and in a naive
+model, which matches keys by slicing the text and replaces the longest key before
+the caret until no key matches. The fuzzer reports the sequences for which they
+differ (shrunk to a minimal sequence) or for which the composition does not terminate.
+
+The sequences are generated in several processes from a seed, so that a run can be
+reproduced with the same --seed and --jobs options.
+"""
+
+import argparse
+import multiprocessing
+import random
+import sys
+import time
+
+from kc_compose import BACKSPACE, LEFT, RIGHT, Composer, flattenMapping, loadMapping
+
+EDIT_KEYS = [BACKSPACE, LEFT, RIGHT]
+
+def naiveCompose(mapping, keys, maxSteps=64):
+    """Type keys with the naive model.
+
+    :param mapping: The mapping, as a dictionary.
+    :param keys: An iterable over the keys to type (see Composer.type()).
+    :param maxSteps: The maximum number of compositions for a typed key.
+    :return: The text of the field.
+    """
+    maxLength = max(len(key) for key in mapping)
+    text = ''
+    caret = 0
+    for key in keys:
+        if (key == BACKSPACE):
+            if (caret > 0):
+                text = text[:caret - 1] + text[caret:]
+                caret -= 1
+        elif (key == LEFT):
+            caret = max(0, caret - 1)
+        elif (key == RIGHT):
+            caret = min(len(text), caret + 1)
+        else:
+            text = text[:caret] + key + text[caret:]
+            caret += 1
+        for _ in range(0, maxSteps + 1):
+            for l in range(min(maxLength, caret), 0, -1):
+                if text[caret - l:caret] in mapping:
+                    break
+            else:
+                break
+            value = mapping[text[caret - l:caret]]
+            text = text[:caret - l] + value + text[caret:]
+            caret += len(value) - l
+        else:
+            raise RecursionError(f"Composition did not terminate after {maxSteps} steps")
+    return text
+
+def alphabet(mapping):
+    """The keys which are typed by the fuzzer: the characters of the keys and a space."""
+    return sorted(set(''.join(mapping)) | {' '})
+
+def generate(rng, chars, length, editRate=0.1):
+    """Generate a random key sequence.
+
+    :param rng: The random generator.
+    :param chars: The characters which may be typed.
+    :param length: The number of keys.
+    :param editRate: The probability of each key to be a backspace or a caret move.
+    :return: The list of the keys.
+    """
+    return [rng.choice(EDIT_KEYS) if (rng.random() < editRate) else rng.choice(chars) for _ in range(0, length)]
+
+def check(trie, mapping, keys):
+    """Type the keys in the reference implementation and in the naive model.
+
+    :return: None when both agree, or a message describing the difference.
+    """
+    try:
+        expected = naiveCompose(mapping, keys)
+    except RecursionError as error:
+        expected = f"<{error}>"
+    try:
+        actual = Composer(trie).typeKeys(keys)
+    except RecursionError as error:
+        actual = f"<{error}>"
+    if (actual != expected):
+        return f"got {actual!r}, expected {expected!r}"
+    return None
+
+def shrink(trie, mapping, keys):
+    """Remove keys from a failing sequence while it still fails."""
+    size = len(keys) // 2
+    while (size > 0):
+        start = 0
+        while (start < len(keys)):
+            candidate = keys[:start] + keys[start + size:]
+            if candidate and check(trie, mapping, candidate):
+                keys = candidate
+            else:
+                start += size
+        size //= 2
+    return keys
+
+def fuzz(code, seed, duration, maxLength, maxFailures):
+    """Fuzz one mapping (run in a worker process).
+
+    :return: A tuple containing the number of sequences, the number of keys
+    and the list of the failing sequences.
+    """
+    trie = loadMapping(code)
+    mapping = flattenMapping(trie)
+    chars = alphabet(mapping)
+    rng = random.Random(seed)
+
+    sequences = 0
+    typed = 0
+    failures = []
+    end = time.monotonic() + duration
+    while (time.monotonic() < end) and (len(failures) < maxFailures):
+        for _ in range(0, 100):
+            keys = generate(rng, chars, rng.randint(1, maxLength))
+            sequences += 1
+            typed += len(keys)
+            if check(trie, mapping, keys):
+                keys = shrink(trie, mapping, keys)
+                failures.append((keys, check(trie, mapping, keys)))
+                break
+    return sequences, typed, failures
+
+def sample(code, seed, count, maxLength):
+    """Generate a reproducible sample of key sequences with the expected texts.
+
+    :return: A list of (keys, text) tuples.
+    """
+    trie = loadMapping(code)
+    chars = alphabet(flattenMapping(trie))
+    rng = random.Random(seed)
+    sequences = [generate(rng, chars, rng.randint(1, maxLength)) for _ in range(0, count)]
+    return [(keys, Composer(trie).typeKeys(keys)) for keys in sequences]
+
+def describe(keys):
+    return ' '.join(key if (len(key) == 1) else f"<{key}>" for key in keys)
+
+if __name__ == '__main__':
+    argParser = argparse.ArgumentParser(description="Fuzz the KeyboardCompositor composition engine.")
+    argParser.add_argument('codes', nargs='*', default=['el', 'ru'],
+                           help="Codes of the mappings to fuzz")
+    argParser.add_argument('-j', '--jobs', type=int, default=multiprocessing.cpu_count(),
+                           help="Number of worker processes (per mapping)")
+    argParser.add_argument('-t', '--time', type=float, default=10,
+                           help="Duration of the run, in seconds")
+    argParser.add_argument('-l', '--length', type=int, default=12,
+                           help="Maximum length of the key sequences")
+    argParser.add_argument('-s', '--seed', type=int, default=0,
+                           help="Seed of the random generator")
+    argParser.add_argument('-m', '--max-failures', type=int, default=5,
+                           help="Number of failures after which a worker stops")
+    args = argParser.parse_args()
+
+    tasks = [(code, args.seed * 1000003 + j, args.time, args.length, args.max_failures)
+             for code in args.codes for j in range(0, args.jobs)]
+    with multiprocessing.Pool(min(len(tasks), multiprocessing.cpu_count())) as pool:
+        start = time.monotonic()
+        results = pool.starmap(fuzz, tasks)
+        elapsed = time.monotonic() - start
+
+    failed = False
+    for code in args.codes:
+        codeResults = [result for task, result in zip(tasks, results) if (task[0] == code)]
+        sequences = sum(result[0] for result in codeResults)
+        typed = sum(result[1] for result in codeResults)
+        print(f"{code}: {sequences} sequences ({typed} keys) in {elapsed:.1f}s, {60 * sequences / elapsed:.0f} sequences/min")
+        failures = {}
+        for result in codeResults:
+            for keys, message in result[2]:
+                failures.setdefault(tuple(keys), message)
+        for keys, message in sorted(failures.items(), key=lambda failure: len(failure[0])):
+            print(f"    FAIL {describe(keys)}: {message}")
+            failed = True
+    sys.exit(1 if failed else 0)
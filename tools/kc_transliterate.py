@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+# Copyright 2020 Pascal COMBES <pascom@orange.fr>
+#
+# This file is part of KeyboardCompositor.
+#
+# KeyboardCompositor is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# KeyboardCompositor is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with KeyboardCompositor. If not, see <http://www.gnu.org/licenses/>
+
+"""Transliterate text files with the compiled mappings, without a browser.
+
+The text is transliterated as the content script does when text is pasted
+(see keyMapper.transliterate() in src/kc_content_script.js): each character is appended
+to the output and the longest key ending the output is replaced by its mapped text,
+until no key matches, as if the characters were typed one by one.
+
+The text is streamed: the output is written as soon as it cannot change any more,
+i.e. up to the last character which is not part of any key (such as a space or a newline),
+since no key can match across it. The words between these separators are transliterated
+independently, which allows to cache them.
+
+Each file is streamed in a single process, which keeps its word cache warm.
+When several files are written in an output directory, they are transliterated
+in parallel in a process pool.
+"""
+
+import argparse
+import multiprocessing
+import os
+import re
+import sys
+import time
+
+from kc_compose import flattenMapping, loadMapping
+
+CHUNK_SIZE = 1 << 20        # Number of characters read at once
+MAX_PENDING = 1 << 24       # Number of characters after which the output must be written
+CACHE_SIZE = 1 << 16        # Number of transliterated words which are cached
+
+class Transliterator:
+    """Streaming transliterator.
+
+    The text is split into words (runs of characters which are part of keys) and separators.
+    Since no key can match across a separator, each word is transliterated independently
+    and the transliterated words are cached.
+
+    :param trie: The compiled mapping.
+    :param maxPending: The maximum number of characters which are not written,
+    after which a ValueError is raised (when the text contains no separator).
+    :param cacheSize: The maximum number of cached words.
+    """
+
+    def __init__(self, trie, maxPending=MAX_PENDING, cacheSize=CACHE_SIZE):
+        self.trie = trie
+        self.maxPending = maxPending
+        self.cacheSize = cacheSize
+        self.cache = {}
+        self.pending = ''
+        keyChars = ''.join(sorted(set(''.join(flattenMapping(trie)))))
+        if keyChars:
+            self.words = re.compile('[' + ''.join(re.escape(char) for char in keyChars) + ']+')
+            self.separator = re.compile('[^' + ''.join(re.escape(char) for char in keyChars) + ']')
+        else:
+            self.words = self.separator = None
+
+    def transliterateWord(self, word):
+        """Transliterate a word (see keyMapper.transliterate()).
+
+        :param word: A run of characters which are part of keys.
+        :return: The transliterated word.
+        """
+        trie = self.trie
+        output = []
+        for char in word:
+            output.append(char)
+            # The number of compositions is bounded, in case the mapping loops:
+            for _ in range(0, 64):
+                # Find the longest key ending the output (see keyMapper.match()):
+                found = None
+                node = trie
+                for l in range(1, len(output) + 1):
+                    node = node.get(output[-l])
+                    if node is None:
+                        break
+                    if '' in node:
+                        found = l
+                        value = node['']
+                if found is None:
+                    break
+                output[-found:] = value
+        return ''.join(output)
+
+    def replaceWord(self, match):
+        word = match.group()
+        text = self.cache.get(word)
+        if text is None:
+            if (len(self.cache) >= self.cacheSize):
+                self.cache.clear()
+            text = self.cache[word] = self.transliterateWord(word)
+        return text
+
+    def feed(self, text):
+        """Transliterate a part of the text.
+
+        :param text: The next part of the text.
+        :return: The part of the output which cannot change any more
+        (up to the last separator).
+        """
+        if self.words is None:
+            return text
+        text = self.pending + text
+        # Find the last separator:
+        end = len(text)
+        while (end > 0) and not self.separator.match(text, end - 1):
+            end -= 1
+        self.pending = text[end:]
+        if (len(self.pending) > self.maxPending):
+            raise ValueError(f"No separator in the last {len(self.pending)} characters")
+        return self.words.sub(self.replaceWord, text[:end])
+
+    def finish(self):
+        """End the text.
+
+        :return: The rest of the output.
+        """
+        text = self.pending
+        self.pending = ''
+        return self.words.sub(self.replaceWord, text) if self.words else text
+
+def transliterate(trie, text):
+    """Transliterate a text.
+
+    :param trie: The compiled mapping.
+    :param text: The text.
+    :return: The transliterated text.
+    """
+    transliterator = Transliterator(trie)
+    return transliterator.feed(text) + transliterator.finish()
+
+def transliterateFiles(trie, inputs, outputs, chunkSize=CHUNK_SIZE):
+    """Transliterate files.
+
+    :param trie: The compiled mapping.
+    :param inputs: The input text files.
+    :param outputs: The output text files (one for each input file).
+    :param chunkSize: The number of characters read at once.
+    :return: The number of transliterated characters.
+    """
+    count = 0
+    for input, output in zip(inputs, outputs):
+        transliterator = Transliterator(trie)
+        while True:
+            chunk = input.read(chunkSize)
+            if not chunk:
+                break
+            count += len(chunk)
+            output.write(transliterator.feed(chunk))
+        output.write(transliterator.finish())
+    return count
+
+workerTrie = None
+
+def initWorker(code, mappingDir):
+    global workerTrie
+    workerTrie = loadMapping(code, mappingDir)
+
+def transliterateFile(inputPath, outputPath, encoding, chunkSize):
+    """Transliterate a file (run in a worker process).
+
+    :return: The number of transliterated characters.
+    """
+    with open(inputPath, 'r', encoding=encoding, newline='') as input, \
+         open(outputPath, 'w', encoding=encoding, newline='') as output:
+        return transliterateFiles(workerTrie, [input], [output], chunkSize)
+
+def transliteratePaths(code, mappingDir, inputPaths, outputPaths, jobs, encoding='utf-8', chunkSize=CHUNK_SIZE):
+    """Transliterate files in parallel.
+
+    :param code: The code of the mapping (loaded by the worker processes).
+    :param mappingDir: The directory containing the compiled mappings.
+    :param inputPaths: The paths to the input files.
+    :param outputPaths: The paths to the output files (one for each input file).
+    :param jobs: The number of worker processes.
+    :param encoding: The encoding of the files.
+    :param chunkSize: The number of characters read at once.
+    :return: The number of transliterated characters.
+    """
+    with multiprocessing.Pool(min(jobs, len(inputPaths)), initWorker, (code, mappingDir)) as pool:
+        return sum(pool.starmap(transliterateFile, [
+            (inputPath, outputPath, encoding, chunkSize) for inputPath, outputPath in zip(inputPaths, outputPaths)
+        ]))
+
+if __name__ == '__main__':
+    argParser = argparse.ArgumentParser(description="Transliterate text files with a KeyboardCompositor mapping.")
+    argParser.add_argument('code',
+                           help="Code of the mapping (e.g. ru)")
+    argParser.add_argument('inputs', nargs='*',
+                           help="Input files (defaults to the standard input)")
+    argParser.add_argument('-o', '--output',
+                           help="Output file or, with several input files, output directory (defaults to the standard output)")
+    argParser.add_argument('-d', '--mapping-dir',
+                           help="Directory containing the compiled mappings (defaults to src/mappings)")
+    argParser.add_argument('-j', '--jobs', type=int, default=1,
+                           help="Number of worker processes, when several files are written in an output directory")
+    argParser.add_argument('-c', '--chunk-size', type=int, default=CHUNK_SIZE,
+                           help="Number of characters read at once")
+    argParser.add_argument('-e', '--encoding', default='utf-8',
+                           help="Encoding of the input and output files")
+    args = argParser.parse_args()
+
+    start = time.monotonic()
+    try:
+        if args.output and (len(args.inputs) > 1):
+            os.makedirs(args.output, exist_ok=True)
+            outputPaths = [os.path.join(args.output, os.path.basename(path)) for path in args.inputs]
+            if (args.jobs > 1):
+                count = transliteratePaths(args.code, args.mapping_dir, args.inputs, outputPaths, args.jobs, args.encoding, args.chunk_size)
+            else:
+                initWorker(args.code, args.mapping_dir)
+                count = sum(transliterateFile(inputPath, outputPath, args.encoding, args.chunk_size)
+                            for inputPath, outputPath in zip(args.inputs, outputPaths))
+        else:
+            if args.inputs:
+                inputs = [open(path, 'r', encoding=args.encoding, newline='') for path in args.inputs]
+            else:
+                inputs = [open(sys.stdin.fileno(), 'r', encoding=args.encoding, newline='', closefd=False)]
+            if args.output:
+                output = open(args.output, 'w', encoding=args.encoding, newline='')
+            else:
+                output = open(sys.stdout.fileno(), 'w', encoding=args.encoding, newline='', closefd=False)
+            try:
+                count = transliterateFiles(loadMapping(args.code, args.mapping_dir), inputs, [output] * len(inputs), args.chunk_size)
+            finally:
+                for file in inputs + [output]:
+                    file.close()
+    except ValueError as error:
+        print(f"ERROR: {error}", file=sys.stderr)
+        sys.exit(1)
+    elapsed = time.monotonic() - start
+    print(f"{args.code}: {count} characters in {elapsed:.1f}s, {count / max(elapsed, 1e-6) / 1e6:.2f} Mchars/s", file=sys.stderr)